@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Idle CPU usage of the client receive loop.
+
+Connects to a silent local server and measures the process CPU time spent
+while waiting for messages, first with the former busy-wait loop (non-blocking
+recv spinning on EAGAIN), then with network.ServerConnection.
+
+Usage : python benchmarks/bench_client_idle.py [seconds]
+"""
+
+import errno
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from network import ServerConnection
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class BusyWaitListener(Thread):
+    """The receive loop ListenerServer used before, kept here as the baseline."""
+    runThread = True
+
+    def __init__(self, port):
+        Thread.__init__(self)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(("127.0.0.1", port))
+        self.sock.setblocking(0)
+
+    def run(self):
+        while self.runThread:
+            try:
+                messages = self.sock.recv(2048)
+            except socket.error, e:
+                if e.args[0] == errno.EAGAIN or e.args[0] == errno.EWOULDBLOCK:
+                    continue
+                return
+
+    def close(self):
+        self.runThread = False
+        self.sock.close()
+
+
+def measure(listener, duration):
+    listener.start()
+    start, cpu_start = time.time(), cpu_time()
+    time.sleep(duration)
+    cpu = cpu_time() - cpu_start
+    elapsed = time.time() - start
+    listener.close()
+    listener.join()
+    return round(100 * cpu / elapsed, 1)
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+    port = server.getsockname()[1]
+
+    results = {
+        "busy_wait_cpu_percent": measure(BusyWaitListener(port), duration),
+        "select_cpu_percent": measure(ServerConnection("127.0.0.1", port), duration),
+        "seconds": duration,
+    }
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Scaling benchmark for the sharded server (cluster.py).
+
+Starts the gateway with 1 to N zones on a generated wide map, opens active
+connections spread over the whole map that keep moving, then reports the
+delivered messages per second and the CPU of each zone process. The busiest
+zone bounds the capacity: it is the one that saturates its core first, so
+the estimated capacity is the move rate scaled to 100% of that zone.
+
+On a machine with fewer cores than zones, the zones share the cores and the
+capacity estimate is the only meaningful figure.
+
+Usage : python benchmarks/bench_cluster.py [max zones] [active] [seconds] [rate]
+"""
+
+import json
+import os
+import random
+import resource
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from bench_connections import ROOT, DIRECTIONS, proc_stats, connect, drain
+from bench_move_validation import generate_map
+import bench_connections
+
+MAP_WIDTH  = 400
+MAP_HEIGHT = 40
+OFFSETS    = {"up": (0, -1), "down": (0, 1), "left": (-1, 0), "right": (1, 0)}
+
+
+def children(pid):
+    """Returns the pids of the direct children of a Linux process."""
+    pids = []
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except IOError:
+                continue
+            if int(fields[1]) == pid:
+                pids.append(int(entry))
+    return sorted(pids)
+
+
+def zone_cpu(pids):
+    return [proc_stats(pid)[0] for pid in pids]
+
+
+def run(zones, active, duration, rate, map_file):
+    port = bench_connections.PORT
+    gateway = subprocess.Popen([sys.executable, os.path.join(ROOT, 'cluster.py'), str(port), str(zones), '10', map_file],
+                               stdout=open(os.devnull, 'w'))
+    time.sleep(1.5)
+    try:
+        socks = connect(active)
+        poller = select.epoll()
+        fds = {}
+        for sock in socks:
+            poller.register(sock.fileno(), select.EPOLLIN)
+            fds[sock.fileno()] = sock
+
+        # first move of each player: anywhere on the map, spread evenly between the zones
+        positions = []
+        for sock in socks:
+            position = [random.randrange(MAP_WIDTH), random.randrange(MAP_HEIGHT), "down"]
+            sock.send(json.dumps(position) + "|")
+            positions.append(position)
+        settle = time.time()
+        while drain(socks, poller, fds, 0.5) and time.time() - settle < 10:
+            pass
+
+        workers = children(gateway.pid)
+        cpu_start = zone_cpu(workers)
+        gateway_start = proc_stats(gateway.pid)[0]
+        sent = received = 0
+        interval = 1.0 / (rate * active)
+        start = next_move = time.time()
+        while time.time() - start < duration:
+            now = time.time()
+            while next_move <= now:
+                index = random.randrange(active)
+                position = positions[index]
+                # mostly along the x axis, so that players cross the zone borders
+                direction = random.choice(DIRECTIONS + ["left", "right"])
+                dx, dy = OFFSETS[direction]
+                position[0] = min(MAP_WIDTH - 1, max(0, position[0] + dx))
+                position[1] = min(MAP_HEIGHT - 1, max(0, position[1] + dy))
+                position[2] = direction
+                socks[index].send(json.dumps(position) + "|")
+                sent += 1
+                next_move += interval
+            received += drain(socks, poller, fds, max(0, next_move - time.time()))
+        elapsed = time.time() - start
+        cpu = [(end - begin) / elapsed for begin, end in zip(cpu_start, zone_cpu(workers))]
+        gateway_cpu = (proc_stats(gateway.pid)[0] - gateway_start) / elapsed
+        for sock in socks:
+            sock.close()
+    finally:
+        gateway.terminate()
+        gateway.wait()
+
+    busiest = max(cpu) if cpu else 0
+    return {
+        "zones": zones,
+        "moves_sent_per_s": round(sent / elapsed, 1),
+        "messages_delivered_per_s": round(received / elapsed, 1),
+        "zone_cpu_percent": [round(100 * value, 1) for value in cpu],
+        "gateway_cpu_percent": round(100 * gateway_cpu, 1),
+        "estimated_capacity_moves_per_s": int(sent / elapsed / busiest) if busiest else None,
+    }
+
+
+def main():
+    max_zones = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    active    = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    duration  = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    rate      = float(sys.argv[4]) if len(sys.argv) > 4 else 5 # moves per second per active client
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    random.seed(0)
+
+    directory = tempfile.mkdtemp()
+    try:
+        # no collision, so that every move of the random walk is accepted
+        map_file = generate_map(directory, MAP_WIDTH, MAP_HEIGHT, 0)
+        results = []
+        for zones in xrange(1, max_zones + 1):
+            results.append(run(zones, active, duration, rate, map_file))
+    finally:
+        shutil.rmtree(directory)
+
+    print(json.dumps({
+        "map": "generated {}x{}".format(MAP_WIDTH, MAP_HEIGHT),
+        "active_connections": active,
+        "cpu_count": os.sysconf('SC_NPROCESSORS_ONLN'),
+        "runs": results,
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Load benchmark for the event-driven server.
+
+Starts server.py in a subprocess, opens a large number of idle connections
+plus a set of active ones that keep moving, then reports connection time,
+delivered messages per second and the server's CPU, memory and thread count.
+
+Every connection first places its player at random on a generated map much
+larger than an area of interest, and the measure only starts once the
+resulting joins have all been delivered: it is the steady state of the
+server that is measured, not the join of all the players.
+
+Usage : python benchmarks/bench_connections.py [idle] [active] [seconds] [rate]
+"""
+
+import json
+import os
+import random
+import resource
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from bench_move_validation import generate_map
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+PORT = 8123
+DIRECTIONS = ["up", "down", "left", "right"]
+MAP_SIZE   = 512  #Side of the generated map, in tiles: about 500 areas of interest
+QUIET_TIME = 1.0  #The joins are delivered once the connections have received nothing for that long
+
+
+def proc_stats(pid):
+    """Returns (cpu seconds, rss in kB, thread count) of a Linux process."""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+    cpu = (int(fields[11]) + int(fields[12])) / float(ticks)
+    threads = int(fields[17])
+    rss = int(fields[21]) * resource.getpagesize() / 1024
+    return cpu, rss, threads
+
+
+def connect(count):
+    socks = []
+    for i in xrange(count):
+        sock = socket.create_connection(("127.0.0.1", PORT))
+        sock.setblocking(0)
+        socks.append(sock)
+    return socks
+
+
+def drain(socks, poller, fds, timeout):
+    """Reads everything available, returns the number of messages received."""
+    received = 0
+    for fd, event in poller.poll(timeout):
+        try:
+            data = fds[fd].recv(65536)
+        except socket.error:
+            continue
+        received += data.count("|")
+    return received
+
+
+def main():
+    idle     = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    active   = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    rate     = float(sys.argv[4]) if len(sys.argv) > 4 else 5 # moves per second per active client
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    random.seed(0)
+
+    directory = tempfile.mkdtemp()
+    # no collision, so that every move of the random walk is accepted
+    map_file = generate_map(directory, MAP_SIZE, MAP_SIZE, 0)
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), str(PORT), '20',
+                               map_file, '0', 'none'],
+                              stdout=open(os.devnull, 'w'))
+    time.sleep(1.0)
+    try:
+        start = time.time()
+        idle_socks = connect(idle)
+        active_socks = connect(active)
+        connect_time = time.time() - start
+
+        poller = select.epoll()
+        fds = {}
+        for sock in idle_socks + active_socks:
+            poller.register(sock.fileno(), select.EPOLLIN)
+            fds[sock.fileno()] = sock
+
+        # first move of each player, anywhere on the map: the server knows the protocol at once,
+        # instead of waiting for the handshake timeout, and the players don't all see each other
+        positions = []
+        for sock in idle_socks + active_socks:
+            position = [random.randrange(MAP_SIZE), random.randrange(MAP_SIZE)]
+            sock.send(json.dumps(position + ["down"]) + "|")
+            positions.append(position)
+        positions = positions[idle:]
+
+        # Let the join broadcasts settle before measuring
+        settle = time.time()
+        joins = 0
+        while True:
+            received = drain(idle_socks, poller, fds, QUIET_TIME)
+            if not received:
+                break
+            joins += received
+        settle_time = time.time() - settle - QUIET_TIME
+
+        cpu_start, _, _ = proc_stats(server.pid)
+        sent = received = 0
+        interval = 1.0 / (rate * active) if active else duration
+        start = next_move = time.time()
+        while time.time() - start < duration:
+            now = time.time()
+            while active and next_move <= now:
+                index = random.randrange(active)
+                position = positions[index]
+                # one tile per move, inside the map, so that the server accepts it
+                axis = random.randrange(2)
+                position[axis] = min(MAP_SIZE - 1, max(0, position[axis] + random.choice((-1, 1))))
+                active_socks[index].send(json.dumps(position + [random.choice(DIRECTIONS)]) + "|")
+                sent += 1
+                next_move += interval
+            received += drain(idle_socks, poller, fds, max(0, next_move - time.time()))
+        elapsed = time.time() - start
+        cpu_end, rss, threads = proc_stats(server.pid)
+
+        print(json.dumps({
+            "idle_connections": idle,
+            "active_connections": active,
+            "connect_seconds": round(connect_time, 3),
+            "join_settle_seconds": round(settle_time, 3),
+            "join_messages": joins,
+            "map": "generated {0}x{0}".format(MAP_SIZE),
+            "moves_sent_per_s": round(sent / elapsed, 1),
+            "messages_delivered_per_s": round(received / elapsed, 1),
+            "server_cpu_percent": round(100 * (cpu_end - cpu_start) / elapsed, 1),
+            "server_rss_kb": rss,
+            "server_threads": threads,
+        }, indent=2, sort_keys=True))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
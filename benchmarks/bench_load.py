@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Load benchmark with headless bots, against the player count.
+
+For each player count, starts server.py in a subprocess, connects that many
+bots (bots.py) that random-walk over the map, then reports what they
+received (messages/s, bytes per player per second, fan-out latency and input
+round trip percentiles) along with the server's CPU, memory and threads.
+
+Without a map file, a 256x256 map whose tiles collide one time out of ten is
+generated, so that the players spread over several interest cells.
+
+The JSON result carries the git revision. Two results are compared with
+`compare`, which prints the relative change of each figure per player count.
+
+Usage : python benchmarks/bench_load.py [counts] [seconds] [rate] [binary|json] [map file]
+        python benchmarks/bench_load.py compare old.json new.json
+"""
+
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from bench_connections import ROOT, PORT, proc_stats
+from bench_move_validation import generate_map
+
+sys.path.insert(0, ROOT)
+
+import bots
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(count, duration, rate, binary, map_file):
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), str(PORT), '10', map_file, '0', 'none'],
+                              stdout=open(os.devnull, 'w'))
+    time.sleep(1)
+    try:
+        swarm = bots.Swarm("127.0.0.1", PORT, map_file, binary)
+        start = time.time()
+        swarm.connect(count)
+        connect_time = time.time() - start
+        # first move of every bot, then the join broadcasts
+        swarm.place()
+        swarm.settle()
+        swarm.reset()
+
+        cpu_start, _, _ = proc_stats(server.pid)
+        elapsed = swarm.run(duration, rate)
+        cpu_end, rss, threads = proc_stats(server.pid)
+        results = swarm.results(elapsed)
+        swarm.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    results.update({
+        "bots": count,
+        "connect_seconds": round(connect_time, 3),
+        "server_cpu_percent": round(100 * (cpu_end - cpu_start) / elapsed, 1),
+        "server_rss_kb": rss,
+        "server_threads": threads,
+    })
+    return results
+
+
+def figures(results, prefix=""):
+    """Flattens the numbers of a run, as {"fanout_latency_ms.p99": value}."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(figures(value, prefix + key + "."))
+        elif isinstance(value, (int, long, float)) and key != "samples":
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    old_runs = dict((run["bots"], figures(run)) for run in old["runs"])
+    changes = {}
+    for run in new["runs"]:
+        before = old_runs.get(run["bots"])
+        if before is None:
+            continue
+        changes[run["bots"]] = dict(
+            (key, "{:+.1f}%".format(100.0 * (value - before[key]) / before[key]) if before[key] else None)
+            for key, value in figures(run).items() if key in before)
+    print(json.dumps({"old": old.get("revision"), "new": new.get("revision"), "changes": changes},
+                     indent=2, sort_keys=True))
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        return compare(sys.argv[2], sys.argv[3])
+
+    counts   = [int(count) for count in (sys.argv[1] if len(sys.argv) > 1 else "100,500,1000").split(",")]
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rate     = float(sys.argv[3]) if len(sys.argv) > 3 else 5 # moves per second per bot
+    binary   = (sys.argv[4] if len(sys.argv) > 4 else "binary") != "json"
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    random.seed(0)
+
+    directory = None
+    if len(sys.argv) > 5:
+        map_file = sys.argv[5]
+    else:
+        directory = tempfile.mkdtemp()
+        map_file  = generate_map(directory, 256, 256, 0.1)
+    try:
+        runs = [run(count, duration, rate, binary, map_file) for count in counts]
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    print(json.dumps({
+        "revision": revision(),
+        "map": "generated 256x256" if directory is not None else map_file,
+        "protocol": "binary" if binary else "json",
+        "moves_per_bot_per_s": rate,
+        "seconds": duration,
+        "runs": runs,
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
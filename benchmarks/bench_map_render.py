@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Compares the former GridLayout map (one Image widget per tile) with the
+batched TileGrid renderer: load time, widget count and frame time while the
+camera scrolls. Needs Kivy, pytmx and a display.
+
+Usage : python benchmarks/bench_map_render.py [map file] [frames]
+"""
+
+import itertools
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from kivy.base import EventLoop
+EventLoop.ensure_window()
+
+from kivy.uix.gridlayout import GridLayout
+from kivy.uix.image import Image
+from pytmx import TiledMap
+
+import client
+from tilemap import PropertyIndex
+
+
+class KivyTiledMap(TiledMap):
+    """The map as the client loaded it before StreamedTiledMap: fully parsed
+    by pytmx, with Kivy images for every tileset. Make sure that there is an
+    active OpenGL context (Kivy Window) before trying to load a map.
+    Source : kivy wiki
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(KivyTiledMap, self).__init__(*args, **kwargs)
+
+        # initialize the image array, shared by every tileset
+        self.images = [0] * self.maxgid
+        self.property_indexes = {}        #layer name -> PropertyIndex
+
+        # call load tile images for each tileset
+        for tileset in self.tilesets:
+            self.loadTileImages(tileset)
+
+    def loadTileImages(self, ts):
+        """Loads the images in filename into Kivy Images.
+        :type ts: TiledTileset
+        """
+        # print ts.source
+        image   = Image(source="map/" + ts.source)
+        texture = image.texture
+        ts.width, ts.height = texture.size
+
+        p = itertools.product(
+            xrange(ts.margin, ts.height, ts.tileheight + ts.margin),
+            xrange(ts.margin, ts.width, ts.tilewidth + ts.margin)
+        )
+
+        for real_gid, (y, x) in enumerate(p, ts.firstgid):
+            if x + ts.tilewidth - ts.spacing > ts.width:
+                continue
+
+            gids = self.map_gid(real_gid)
+
+            if gids:
+                x = x - ts.spacing
+                # convert the y coordinate to opengl (0 at bottom of texture)
+                y = ts.height - y - ts.tileheight + ts.spacing
+
+                tile = texture.get_region(x, y, ts.tilewidth, ts.tileheight)
+
+                for gid, flags in gids:
+                    self.images[gid] = tile
+
+
+    def layer_properties(self, layer_name):
+        """Returns the PropertyIndex of a layer, built the first time it is asked for."""
+        if layer_name not in self.property_indexes:
+            self.property_indexes[layer_name] = PropertyIndex(
+                self.width, self.height, self.get_layer_by_name(layer_name), self.tile_properties)
+        return self.property_indexes[layer_name]
+
+    def find_tile_with_property(self, property_name, layer_name='Ground'):
+        return self.layer_properties(layer_name).find(property_name)
+
+    def tile_has_property(self, x, y, property_name, layer_name='Ground'):
+        """Check if the tile coordinates passed in represent a collision.
+        :return: Boolean representing whether or not there was a collision.
+        """
+        return self.layer_properties(layer_name).has(property_name, x, y)
+
+
+class LegacyTileGrid(GridLayout):
+    """The map as it was built before: one Image widget per tile of the 'Ground' layer."""
+
+    def __init__(self, map_file, **kwargs):
+        self.map = KivyTiledMap(map_file)
+        super(LegacyTileGrid, self).__init__(
+            rows=self.map.height, cols=self.map.width,
+            row_force_default=True,
+            row_default_height=self.map.tileheight,
+            col_force_default=True,
+            col_default_width=self.map.tilewidth,
+            **kwargs
+        )
+        for tile in self.map.get_layer_by_name('Ground').tiles():
+            self.add_widget(Image(texture=self.map.get_tile_image(tile[0], tile[1], 0), size=(32, 32)))
+
+
+def count_widgets(widget):
+    return 1 + sum(count_widgets(child) for child in widget.children)
+
+
+def measure(factory, frames):
+    window = EventLoop.window
+    start  = time.time()
+    grid   = factory()
+    window.add_widget(grid)
+    EventLoop.idle()
+    load = time.time() - start
+
+    start = time.time()
+    for frame in xrange(frames):
+        grid.x = -(frame % 64) * 4
+        EventLoop.idle()
+    frame_time = (time.time() - start) / frames
+
+    widgets = count_widgets(grid)
+    window.remove_widget(grid)
+    return {
+        "load_seconds": round(load, 3),
+        "widgets": widgets,
+        "frame_ms": round(frame_time * 1000, 2),
+    }
+
+
+def main():
+    map_file = sys.argv[1] if len(sys.argv) > 1 else './map/desert.tmx'
+    frames   = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    client.TileGrid.map_file = map_file
+    results = {
+        "map": map_file,
+        "gridlayout": measure(lambda: LegacyTileGrid(map_file), frames),
+        "batched": measure(lambda: client.TileGrid(background=False, bake_budget=0), frames),
+    }
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
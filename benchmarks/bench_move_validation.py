@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Cost of the server-side move validation (bounds, collision bitmap, one tile
+per step), alone and through GameServer.on_message.
+
+Without a map file, a 512x512 map whose tiles collide one time out of five is
+generated, since the maps of the game have no collision tiles yet.
+
+Usage : python benchmarks/bench_move_validation.py [moves] [map file]
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import server
+
+
+class FakeClient(object):
+    """Just what on_message needs from a connection."""
+    resuming = False  #The session is already resumed, the moves are not held
+
+    def __init__(self, fd, player):
+        self.fd     = fd
+        self.player = player
+        self.held   = []
+        self.move_credit = server.MOVE_BURST
+        self.credit_tick = 0
+
+
+def generate_map(directory, width=512, height=512, density=0.2):
+    filename = os.path.join(directory, 'generated.tmx')
+    gids = [2 if random.random() < density else 1 for i in xrange(width * height)]
+    with open(filename, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<map version="1.0" orientation="orthogonal" width="{0}" height="{1}" tilewidth="32" tileheight="32">\n'
+                ' <tileset firstgid="1" name="Generated" tilewidth="32" tileheight="32">\n'
+                '  <image source="generated.png" width="64" height="32"/>\n'
+                '  <tile id="1"><properties><property name="collision" value="1"/></properties></tile>\n'
+                ' </tileset>\n'
+                ' <layer name="Ground" width="{0}" height="{1}">\n'
+                '  <data encoding="csv">{2}</data>\n'
+                ' </layer>\n'
+                '</map>\n'.format(width, height, ','.join(str(gid) for gid in gids)))
+    return filename
+
+
+def bench(function, number):
+    """Returns the best time per call in microseconds."""
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    count     = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    directory = None
+    random.seed(0)
+    if len(sys.argv) > 2:
+        map_file = sys.argv[2]
+    else:
+        directory = tempfile.mkdtemp()
+        map_file  = generate_map(directory)
+
+    try:
+        game = server.GameServer(0, map_file=map_file)
+        width, height = game.map.width, game.map.height
+
+        # one tile moves from random positions, some of them out of the map or into walls
+        moves = []
+        for i in xrange(count):
+            player = server.Player(i)
+            player.x, player.y, player.placed = random.randrange(width), random.randrange(height), True
+            dx, dy = random.choice(((0, 1), (0, -1), (1, 0), (-1, 0), (0, 0), (2, 0)))
+            moves.append((FakeClient(i, player), ("move", player.x + dx, player.y + dy, random.choice(server.DIRECTION_CODES.keys()))))
+
+        state = {'index': 0}
+
+        def validate():
+            client, message = moves[state['index'] % count]
+            state['index'] += 1
+            game.valid_move(client.player, message[1], message[2], message[3])
+
+        def on_message():
+            client, message = moves[state['index'] % count]
+            state['index'] += 1
+            # one tick between two moves of a client, so that the speed limit does not drop them
+            game.tick_count += 1
+            game.on_message(client, message)
+
+        accepted = sum(game.valid_move(client.player, *message[1:]) for client, message in moves)
+        validate_us = bench(validate, count)
+        message_us  = bench(on_message, count)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    print(json.dumps({
+        "map": "generated 512x512" if directory is not None else map_file,
+        "moves": count,
+        "accepted_percent": round(100.0 * accepted / count, 1),
+        "valid_move_us": round(validate_us, 3),
+        "on_message_us": round(message_us, 3),
+        "moves_per_tick_at_{}hz".format(server.TICK_RATE): int(1e6 / server.TICK_RATE / message_us),
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
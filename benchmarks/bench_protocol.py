@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Encode/decode microbenchmarks of the legacy JSON protocol against the binary one.
+
+Usage : python benchmarks/bench_protocol.py [players per snapshot]
+"""
+
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import protocol
+
+
+def bench(function, number):
+    """Returns the best time per call in microseconds."""
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    random.seed(0)
+    players = [(i, random.randrange(200), random.randrange(200), random.choice(protocol.DIRECTIONS))
+               for i in xrange(count)]
+    number = max(10, 100000 // count)
+    results = {}
+
+    for codec in (protocol.JSON_CODEC, protocol.BINARY_CODEC):
+        def encode():
+            return codec.snapshot([codec.record(*player) for player in players], [])
+        data = encode()
+
+        if codec is protocol.BINARY_CODEC:
+            def decode():
+                for msg_type, payload in protocol.FrameDecoder().feed(data):
+                    protocol.decode_snapshot(payload)
+        else:
+            def decode():
+                for message in protocol.JsonDecoder().feed(data):
+                    json.loads(message)
+
+        binary = codec is protocol.BINARY_CODEC
+        moves  = "".join(protocol.encode_move(binary, x, y, direction) for i, x, y, direction in players)
+
+        def decode_moves():
+            codec.messages(codec.decoder().feed(moves))
+
+        results[codec.name] = {
+            "snapshot_bytes": len(data),
+            "bytes_per_player": round(len(data) / float(count), 2),
+            "encode_snapshot_us": round(bench(encode, number), 2),
+            "decode_snapshot_us": round(bench(decode, number), 2),
+            "decode_moves_us": round(bench(decode_moves, number), 2),
+        }
+
+    print(json.dumps({"players": count, "results": results}, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
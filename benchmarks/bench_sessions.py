@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Cost of the session persistence for the game loop, and of its writer thread.
+
+Every tick, each of the players moves and its session is saved, then the
+tick's batch is handed to the writer thread. The game loop only pays for the
+dict updates and a queue put; the time the writer needs to commit the batches
+to SQLite is reported apart, with the number of batches it had to merge
+because the disk was slower than the ticks.
+
+Usage : python benchmarks/bench_sessions.py [players] [ticks] [tick rate]
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sessions import SessionStore
+
+
+def main():
+    players   = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    ticks     = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    tick_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+    random.seed(0)
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'sessions.db')
+        store  = SessionStore(filename)
+        tokens = [store.create(id_client) for id_client in xrange(players)]
+        store.flush()
+
+        loop_time = 0
+        worst     = 0
+        start = time.time()
+        for tick in xrange(ticks):
+            tick_start = time.time()
+            for id_client, token in enumerate(tokens):
+                store.save(token, id_client, random.randrange(512), random.randrange(512), "down")
+            store.flush()
+            elapsed = time.time() - tick_start
+            loop_time += elapsed
+            worst = max(worst, elapsed)
+            time.sleep(max(0, tick_start + 1 / tick_rate - time.time()))
+        pending = store.batches.qsize()
+        close_start = time.time()
+        store.close()
+        total = time.time() - start
+        drain = time.time() - close_start
+        size  = os.path.getsize(filename)
+    finally:
+        shutil.rmtree(directory)
+
+    print(json.dumps({
+        "players": players,
+        "ticks": ticks,
+        "saves_per_tick": players,
+        "loop_ms_per_tick": round(1000 * loop_time / ticks, 3),
+        "loop_worst_tick_ms": round(1000 * worst, 3),
+        "loop_us_per_save": round(1e6 * loop_time / ticks / players, 3),
+        "batches_pending_at_end": pending,
+        "writer_drain_seconds_at_end": round(drain, 3),
+        "rows_written_per_s": int(players * ticks / total),
+        "database_kb": size / 1024,
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
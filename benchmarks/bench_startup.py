@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Client startup time: time to the first frame and until the map around the
+viewport is drawn, with the map loaded in the TileGrid constructor (as it was
+before) and with the staged loader. Each map is measured with a cold cache
+(no .kogmap index nor .atlas, the TMX file is parsed) and a warm one.
+
+The maps are the one given (desert.tmx by default) and a generated large one.
+Needs Kivy and a display.
+
+Usage : python benchmarks/bench_startup.py [map file] [large map size] [runs]
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+os.chdir(ROOT)
+
+from kivy.base import EventLoop
+EventLoop.ensure_window()
+
+import client
+from bench_move_validation import generate_map
+
+TIMEOUT = 60  #Seconds after which a staged load is reported as unfinished
+
+
+def clear_cache(map_file):
+    for extension in ('.kogmap', '.atlas'):
+        path = os.path.splitext(map_file)[0] + extension
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def measure(map_file, staged):
+    """Returns the time to the first frame, to the map being drawn, and the longest frame in between."""
+    window = EventLoop.window
+    start  = time.time()
+    grid   = client.TileGrid(map_file=map_file, background=staged, bake_budget=0.008 if staged else 0)
+    window.add_widget(grid)
+    EventLoop.idle()
+    first_frame = time.time() - start
+
+    longest = first_frame
+    while not grid.ready and time.time() - start < TIMEOUT:
+        frame = time.time()
+        EventLoop.idle()
+        longest = max(longest, time.time() - frame)
+    ready = time.time() - start if grid.ready else None
+
+    window.remove_widget(grid)
+    return first_frame, ready, longest
+
+
+def run(map_file, staged, cold, runs):
+    results = []
+    for i in xrange(runs):
+        if cold:
+            clear_cache(map_file)
+        else:
+            client.TileGrid.load_map(map_file, client.CHUNK_SIZE)
+        results.append(measure(map_file, staged))
+    first_frame, ready, longest = [sorted(values)[len(values) // 2] for values in zip(*results)]
+    return {
+        "first_frame_ms": round(1000 * first_frame, 1),
+        "map_ready_ms": round(1000 * ready, 1) if ready is not None else None,
+        "longest_frame_ms": round(1000 * longest, 1),
+    }
+
+
+def main():
+    map_file = sys.argv[1] if len(sys.argv) > 1 else './map/desert.tmx'
+    size     = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    runs     = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    random.seed(0)
+
+    directory = tempfile.mkdtemp()
+    try:
+        large = generate_map(directory, size, size)
+        shutil.copy(os.path.join(ROOT, 'map', 'ground.png'), os.path.join(directory, 'generated.png'))
+        # the cache of the given map is put back as it was found
+        saved = tempfile.mkdtemp()
+        for extension in ('.kogmap', '.atlas'):
+            path = os.path.splitext(map_file)[0] + extension
+            if os.path.exists(path):
+                shutil.copy(path, saved)
+
+        results = {}
+        for name, path in ((os.path.basename(map_file), map_file), ("generated {0}x{0}".format(size), large)):
+            results[name] = dict(
+                ("{}_{}".format("staged" if staged else "blocking", "cold" if cold else "warm"),
+                 run(path, staged, cold, runs))
+                for staged in (False, True) for cold in (True, False))
+
+        for name in os.listdir(saved):
+            shutil.copy(os.path.join(saved, name), os.path.dirname(map_file))
+        shutil.rmtree(saved)
+    finally:
+        shutil.rmtree(directory)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
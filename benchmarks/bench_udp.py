@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Fan-out latency under packet loss, deltas over TCP against datagrams.
+
+Starts server.py and the lossy shim (netshim.py) in subprocesses, then for
+each loss rate connects bots (bots.py) through the shim, once receiving the
+deltas on their TCP connection and once by datagrams. With loss, TCP holds
+the following deltas behind each retransmission, while a lost datagram is
+only replaced by the next tick's delta. The inputs of the bots stay on TCP
+in both cases, so they keep part of the loss penalty.
+
+Usage : python benchmarks/bench_udp.py [bots] [seconds] [latency ms] [losses]
+"""
+
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from bench_connections import ROOT, PORT
+
+sys.path.insert(0, ROOT)
+
+import bots
+
+SHIM_PORT = PORT + 1
+MAP_FILE  = os.path.join(ROOT, 'map', 'desert.tmx')
+
+
+def run(count, duration, latency, loss, udp):
+    shim = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'netshim.py'),
+                             str(SHIM_PORT), str(PORT), str(loss), str(latency), str(latency / 5)],
+                            stdout=open(os.devnull, 'w'))
+    time.sleep(0.5)
+    try:
+        swarm = bots.Swarm("127.0.0.1", SHIM_PORT, MAP_FILE, True, udp)
+        swarm.connect(count)
+        swarm.place()
+        swarm.settle()
+        swarm.reset()
+        results = swarm.results(swarm.run(duration, 5))
+        swarm.close()
+    finally:
+        shim.terminate()
+        shim.wait()
+    latencies = results["fanout_latency_ms"] or {}
+    return dict([("loss_percent", 100 * loss), ("transport", "udp" if udp else "tcp"),
+                 ("datagram_bots", results["datagram_bots"])] +
+                [("fanout_" + key + "_ms", value) for key, value in latencies.items() if key != "samples"])
+
+
+def main():
+    count    = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    latency  = float(sys.argv[3]) if len(sys.argv) > 3 else 30 # one way, in ms
+    losses   = [float(loss) for loss in (sys.argv[4] if len(sys.argv) > 4 else "0,0.02,0.05,0.1").split(",")]
+    random.seed(0)
+
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py'), str(PORT), '20', MAP_FILE, '0', 'none'],
+                              stdout=open(os.devnull, 'w'))
+    time.sleep(1)
+    try:
+        runs = []
+        for loss in losses:
+            for udp in (False, True):
+                runs.append(run(count, duration, latency, loss, udp))
+    finally:
+        server.terminate()
+        server.wait()
+
+    print(json.dumps({
+        "bots": count,
+        "one_way_latency_ms": latency,
+        "runs": runs,
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Lossy network shim, to test the transports locally.
+
+Relays the TCP connections and the UDP datagrams received on a port to the
+server's port, adding a one-way latency (with jitter) and packet loss:
+- a lost datagram is dropped, the others may arrive out of order;
+- a lost TCP chunk is delivered after a retransmission timeout, and holds up
+  everything sent after it on that connection, as the kernel would.
+
+Usage : python benchmarks/netshim.py [port] [server port] [loss] [latency ms] [jitter ms]
+"""
+
+import heapq
+import itertools
+import random
+import select
+import socket
+import sys
+import threading
+import time
+
+RECV_SIZE = 65536
+
+# Retransmission timeout of a lost TCP segment (the Linux minimum)
+TCP_RTO = 0.2
+
+
+class Shim(object):
+
+    def __init__(self, port, target_port, loss=0.0, latency=0.0, jitter=0.0, host="127.0.0.1"):
+        self.target  = (host, target_port)
+        self.loss    = loss
+        self.latency = latency
+        self.jitter  = jitter
+        self.running = False
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1024)
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((host, port))
+
+        self.peers     = {}  #TCP socket -> socket at the other end of the relay
+        self.release   = {}  #TCP socket -> time of the last scheduled delivery on it, to keep the stream in order
+        self.upstreams = {}  #client UDP address -> socket connected to the server
+        self.clients   = {}  #upstream UDP socket -> client address
+        self.queue     = []  #(delivery time, order, function, arguments)
+        self.order     = itertools.count()
+
+    def delay(self):
+        return self.latency + random.random() * self.jitter
+
+    def schedule(self, when, function, *args):
+        heapq.heappush(self.queue, (when, next(self.order), function, args))
+
+    def relay_stream(self, sock, data):
+        target = self.peers[sock]
+        now = time.time()
+        when = now + self.delay()
+        if random.random() < self.loss:
+            when += TCP_RTO
+        when = max(when, self.release.get(target, now))
+        self.release[target] = when
+        self.schedule(when, self.deliver_stream, target, data)
+
+    def deliver_stream(self, target, data):
+        if target in self.peers:
+            try:
+                target.sendall(data)
+            except socket.error:
+                self.close(target)
+
+    def relay_datagram(self, send, data, *address):
+        if random.random() >= self.loss:
+            self.schedule(time.time() + self.delay(), self.deliver_datagram, send, data, address)
+
+    def deliver_datagram(self, send, data, address):
+        try:
+            send(data, *address)
+        except socket.error:
+            pass
+
+    def close(self, sock):
+        peer = self.peers.pop(sock, None)
+        if peer is not None:
+            self.peers.pop(peer, None)
+            peer.close()
+        sock.close()
+
+    def accept(self):
+        sock, address = self.listener.accept()
+        upstream = socket.create_connection(self.target)
+        for end in (sock, upstream):
+            end.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.peers[sock] = upstream
+        self.peers[upstream] = sock
+
+    def run(self):
+        self.running = True
+        while self.running:
+            now = time.time()
+            while self.queue and self.queue[0][0] <= now:
+                when, order, function, args = heapq.heappop(self.queue)
+                function(*args)
+            timeout = min(0.05, max(0, self.queue[0][0] - now)) if self.queue else 0.05
+            sockets = [self.listener, self.udp] + self.peers.keys() + self.clients.keys()
+            readable, _, _ = select.select(sockets, [], [], timeout)
+            for sock in readable:
+                if sock is self.listener:
+                    self.accept()
+                elif sock is self.udp:
+                    data, address = self.udp.recvfrom(RECV_SIZE)
+                    upstream = self.upstreams.get(address)
+                    if upstream is None:
+                        upstream = self.upstreams[address] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        upstream.connect(self.target)
+                        self.clients[upstream] = address
+                    self.relay_datagram(upstream.send, data)
+                elif sock in self.clients:
+                    try:
+                        data = sock.recv(RECV_SIZE)
+                    except socket.error:
+                        continue
+                    self.relay_datagram(self.udp.sendto, data, self.clients[sock])
+                elif sock in self.peers:
+                    try:
+                        data = sock.recv(RECV_SIZE)
+                    except socket.error:
+                        data = ""
+                    if data:
+                        self.relay_stream(sock, data)
+                    else:
+                        self.close(sock)
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.running = False
+
+
+def main():
+    port        = int(sys.argv[1]) if len(sys.argv) > 1 else 8005
+    target_port = int(sys.argv[2]) if len(sys.argv) > 2 else 8004
+    loss        = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    latency     = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.05
+    jitter      = float(sys.argv[5]) / 1000 if len(sys.argv) > 5 else 0.01
+    print("--Relaying port {} to {}, {:.0%} loss, {:.0f}+{:.0f} ms--".format(
+        port, target_port, loss, latency * 1000, jitter * 1000))
+    Shim(port, target_port, loss, latency, jitter).run()
+
+
+if __name__ == '__main__':
+    main()
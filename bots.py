@@ -0,0 +1,378 @@
+"""Headless simulated clients, to load a server without Kivy.
+
+Each bot speaks the same protocol as ServerConnection (binary with inputs and
+deltas, optionally received by datagrams, or legacy JSON) and random-walks over the map, predicting its moves
+with the same rules and collision bitmap as the server. All the bots of a
+Swarm share one thread and one epoll loop, so thousands of them fit in one
+process.
+
+The swarm measures what the players would see:
+- the fan-out latency, from the input of a bot to the reception of the
+  resulting position by each bot that sees it (binary protocol only, the
+  JSON bots don't know their own id);
+- the input round trip, from an input to its STATE ack (protocol v3);
+- the messages and bytes received.
+
+Usage : python bots.py [bots] [seconds] [moves per second per bot] [binary|udp|json] [host:port] [map file]
+"""
+import errno
+import json
+import os
+import random
+import select
+import socket
+import sys
+import time
+
+import protocol
+from delta import DeltaDecoder
+from movement import PREDICTED_BURST, spend, step
+from network import RECV_SIZE
+from tilemap import load_map
+
+ROOT     = os.path.abspath(os.path.dirname(__file__))
+MAP_FILE = os.path.join(ROOT, 'map', 'desert.tmx')
+COLLISION_LAYER    = "Ground"
+COLLISION_PROPERTY = "collision"
+
+
+class Walkable(object):
+    """Bounds and collision check of the server, for the bots' predictions."""
+
+    def __init__(self, map_file):
+        self.map        = load_map(map_file)
+        self.collisions = None
+        layer = self.map.layer_index.get(COLLISION_LAYER)
+        if layer is not None:
+            self.collisions = self.map.layer_properties(layer)
+
+    def __call__(self, x, y):
+        if x < 0 or y < 0 or x >= self.map.width or y >= self.map.height:
+            return False
+        return self.collisions is None or not self.collisions.has(COLLISION_PROPERTY, x, y)
+
+    def random_position(self):
+        while True:
+            x, y = random.randrange(self.map.width), random.randrange(self.map.height)
+            if self(x, y):
+                return x, y
+
+
+class Bot(object):
+    """One connection, its predicted state and its decoders."""
+    id_client = None   #Sent by the server in WELCOME, binary protocol only
+    inputs    = False  #Does the server apply our inputs (protocol v3) ?
+    placed    = False  #Has our first absolute move been sent ?
+    token     = None   #Token of the datagram channel, sent by the server
+    channel   = False  #Do the deltas come by datagrams ?
+
+    def __init__(self, swarm, sock, binary, x, y, udp=None):
+        self.swarm     = swarm
+        self.sock      = sock
+        self.udp       = udp
+        self.binary    = binary
+        self.decoder   = protocol.FrameDecoder() if binary else protocol.JsonDecoder()
+        self.deltas    = DeltaDecoder()
+        self.x, self.y = x, y
+        self.direction = random.choice(protocol.DIRECTIONS)
+        self.seq       = 0
+        self.sent      = {}  #input seq -> send time, until its STATE ack
+        self.move_credit = PREDICTED_BURST  #Steps left under the server's speed limit, as the client
+        self.credit_time = time.time()
+        self.states    = {}  #id -> last state received for each player we see
+
+    def send(self, data):
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self.swarm.close(self)
+
+    def bind(self):
+        try:
+            self.udp.send(protocol.encode_bind(self.id_client, self.token))
+        except socket.error:
+            pass
+
+    def move(self, now):
+        """Sends a random key, as a player walking mostly straight ahead.
+        :return: False if the step was skipped, as too close to the previous ones."""
+        if not self.placed:
+            # the server accepts any walkable position as the first move
+            self.placed = True
+            self.send(protocol.encode_move(self.binary, self.x, self.y, self.direction))
+            return True
+        key = self.direction if random.random() < 0.7 else random.choice(protocol.DIRECTIONS)
+        state = step(self.x, self.y, self.direction, key, self.swarm.walkable)
+        if state[:2] != (self.x, self.y):
+            self.move_credit, allowed = spend(self.move_credit, now - self.credit_time, PREDICTED_BURST)
+            self.credit_time = now
+            if not allowed:
+                return False
+        if self.inputs:
+            self.seq += 1
+            self.sent[self.seq] = now
+            self.send(protocol.encode_input(self.seq, key))
+        else:
+            self.send(protocol.encode_move(self.binary, state[0], state[1], state[2]))
+        if self.id_client is not None and state != (self.x, self.y, self.direction):
+            self.swarm.moved[(self.id_client,) + state] = now
+        self.x, self.y, self.direction = state
+        return True
+
+    def receive(self, data, now):
+        swarm = self.swarm
+        swarm.bytes_received += len(data)
+        if not self.binary:
+            for message in self.decoder.feed(data):
+                if len(json.loads(message)) > 0:
+                    swarm.messages += 1
+            return
+
+        for msg_type, payload in self.decoder.feed(data):
+            self.receive_frame(msg_type, payload, now)
+
+    def receive_datagram(self, data, now):
+        self.swarm.bytes_received += len(data)
+        try:
+            msg_type, payload = protocol.decode_datagram(data)
+        except protocol.ProtocolError:
+            return
+        if msg_type == protocol.MSG_BIND:
+            if not self.channel:
+                self.channel = True
+                self.send(protocol.encode_bind(self.id_client, self.token))
+        elif msg_type == protocol.MSG_DELTA:
+            self.receive_frame(msg_type, payload, now)
+
+    def receive_frame(self, msg_type, payload, now):
+        swarm = self.swarm
+        swarm.frames += 1
+        if msg_type == protocol.MSG_WELCOME:
+            version, self.id_client = protocol.WELCOME.unpack(payload)
+            self.inputs = version >= 3
+            if version >= 5:
+                self.send(protocol.encode_resume(None))  #a new player every time
+        elif msg_type == protocol.MSG_SESSION:
+            self.id_client, token = protocol.SESSION.unpack(payload)
+        elif msg_type == protocol.MSG_SNAPSHOT:
+            records, leaves = protocol.decode_snapshot(payload)
+            swarm.messages += len(records) + len(leaves)
+            for id_client in leaves:
+                self.states.pop(id_client, None)
+            for record in records:
+                self.seen(record, now)
+        elif msg_type == protocol.MSG_DELTA:
+            delta = self.deltas.feed(payload)
+            if delta is None:
+                return
+            seq, records, leaves = delta
+            self.send(protocol.encode_ack(seq))
+            swarm.messages += len(records) + len(leaves)
+            for id_client in leaves:
+                self.states.pop(id_client, None)
+            for id_client, x, y, code in records:
+                self.seen((id_client, x, y, protocol.DIRECTIONS[code]), now)
+        elif msg_type == protocol.MSG_CORRECTION:
+            self.x, self.y, code = protocol.MOVE.unpack(payload)
+            self.direction = protocol.DIRECTIONS[code]
+            swarm.corrections += 1
+        elif msg_type == protocol.MSG_STATE:
+            seq, x, y, code = protocol.STATE.unpack(payload)
+            sent = self.sent.pop(seq, None)
+            if sent is not None:
+                swarm.round_trips.append(now - sent)
+            if seq == self.seq and (x, y, protocol.DIRECTIONS[code]) != (self.x, self.y, self.direction):
+                # our prediction was wrong and no other input is in flight
+                self.x, self.y, self.direction = x, y, protocol.DIRECTIONS[code]
+                swarm.corrections += 1
+        elif msg_type == protocol.MSG_CHANNEL and self.udp is not None:
+            self.token, = protocol.CHANNEL.unpack(payload)
+            self.bind()
+
+    def seen(self, record, now):
+        """Fan-out latency of the input behind a new position of a player we already saw.
+
+        Enters and keyframes repeat positions reached long ago, they are not counted.
+        """
+        id_client, state = record[0], record[1:]
+        previous = self.states.get(id_client)
+        self.states[id_client] = state
+        if id_client != self.id_client and previous is not None and previous != state:
+            sent = self.swarm.moved.get(record)
+            if sent is not None:
+                self.swarm.latencies.append(now - sent)
+
+
+class Swarm(object):
+    """Bots of one process, driven by a single epoll loop."""
+
+    def __init__(self, host, port, map_file=MAP_FILE, binary=True, udp=False):
+        self.host     = host
+        self.port     = port
+        self.binary   = binary
+        self.udp      = binary and udp
+        self.walkable = Walkable(map_file)
+        self.bots     = {}  #fd -> Bot
+        self.datagrams = {} #fd of the datagram socket -> Bot
+        self.poller   = select.epoll()
+        self.moved    = {}  #(id, x, y, direction) -> time of the input that led to this state
+        self.reset()
+
+    def reset(self):
+        """Clears the counters, to measure from now on."""
+        self.messages       = 0
+        self.frames         = 0
+        self.bytes_received = 0
+        self.moves_sent     = 0
+        self.corrections    = 0
+        self.latencies      = []
+        self.round_trips    = []
+
+    def connect(self, count):
+        for i in xrange(count):
+            sock = socket.create_connection((self.host, self.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.binary:
+                sock.sendall(protocol.HELLO)
+            sock.setblocking(0)
+            udp = None
+            if self.udp:
+                udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                udp.connect((self.host, self.port))
+                udp.setblocking(0)
+            x, y = self.walkable.random_position()
+            bot = self.bots[sock.fileno()] = Bot(self, sock, self.binary, x, y, udp)
+            self.poller.register(sock.fileno(), select.EPOLLIN)
+            if udp is not None:
+                self.datagrams[udp.fileno()] = bot
+                self.poller.register(udp.fileno(), select.EPOLLIN)
+
+    def bind(self):
+        """Sends the BIND datagram again for the bots whose channel isn't confirmed, it may have been lost."""
+        for bot in self.bots.values():
+            if bot.token is not None and not bot.channel:
+                bot.bind()
+
+    def place(self):
+        """Sends the first move of the bots that haven't played yet."""
+        now = time.time()
+        for bot in self.bots.values():
+            if not bot.placed:
+                bot.move(now)
+
+    def close(self, bot=None):
+        for bot in [bot] if bot is not None else self.bots.values():
+            fd = bot.sock.fileno()
+            if self.bots.pop(fd, None) is not None:
+                self.poller.unregister(fd)
+                bot.sock.close()
+                if bot.udp is not None:
+                    del self.datagrams[bot.udp.fileno()]
+                    self.poller.unregister(bot.udp.fileno())
+                    bot.udp.close()
+
+    def poll(self, timeout):
+        for fd, event in self.poller.poll(timeout):
+            bot = self.datagrams.get(fd)
+            if bot is not None:
+                self.read_datagrams(bot)
+                continue
+            bot = self.bots.get(fd)
+            if bot is None:
+                continue
+            try:
+                data = bot.sock.recv(RECV_SIZE)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    continue
+                data = ""
+            if not data:
+                self.close(bot)
+                continue
+            bot.receive(data, time.time())
+
+    def read_datagrams(self, bot):
+        while True:
+            try:
+                data = bot.udp.recv(RECV_SIZE)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                continue
+            bot.receive_datagram(data, time.time())
+
+    def run(self, duration, rate):
+        """Random-walks every bot at `rate` moves per second for `duration` seconds."""
+        bots = self.bots.values()
+        interval = 1.0 / (rate * len(bots)) if bots and rate else duration
+        start = next_move = next_bind = time.time()
+        while time.time() - start < duration:
+            now = time.time()
+            if self.udp and now >= next_bind:
+                self.bind()
+                next_bind = now + 1
+            while bots and next_move <= now:
+                bot = random.choice(bots)
+                if bot.sock.fileno() in self.bots and bot.move(now):
+                    self.moves_sent += 1
+                next_move += interval
+            self.poll(max(0, min(next_move, start + duration) - time.time()))
+        return time.time() - start
+
+    def settle(self, timeout=0.5, limit=10):
+        """Reads until the server stays silent for `timeout` seconds."""
+        start = time.time()
+        received = -1
+        while received != self.bytes_received and time.time() - start < limit:
+            received = self.bytes_received
+            if self.udp:
+                self.bind()
+            self.poll(timeout)
+
+    def results(self, elapsed):
+        count = len(self.bots) or 1
+        return {
+            "bots_alive": len(self.bots),
+            "datagram_bots": sum(1 for bot in self.bots.values() if bot.channel),
+            "moves_sent_per_s": round(self.moves_sent / elapsed, 1),
+            "messages_received_per_s": round(self.messages / elapsed, 1),
+            "frames_received_per_s": round(self.frames / elapsed, 1),
+            "bytes_per_player_per_s": round(self.bytes_received / elapsed / count, 1),
+            "corrections": self.corrections,
+            "fanout_latency_ms": percentiles(self.latencies),
+            "input_round_trip_ms": percentiles(self.round_trips),
+        }
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    def at(fraction):
+        return round(1000 * samples[min(len(samples) - 1, int(fraction * len(samples)))], 2)
+    return {"samples": len(samples), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": at(1)}
+
+
+def main():
+    count    = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rate     = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    mode     = sys.argv[4] if len(sys.argv) > 4 else "binary"
+    address  = sys.argv[5] if len(sys.argv) > 5 else "127.0.0.1:8004"
+    map_file = sys.argv[6] if len(sys.argv) > 6 else MAP_FILE
+    host, port = address.rsplit(":", 1)
+
+    swarm = Swarm(host, int(port), map_file, mode != "json", mode == "udp")
+    swarm.connect(count)
+    swarm.place()
+    swarm.settle()
+    swarm.reset()
+    try:
+        results = swarm.results(swarm.run(duration, rate))
+    finally:
+        swarm.close()
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
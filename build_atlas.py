@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Offline build step for the client textures.
+
+- Packs every character animation frame of images/ into the Kivy atlas
+  images/characters.atlas, so the client loads one texture instead of one
+  file per frame. This part needs Kivy and PIL.
+- Writes the index (.kogmap) and the tileset atlas (.atlas, gid -> texture
+  region) of each map, which the client would otherwise build on its first
+  start.
+
+Usage : python build_atlas.py [map files]
+"""
+
+import glob
+import os
+import sys
+
+from tilemap import load_map, load_atlas
+
+ROOT       = os.path.abspath(os.path.dirname(__file__))
+ASSETS_DIR = os.path.join(ROOT, 'images')
+ATLAS_SIZE = 512
+
+
+def build_characters():
+    from kivy.atlas import Atlas
+
+    frames = sorted(glob.glob(os.path.join(ASSETS_DIR, 'red-*-[0-9].png')) +
+                    glob.glob(os.path.join(ASSETS_DIR, 'green-*-[0-9].png')))
+    # ids of the atlas are the file names without extension, as in Character._animation
+    filename, meta = Atlas.create(os.path.join(ASSETS_DIR, 'characters'), frames, ATLAS_SIZE)
+    print('{}: {} frames on {} texture(s)'.format(os.path.relpath(filename, ROOT), len(frames), len(meta)))
+
+
+def build_maps(map_files):
+    for map_file in map_files:
+        index = load_map(map_file)
+        atlas = load_atlas(map_file, index)
+        print('{}: {} tiles in {} tileset(s)'.format(
+            map_file, sum(len(regions) for regions in atlas.values()), len(atlas)))
+        index.close()
+
+
+def main():
+    map_files = sys.argv[1:] or [os.path.join(ROOT, 'map', 'desert.tmx')]
+    build_maps(map_files)
+    build_characters()
+
+
+if __name__ == '__main__':
+    main()
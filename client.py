@@ -1,138 +1,247 @@
 #!/usr/bin/kivy
 from kivy.config import Config
 Config.set('kivy', 'log_level', 'debug')
-Config.write()
 from kivy.app import App
 from kivy.core.window import Window
 from kivy.uix.widget import Widget
-import itertools
 
-from kivy.uix.gridlayout import GridLayout
+from kivy.graphics import (Fbo, Rectangle, ClearColor, ClearBuffers,
+                           PushMatrix, PopMatrix, Translate, InstructionGroup)
+
+from kivy.core.image import Image as CoreImage
+from kivy.atlas import Atlas
 
-from pytmx import TiledMap, TiledTileset
-from kivy.uix.image import Image
 from kivy.properties import StringProperty
 
-from kivy.properties import NumericProperty, ReferenceListProperty, ObjectProperty
+from kivy.properties import NumericProperty, ObjectProperty
 from kivy.vector import Vector
 from kivy.clock import Clock
 
 from kivy.logger import Logger
 from kivy.animation import Animation
 
+import binascii
 import os
+import sys
+import time
+from bisect import bisect_right
+from collections import OrderedDict, deque
 from functools import partial
+from threading import Thread
 from kivy.properties import (NumericProperty,
                              StringProperty,
                              BooleanProperty)
 
-import json
-import socket
-from threading import Thread
-import errno
-import sys
 from kivy.event import EventDispatcher
 
-class KivyTiledMap(TiledMap):
-    """Loads Kivy images. Make sure that there is an active OpenGL context
-    (Kivy Window) before trying to load a map.
-    Source : kivy wiki
-    """
+from network import ServerConnection
+from movement import PREDICTED_BURST, spend, step
+from tilemap import load_map, load_atlas, CHUNK_SIZE
 
-    def __init__(self, *args, **kwargs):
-        super(KivyTiledMap, self).__init__(*args, **kwargs)
+class StreamedTiledMap(object):
+    """Map read from its chunked on-disk index (see tilemap.py) instead of
+    being fully loaded by pytmx. A tileset image is only loaded the first
+    time one of its tiles is drawn, and cut with the regions precomputed in
+    the map atlas.
+    """
 
-        # call load tile images for each tileset
-        for tileset in self.tilesets:
+    def __init__(self, filename, chunk_size=CHUNK_SIZE):
+        self.index      = load_map(filename, chunk_size)
+        self.atlas      = load_atlas(filename, self.index) #tileset image -> {gid: region}
+        self.directory  = os.path.dirname(filename)
+        self.width      = self.index.width
+        self.height     = self.index.height
+        self.tilewidth  = self.index.tilewidth
+        self.tileheight = self.index.tileheight
+        self.tilesets   = sorted(self.index.tilesets, key=lambda ts: ts['firstgid'])
+        self.firstgids  = [ts['firstgid'] for ts in self.tilesets]
+        self.textures   = {}              #gid -> texture region, filled tileset by tileset
+        self.loaded     = set()           #firstgid of the tilesets already sliced
+
+    def get_tile_image_by_gid(self, gid):
+        if gid not in self.textures:
+            tileset = self.tilesets[bisect_right(self.firstgids, gid) - 1]
+            if tileset['firstgid'] in self.loaded:
+                return None
             self.loadTileImages(tileset)
+        return self.textures.get(gid)
 
     def loadTileImages(self, ts):
-        """Loads the images in filename into Kivy Images.
-        :type ts: TiledTileset
-        """
-        # print ts.source
-        image   = Image(source="map/" + ts.source)
-        texture = image.texture
-        ts.width, ts.height = texture.size
-
-        # initialize the image array
-        self.images = [0] * self.maxgid
-
-        p = itertools.product(
-            xrange(ts.margin, ts.height, ts.tileheight + ts.margin),
-            xrange(ts.margin, ts.width, ts.tilewidth + ts.margin)
-        )
-
-        for real_gid, (y, x) in enumerate(p, ts.firstgid):
-            if x + ts.tilewidth - ts.spacing > ts.width:
-                continue
-
-            gids = self.map_gid(real_gid)
-
-            if gids:
-                x = x - ts.spacing
-                # convert the y coordinate to opengl (0 at bottom of texture)
-                y = ts.height - y - ts.tileheight + ts.spacing
-
-                tile = texture.get_region(x, y, ts.tilewidth, ts.tileheight)
-
-                for gid, flags in gids:
-                    self.images[gid] = tile
-
+        """Loads a tileset image and cuts it into one texture region per gid."""
+        self.loaded.add(ts['firstgid'])
+        if ts['image'] is None:
+            return
+        texture = CoreImage(os.path.join(self.directory, ts['image'])).texture
+        for gid, region in self.atlas.get(os.path.normpath(ts['image']), {}).iteritems():
+            self.textures[int(gid)] = texture.get_region(*region)
+
+    def visible_layers(self):
+        return [index for index, (name, visible) in enumerate(self.index.layers) if visible]
+
+    def layer_properties(self, layer_name):
+        """Returns the PropertyIndex of a layer, or None if the map has no such layer."""
+        layer = self.index.layer_index.get(layer_name)
+        if layer is None:
+            return None
+        return self.index.layer_properties(layer)
 
     def find_tile_with_property(self, property_name, layer_name='Ground'):
-        layer = self.get_layer_by_name(layer_name)
-        index = 0
-        for tile in layer:
-            try:
-                properties = self.get_tile_properties((tile[0], tile[1], index))
-                if properties.has_key(property_name):
-                    return tile[0], tile[1]
-            except:
-                pass
-
-        return None
-
+        properties = self.layer_properties(layer_name)
+        return properties.find(property_name) if properties else None
 
     def tile_has_property(self, x, y, property_name, layer_name='Ground'):
         """Check if the tile coordinates passed in represent a collision.
         :return: Boolean representing whether or not there was a collision.
         """
-        layer = self.get_layer_by_name(layer_name)
-        index = 0
-
-        try:
-            properties = self.get_tile_properties((x, y, index))
-            return properties.has_key(property_name)
-        except:
-            return False
-
-class TileGrid(GridLayout):
-    """Creates a Kivy grid and puts the tiles in a KivyTiledMap in it.
+        properties = self.layer_properties(layer_name)
+        return properties.has(property_name, x, y) if properties else False
+
+class TileGrid(Widget):
+    """Draws the tile layers of the map on a single canvas.
+    The map is split in chunks of chunk_size x chunk_size tiles, each one baked
+    into an FBO texture, so a frame only draws one Rectangle per chunk.
+    Only the chunks around the viewport are built; the least recently seen
+    ones are released when more than max_chunks are loaded.
+    The widget shows up before its map: the map index, atlas and collision
+    bitmap are read on a thread (which parses the TMX file when the index is
+    not cached yet), then the chunks are baked nearest to the middle of the
+    window first, spending at most bake_budget seconds per frame.
     Source : kivy wiki"""
-    map_file = StringProperty('./map/desert.tmx')
+    map_file       = StringProperty('./map/desert.tmx')
+    chunk_size     = NumericProperty(CHUNK_SIZE) #Size of a chunk in number of tile
+    max_chunks     = NumericProperty(64)         #Number of baked chunks kept in memory
+    preload_margin = NumericProperty(1)          #Chunks built around the viewport, in number of chunk
+    bake_budget    = NumericProperty(0.008)      #Seconds spent baking chunks per frame, 0 to bake them all at once
+    background     = BooleanProperty(True)       #Read the map on a thread instead of in the constructor
+    ready          = BooleanProperty(False)      #Have the chunks around the viewport all been baked once ?
 
     def __init__(self, **kwargs):
-        self.map = KivyTiledMap(self.map_file)
-        # print "yolo"
-
-        super(TileGrid, self).__init__(
-            rows=self.map.height, cols=self.map.width,
-            row_force_default=True,
-            row_default_height=self.map.tileheight,
-            col_force_default=True,
-            col_default_width=self.map.tilewidth,
-            **kwargs
-        )
+        super(TileGrid, self).__init__(**kwargs)
+
+        self.map    = None                #StreamedTiledMap, once read
+        self.chunks = OrderedDict()       #(chunk x, chunk y) -> (fbo, rectangle), least recently seen first
+        with self.canvas.before:
+            PushMatrix()
+            # the map is drawn from the top left corner of the widget, like a GridLayout
+            self.translate = Translate(self.x, self.top)
+            self.chunk_group = InstructionGroup()
+            PopMatrix()
+        self.trigger_chunks = Clock.create_trigger(self.update_chunks)
+        self.bind(pos=self.update_translate, size=self.update_translate)
+        Window.bind(size=self.trigger_chunks)
+
+        if self.background:
+            thread = Thread(target=self.load_in_background, args=(self.map_file, self.chunk_size))
+            thread.daemon = True
+            thread.start()
+        else:
+            self.set_map(self.load_map(self.map_file, self.chunk_size))
 
-        tilelayer_index = 0
+    @staticmethod
+    def load_map(map_file, chunk_size):
+        """Reads the map index, its atlas and its collision bitmap, none of which needs OpenGL."""
+        tiled_map = StreamedTiledMap(map_file, chunk_size)
+        # build the collision bitmap now rather than on the first move
+        tiled_map.layer_properties('Ground')
+        return tiled_map
 
-        for tile in self.map.get_layer_by_name('Ground').tiles():
-            self.add_widget(Image(texture=self.map.get_tile_image(tile[0], tile[1], 0), size=(32,32)))
-            tilelayer_index += 1
+    def load_in_background(self, map_file, chunk_size):
+        try:
+            tiled_map = self.load_map(map_file, chunk_size)
+        except Exception:
+            Logger.exception('TileGrid: Cannot load {}'.format(map_file))
+            return
+        # the textures can only be created on the main thread
+        Clock.schedule_once(lambda dt: self.set_map(tiled_map))
+
+    def set_map(self, tiled_map):
+        self.map = tiled_map
+        self.update_chunks()
+
+    def update_translate(self, *args):
+        self.translate.xy = (self.x, self.top)
+        self.trigger_chunks()
+
+    def visible_chunks(self):
+        """Returns the chunks intersecting the window, plus preload_margin around them."""
+        size   = self.chunk_size
+        tw, th = self.map.tilewidth, self.map.tileheight
+        first_col = int(-self.x // tw)
+        last_col  = int((Window.width - self.x) // tw)
+        first_row = int((self.top - Window.height) // th)
+        last_row  = int(self.top // th)
+
+        margin = self.preload_margin
+        cx_min = max(0, first_col // size - margin)
+        cx_max = min(self.map.index.chunks_x - 1, last_col // size + margin)
+        cy_min = max(0, first_row // size - margin)
+        cy_max = min(self.map.index.chunks_y - 1, last_row // size + margin)
+        return [(cx, cy) for cy in xrange(cy_min, cy_max + 1) for cx in xrange(cx_min, cx_max + 1)]
+
+    def update_chunks(self, *args):
+        if self.map is None:
+            return
+        needed  = self.visible_chunks()
+        missing = []
+        for key in needed:
+            if key in self.chunks:
+                # mark the chunk as recently seen
+                self.chunks[key] = self.chunks.pop(key)
+            else:
+                missing.append(key)
+
+        # the chunks nearest to the middle of the window are baked first, the others on the next frames
+        size = self.chunk_size
+        cx = (Window.width / 2. - self.x) // self.map.tilewidth // size
+        cy = (self.top - Window.height / 2.) // self.map.tileheight // size
+        missing.sort(key=lambda key: abs(key[0] - cx) + abs(key[1] - cy))
+        start = time.time()
+        for index, key in enumerate(missing):
+            if index and self.bake_budget and time.time() - start > self.bake_budget:
+                self.trigger_chunks()
+                break
+            self.chunks[key] = self.bake_chunk(*key)
+            self.chunk_group.add(self.chunks[key][1])
+        else:
+            self.ready = True
+
+        # release the least recently seen chunks over the budget
+        budget = max(self.max_chunks, len(needed))
+        while len(self.chunks) > budget:
+            key, (fbo, rectangle) = self.chunks.popitem(last=False)
+            self.chunk_group.remove(rectangle)
+
+    def bake_chunk(self, cx, cy):
+        """Renders the tiles of a chunk in a texture and returns the fbo and the Rectangle drawing it.
+        The fbo is kept alive so it can redraw its texture if the GL context is lost."""
+        size   = self.chunk_size
+        tw, th = self.map.tilewidth, self.map.tileheight
+        cols   = min(size, self.map.width - cx * size)
+        rows   = min(size, self.map.height - cy * size)
+
+        fbo = Fbo(size=(cols * tw, rows * th))
+        with fbo:
+            ClearColor(0, 0, 0, 0)
+            ClearBuffers()
+            for layer in self.map.visible_layers():
+                for x, y, gid in self.map.index.chunk_tiles(layer, cx, cy):
+                    texture = self.map.get_tile_image_by_gid(gid)
+                    if texture is None:
+                        continue
+                    # the fbo origin is its bottom left corner
+                    Rectangle(texture=texture, size=(tw, th),
+                              pos=((x - cx * size) * tw, (rows - 1 - (y - cy * size)) * th))
+        fbo.draw()
+
+        return fbo, Rectangle(texture=fbo.texture, size=fbo.size,
+                              pos=(cx * size * tw, -(cy * size + rows) * th))
 
     def valid_move(self, x, y):
-        if x < 0 or x > self.map.width or y < 0 or y > self.map.height:
+        if self.map is None:
+            Logger.debug('TileGrid: Move {},{} before the map is loaded'.format(x, y))
+            return False
+
+        if x < 0 or x >= self.map.width or y < 0 or y >= self.map.height:
             Logger.debug('TileGrid: Move {},{} is out of bounds'.format(x, y))
             return False
 
@@ -144,30 +253,35 @@ class TileGrid(GridLayout):
 
 class Character(Widget):
     """Manage the Character and draw it in the grid
+    The animation frames are named after their image file, and their textures
+    are loaded once, from the atlas built by build_atlas.py when there is one.
     """
     ASSETS_DIR   = os.path.abspath(os.path.join(os.path.dirname(__file__), 'images'))
+    ATLAS        = os.path.join(ASSETS_DIR, 'characters.atlas')
+    _textures    = {}                     #Frame name -> texture, shared by every character
     _animation   = {
-        'up': [os.path.join(ASSETS_DIR, 'green-up-0.png'),
-            os.path.join(ASSETS_DIR, 'green-up-1.png'),
-            os.path.join(ASSETS_DIR, 'green-up-2.png'),
-            os.path.join(ASSETS_DIR, 'green-up-3.png')],
-
-        'down': [os.path.join(ASSETS_DIR, 'green-down-0.png'),
-            os.path.join(ASSETS_DIR, 'green-down-1.png'),
-            os.path.join(ASSETS_DIR, 'green-down-2.png'),
-            os.path.join(ASSETS_DIR, 'green-down-3.png')],
-
-        'left': [os.path.join(ASSETS_DIR, 'green-left-0.png'),
-            os.path.join(ASSETS_DIR, 'green-left-1.png'),
-            os.path.join(ASSETS_DIR, 'green-left-2.png'),
-            os.path.join(ASSETS_DIR, 'green-left-3.png')],
-
-        'right': [os.path.join(ASSETS_DIR, 'green-right-0.png'),
-            os.path.join(ASSETS_DIR, 'green-right-1.png'),
-            os.path.join(ASSETS_DIR, 'green-right-2.png'),
-            os.path.join(ASSETS_DIR, 'green-right-3.png')]
+        'up': ['green-up-0',
+            'green-up-1',
+            'green-up-2',
+            'green-up-3'],
+
+        'down': ['green-down-0',
+            'green-down-1',
+            'green-down-2',
+            'green-down-3'],
+
+        'left': ['green-left-0',
+            'green-left-1',
+            'green-left-2',
+            'green-left-3'],
+
+        'right': ['green-right-0',
+            'green-right-1',
+            'green-right-2',
+            'green-right-3']
     }
-    source     = StringProperty()         #The current image of the character
+    source     = StringProperty()         #The current frame of the character
+    texture    = ObjectProperty(None)     #Texture of the current frame
     _animframe = NumericProperty(0)       #The current frame of the animation
     _animating = BooleanProperty(False)   #Is the char animating ?
     direction  = StringProperty('down')   #Where the player is watching
@@ -183,6 +297,19 @@ class Character(Widget):
         self.map_width    = (Window.width / 32 + 1) / 2
         self.current_tile = Vector(5, 5)
 
+    @classmethod
+    def frame_texture(cls, name):
+        """Returns the texture of an animation frame, loading it only the first time."""
+        textures = Character._textures
+        if not textures and os.path.exists(cls.ATLAS):
+            textures.update(Atlas(cls.ATLAS).textures)
+        if name not in textures:
+            textures[name] = CoreImage(os.path.join(cls.ASSETS_DIR, name + '.png')).texture
+        return textures[name]
+
+    def on_source(self, instance, value):
+        self.texture = self.frame_texture(value)
+
     def update_position(self):
         self.map_width  = (Window.width / 32 + 1) / 2
         self.map_height = (Window.height / 32 + 1) / 2
@@ -201,33 +328,100 @@ class Character(Widget):
             self._animating = False
             self.source = self._animation.get(direction)[0]
 
+class RemoteCharacter(Character):
+    """Character of another online player, drawn slightly in the past.
+    Every received state is buffered with its reception time, and the
+    character is drawn between the two states surrounding
+    now - interpolation_delay. When the next state is late, the last move is
+    extrapolated for a short time, then eased back to the last known tile.
+    """
+    step_time = 0.2                       #Time taken to walk one tile, as the local Player animation
+
+    def __init__(self, **kwargs):
+        super(RemoteCharacter, self).__init__(**kwargs)
+        self.snapshots = deque(maxlen=32) #(reception time, x, y, direction), oldest first
+        self.settled   = True             #Is the char drawn on its last known tile ?
+
+    def push(self, received, x, y, direction):
+        if self.snapshots:
+            last = self.snapshots[-1]
+            # the server sends nothing while a player stands still: the move starts one step before its end
+            if received - last[0] > self.step_time:
+                self.snapshots.append((received - self.step_time,) + last[1:])
+        self.snapshots.append((received, x, y, direction))
+        self.settled = False
+
+    def sample(self, render_time, max_extrapolation):
+        """Returns the x, y and direction of the char at render_time."""
+        snapshots = self.snapshots
+        # the states older than the one preceding render_time are no longer needed
+        while len(snapshots) > 2 and snapshots[1][0] <= render_time:
+            snapshots.popleft()
+
+        last = snapshots[-1]
+        if render_time >= last[0]:
+            elapsed = render_time - last[0]
+            if len(snapshots) < 2 or elapsed >= max_extrapolation + self.step_time:
+                self.settled = True
+                return last[1:]
+            # dead reckoning : keep going at the last speed, then come back to the last known tile
+            previous = snapshots[-2]
+            ahead = min(elapsed, max_extrapolation)
+            if elapsed > max_extrapolation:
+                ahead *= 1 - (elapsed - max_extrapolation) / self.step_time
+            ratio = ahead / (last[0] - previous[0]) if last[0] > previous[0] else 0
+            return (last[1] + (last[1] - previous[1]) * ratio,
+                    last[2] + (last[2] - previous[2]) * ratio,
+                    last[3])
+
+        for index in xrange(len(snapshots) - 1, 0, -1):
+            before = snapshots[index - 1]
+            if before[0] <= render_time:
+                after = snapshots[index]
+                ratio = (render_time - before[0]) / (after[0] - before[0])
+                return (before[1] + (after[1] - before[1]) * ratio,
+                        before[2] + (after[2] - before[2]) * ratio,
+                        after[3])
+        return snapshots[0][1:]
+
+    def place(self, x, y, direction, render_time):
+        """Draws the char at a position between two tiles, walking if it moved since the last frame."""
+        moving = (x, y) != (self.current_tile.x, self.current_tile.y)
+        self.current_tile = Vector(x, y)
+        self.direction    = direction
+        self.position_x   = x + camera.x
+        self.position_y   = y - camera.y
+        frames = self._animation.get(direction)
+        if moving:
+            self.source = frames[int(render_time * len(frames) / self.step_time) % len(frames)]
+        else:
+            self.source = frames[0]
+
 class Player(Character):
     """Inherits Character and add touch/keyboard event to move the char
     """
-    ASSETS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'images'))
     _animation = {
-        'up': [os.path.join(ASSETS_DIR, 'red-up-0.png'),
-            os.path.join(ASSETS_DIR, 'red-up-1.png'),
-            os.path.join(ASSETS_DIR, 'red-up-2.png'),
-            os.path.join(ASSETS_DIR, 'red-up-3.png')],
-
-        'down': [os.path.join(ASSETS_DIR, 'red-down-0.png'),
-            os.path.join(ASSETS_DIR, 'red-down-1.png'),
-            os.path.join(ASSETS_DIR, 'red-down-2.png'),
-            os.path.join(ASSETS_DIR, 'red-down-3.png')],
-
-        'left': [os.path.join(ASSETS_DIR, 'red-left-0.png'),
-            os.path.join(ASSETS_DIR, 'red-left-1.png'),
-            os.path.join(ASSETS_DIR, 'red-left-2.png'),
-            os.path.join(ASSETS_DIR, 'red-left-3.png')],
-
-        'right': [os.path.join(ASSETS_DIR, 'red-right-0.png'),
-            os.path.join(ASSETS_DIR, 'red-right-1.png'),
-            os.path.join(ASSETS_DIR, 'red-right-2.png'),
-            os.path.join(ASSETS_DIR, 'red-right-3.png')]
+        'up': ['red-up-0',
+            'red-up-1',
+            'red-up-2',
+            'red-up-3'],
+
+        'down': ['red-down-0',
+            'red-down-1',
+            'red-down-2',
+            'red-down-3'],
+
+        'left': ['red-left-0',
+            'red-left-1',
+            'red-left-2',
+            'red-left-3'],
+
+        'right': ['red-right-0',
+            'red-right-1',
+            'red-right-2',
+            'red-right-3']
     }
     map_grid   = ObjectProperty(None)     #Grid object
-    online     = BooleanProperty(True)    #Is the game playing online ?
 
     def __init__(self, **kwargs):
         super(Player, self).__init__(**kwargs)
@@ -237,12 +431,21 @@ class Player(Character):
         self.map_height = (Window.height / 32 + 1) / 2
         self.map_width  = (Window.width / 32 + 1) / 2
         self.listener   = None
+        self.input_seq  = 0                #Sequence number of the last input sent
+        self.pending    = deque()          #(seq, key) of the inputs predicted but not yet acknowledged
+        self.move_credit = PREDICTED_BURST #Steps we can still take without outrunning the server's speed limit
+        self.credit_time = time.time()     #Time at which that credit was computed
 
     def initListener (self,listener) : 
         self.listener = listener
-        self.online   = listener.online
+        listener.player = self
         if self.online:
-            self.listener.sock.send(json.dumps((self.current_tile.x, self.current_tile.y, self.direction)) + "|")
+            self.listener.send_move(self.current_tile.x, self.current_tile.y, self.direction)
+
+    @property
+    def online(self):
+        """Is the game playing online ? Read from the listener, which goes offline if the connection is lost."""
+        return self.listener is not None and self.listener.online
 
     def on_touch_down(self, touch):
         Logger.debug('Input: touch')
@@ -251,86 +454,109 @@ class Player(Character):
         value, key_name = keycode
         # Logger.debug('Input: {}'.format(key_name))
 
+        # neither moves nor turns until the map is loaded, move() needs its size
+        if self.map_grid.map is None:
+            return
+
         if key_name in ['up', 'down', 'left', 'right']:
-            dx = 0
-            dy = 0
-            new_dir = self.direction
-
-            if key_name == 'up':
-                # if the direction change, the char turn and don't move
-                if new_dir != 'up':
-                    new_dir = 'up'
-                else:
-                    dy = -1
-                
-            elif key_name == 'down':
-                if new_dir != 'down':
-                    new_dir = 'down'
+            # the move is applied at once, the server will replay it and acknowledge its result
+            x, y, new_dir = step(self.current_tile.x, self.current_tile.y, self.direction,
+                                 key_name, self.map_grid.valid_move)
+            if (x, y, new_dir) == (self.current_tile.x, self.current_tile.y, self.direction):
+                return
+            # the server would refuse a step faster than its speed limit, so neither is it predicted nor sent;
+            # turning in place is always allowed
+            if (x, y) != (self.current_tile.x, self.current_tile.y):
+                now = time.time()
+                self.move_credit, allowed = spend(self.move_credit, now - self.credit_time, PREDICTED_BURST)
+                self.credit_time = now
+                if not allowed:
+                    return
+            self.move(x - self.current_tile.x, y - self.current_tile.y, new_dir)
+
+            if self.online:
+                if self.listener.inputs:
+                    self.input_seq += 1
+                    self.pending.append((self.input_seq, key_name))
+                    self.listener.send_input(self.input_seq, key_name)
                 else:
-                    dy = 1
-                
-            elif key_name == 'left':
-                if new_dir != 'left':
-                    new_dir = 'left'
-                else:
-                    dx = -1
-                
-            elif key_name == 'right':
-                if new_dir != 'right':
-                    new_dir = 'right'
-                else:
-                    dx = 1
+                    self.listener.send_move(self.current_tile.x, self.current_tile.y, self.direction)
 
-            if self.map_grid.valid_move(self.current_tile.x + dx, self.current_tile.y + dy):
-                cameraUpdate = False
-                self.map_width = (Window.width / 32 + 1) / 2
+    def move(self, dx, dy, new_dir):
+        """Moves the player of dx, dy tiles (or turns it to new_dir), scrolling the camera if needed."""
+        cameraUpdate = False
+        self.map_width = (Window.width / 32 + 1) / 2
 
-                # if user is in camera zone : we only move the player position
-                if (self.position_x + dx < self.map_width and self.current_tile.x < self.map_width) or self.current_tile.x + dx > self.map_grid.map.width - self.map_width:
-                    self.position_x += dx
-                else:
-                # else we move only the camera
-                    camera.x -= dx
-                    cameraUpdate =  True
-                self.current_tile.x += dx
-
-                self.map_height = (Window.height / 32 + 1) / 2
-                # if user move in camera zone, we only move the player position
-                if (self.position_y + dy < self.map_height and self.current_tile.y < self.map_height) or self.current_tile.y + dy + 2 > self.map_grid.map.height - self.map_height:
-                    self.position_y += dy
-                else:
-                # else we move only the camera
-                    camera.y += dy
-                    cameraUpdate =  True
-                self.current_tile.y += dy
-
-                #if the camera will move, we move all characters
-                if cameraUpdate:
-                    for player in players.values():
-                        player.update_position()
-
-                Logger.debug('Player: Moving to [{}, {}]'.format(self.position_x, self.position_y))
-                Logger.debug('Position : Moving to {}'.format(self.current_tile))
-                Logger.debug('Camera   : Moving to {}'.format(camera))
-
-                #Move the camera
-                coords = camera*32
-                anim   = Animation(x=coords[0], y=coords[1], duration=0.2, transition="linear")
-                anim.start(self.map_grid)
-                # Logger.debug('Character: {} => {}'.format(self.direction, new_dir))
-
-                #Move the char with animation
-                if self.direction == new_dir:
-                    self._animating = True
-                    self._animframe = len(self._animation.get(new_dir, []))
-                    anim_dt = 0.3 / self._animframe
-                    Clock.schedule_once(partial(self._animate, new_dir), anim_dt)
-                else:
-                    self.source    = self._animation.get(new_dir)[0]
-                    self.direction = new_dir
+        # if user is in camera zone : we only move the player position
+        if (self.position_x + dx < self.map_width and self.current_tile.x < self.map_width) or self.current_tile.x + dx > self.map_grid.map.width - self.map_width:
+            self.position_x += dx
+        else:
+        # else we move only the camera
+            camera.x -= dx
+            cameraUpdate =  True
+        self.current_tile.x += dx
 
-                if self.online:
-                    self.listener.sock.send(json.dumps((self.current_tile.x, self.current_tile.y, self.direction)) + "|")
+        self.map_height = (Window.height / 32 + 1) / 2
+        # if user move in camera zone, we only move the player position
+        if (self.position_y + dy < self.map_height and self.current_tile.y < self.map_height) or self.current_tile.y + dy + 2 > self.map_grid.map.height - self.map_height:
+            self.position_y += dy
+        else:
+        # else we move only the camera
+            camera.y += dy
+            cameraUpdate =  True
+        self.current_tile.y += dy
+
+        #if the camera will move, we move all characters
+        if cameraUpdate:
+            for player in players.values():
+                player.update_position()
+
+        Logger.debug('Player: Moving to [{}, {}]'.format(self.position_x, self.position_y))
+        Logger.debug('Position : Moving to {}'.format(self.current_tile))
+        Logger.debug('Camera   : Moving to {}'.format(camera))
+
+        #Move the camera
+        coords = camera*32
+        anim   = Animation(x=coords[0], y=coords[1], duration=0.2, transition="linear")
+        anim.start(self.map_grid)
+        # Logger.debug('Character: {} => {}'.format(self.direction, new_dir))
+
+        #Move the char with animation
+        if self.direction == new_dir:
+            self._animating = True
+            self._animframe = len(self._animation.get(new_dir, []))
+            anim_dt = 0.3 / self._animframe
+            Clock.schedule_once(partial(self._animate, new_dir), anim_dt)
+        else:
+            self.source    = self._animation.get(new_dir)[0]
+            self.direction = new_dir
+
+    def correct(self, x, y, direction):
+        """Puts the player back on the tile kept by the server after a rejected move.
+        The camera only moves if that tile is out of the screen."""
+        self.current_tile = Vector(x, y)
+        self.direction    = direction
+        if not 0 <= x + camera.x < 2 * self.map_width:
+            camera.x = min(0, self.map_width - x)
+        if not 0 <= y - camera.y < 2 * self.map_height:
+            camera.y = max(0, y - self.map_height)
+        Animation.cancel_all(self.map_grid)
+        self.map_grid.pos = camera*32
+        self.update_position()
+        for player in players.values():
+            player.update_position()
+        Logger.debug('Player: Corrected by the server to {}'.format(self.current_tile))
+
+    def reconcile(self, seq, x, y, direction):
+        """Replays the inputs the server has not processed yet on top of the state
+        it acknowledged, and only corrects the player if the result differs from
+        what was predicted."""
+        while self.pending and self.pending[0][0] <= seq:
+            self.pending.popleft()
+        for input_seq, key in self.pending:
+            x, y, direction = step(x, y, direction, key, self.map_grid.valid_move)
+        if (x, y, direction) != (self.current_tile.x, self.current_tile.y, self.direction):
+            self.correct(x, y, direction)
 
     def on_keyboard_closed(self):
         self.keyboard.unbind(on_key_down=self.on_keyboard_down)
@@ -348,73 +574,113 @@ class Camera(EventDispatcher):
     def __mul__(self, other):
         return (self.x*other, self.y*other)
 
-class ListenerServer(Thread):
-    """Thread to listen to the server for update of online players
+class RemotePlayers(Widget):
+    """Layer holding the Characters of the other online players.
+    The updates received are buffered by each RemoteCharacter, which are all
+    drawn once per frame interpolation_delay seconds in the past, and the
+    Character widgets are pooled.
+    """
+    pool_size           = NumericProperty(32)   #Max number of hidden Characters kept for reuse
+    interpolation_delay = NumericProperty(0.1)  #Render delay, at least two server ticks
+    max_extrapolation   = NumericProperty(0.05) #How long a late player keeps moving
+
+    def __init__(self, **kwargs):
+        super(RemotePlayers, self).__init__(**kwargs)
+        self.pool = []
+        Clock.schedule_interval(self.render, 0)
+
+    def apply(self, updates):
+        for update in updates:
+            if update[0] == 'remove':
+                self.remove_player(update[1])
+            elif update[0] == 'update':
+                self.update_player(*update[1:])
+
+    def render(self, dt):
+        """Moves the characters still between two tiles."""
+        render_time = time.time() - self.interpolation_delay
+        for character in players.values():
+            if not character.settled:
+                x, y, direction = character.sample(render_time, self.max_extrapolation)
+                character.place(x, y, direction, render_time)
+
+    def update_player(self, id_client, x, y, direction, received):
+        #If the player just connected
+        if id_client not in players:
+            character = self.pool.pop() if self.pool else RemoteCharacter()
+            character.snapshots.clear()
+            players[id_client] = character
+            self.add_widget(character)
+
+        players[id_client].push(received, x, y, direction)
+
+    def remove_player(self, id_client):
+        if id_client in players:
+            Logger.debug("Listener: Deconnection of player {}".format(id_client))
+            character = players.pop(id_client)
+            self.remove_widget(character)
+            if len(self.pool) < self.pool_size:
+                self.pool.append(character)
+
+class ListenerServer(ServerConnection):
+    """Thread to listen to the server for update of online players.
+    The updates are applied on the main thread, once per frame.
     """
-    runThread = True
-    sock      = None
-    online    = True
-    grid      = None
+    remote = None
+    player = None       #Local Player, put back in place or reconciled with the server state
 
-    def __init__(self, grid):
-        Thread.__init__(self)
+    def __init__(self, remote, binary=True, udp=True, session_file=None):
         # hote = "tpdrio.esiee.fr"
         # port = 8004
         hote = "localhost"
         port = 5000
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.grid = grid
-        try:
-            self.sock.connect((hote, port))
-            self.sock.setblocking(0)
-        except socket.error, e:
-            self.online = False
-
-        if self.online:
-            Logger.debug("Listener: Connection on {}".format(port))
-        else:
-            Logger.debug("Listener: Offline play")
-
-
-    def run(self):
-
-        while self.runThread:
-            try:
-                # we wait for a message from server
-                messages = self.sock.recv(2048)
-            except socket.error, e:
-                err = e.args[0]
-                if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-                    continue
-                else:
-                    # a "real" error occurred
-                    print e
-                    sys.exit(1)
-            else:
-                Logger.debug("Listener: Message received from server {}".format(messages))
-
-                for message in messages.split("|"):
-                    if len(message) > 0:
-                        player = json.loads(message)
-                        if len(player) > 0:
-                            #If the player just connected
-                            if player[0] not in players:
-                                players[player[0]] = Character()
-                                self.grid.add_widget(players[player[0]])
-
-                            #If the player just disconnected
-                            if player[1] == 99 and player[2] == 99:
-                                Logger.debug("Listener: Deconnection of player {}".format(player[0]))
-                                self.grid.remove_widget(players[player[0]])
-                                del players[player[0]]
-                            else:
-                                players[player[0]].current_tile.x = player[1]
-                                players[player[0]].current_tile.y = player[2]
-                                players[player[0]].direction      = player[3]
-                                players[player[0]].update_position()
-           
-        Logger.debug("Listener: Closing thread")
+        self.session_file = session_file
+        session = None
+        if session_file is not None and os.path.exists(session_file):
+            with open(session_file) as f:
+                session = binascii.unhexlify(f.read().strip())
+
+        super(ListenerServer, self).__init__(hote, port, binary, udp, session)
+        self.remote = remote
+
+        # the connection is made by the thread, the updates are processed once it is up
+        Logger.debug("Listener: Connecting to {}".format(port))
+        Clock.schedule_interval(self.process_updates, 0)
+
+    def log(self, message):
+        Logger.debug(message)
+
+    def on_session(self, token):
+        if self.session_file is not None:
+            with open(self.session_file, 'w') as f:
+                f.write(binascii.hexlify(token))
+
+    def process_updates(self, dt):
+        """Applies the updates received since the last frame."""
+        updates = self.drain()
+        corrections = [update for update in updates if update[0] == 'correct']
+        states      = [update for update in updates if update[0] == 'state']
+        if corrections or states:
+            updates = [update for update in updates if update[0] not in ('correct', 'state')]
+            if self.player is not None:
+                if corrections:
+                    self.player.correct(*corrections[-1][1:])
+                if states:
+                    self.player.reconcile(*states[-1][1:])
+        if updates:
+            self.remote.apply(updates)
+
+def session_name(argv):
+    """Returns the name given with --session (python client.py -- --session <name>).
+    Each name keeps its own player between two runs, so that two clients started
+    by the same user do not share one. Without it, every run plays a new player.
+    """
+    if '--session' in argv:
+        index = argv.index('--session')
+        if index + 1 < len(argv):
+            return argv[index + 1]
+    return None
 
 #Global vars
 players    = {}
@@ -426,7 +692,11 @@ class ClientApp(App):
     def build(self):
         grid = TileGrid()
 
-        self.listener = ListenerServer(grid)
+        remote = RemotePlayers()
+        grid.add_widget(remote)
+        name = session_name(sys.argv)
+        session_file = os.path.join(self.user_data_dir, 'session-' + name) if name else None
+        self.listener = ListenerServer(remote, session_file=session_file)
         self.listener.start()
 
     	c = Player(map_grid=grid)
@@ -437,11 +707,11 @@ class ClientApp(App):
 
     def on_stop(self):
         Logger.debug('App   : Closing the app')
+        Clock.unschedule(self.listener.process_updates)
         if self.listener.online:
             #Close the connection with the server
-            self.listener.sock.send(json.dumps((99, 99, "down")) + "|")
-            self.listener.sock.close()
-            self.listener.runThread = False
+            self.listener.send_leave()
+        self.listener.close()
 
 if __name__ == '__main__':
     ClientApp().run()
\ No newline at end of file
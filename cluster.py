@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+
+# Mode réparti du serveur : la carte est découpée en bandes verticales (zones), chacune gérée par un processus
+# ZoneServer, et une passerelle accepte les connexions pour les confier aux zones.
+#
+# Les processus communiquent par des sockets locales (multiprocessing.Pipe) :
+#   passerelle -> zone : ("connect", adresse) suivi de la socket du client (SCM_RIGHTS)
+#   zone -> zone       : ("handoff", état du client) suivi de sa socket, quand son player change de zone
+#                        ("ghosts", [("ghost", id, x, y, direction) ou ("unghost", id)]) à chaque tick, pour
+#                        les players proches de la frontière, qui doivent être visibles des deux côtés
+#
+# Les zones s'écrivent sans jamais bloquer (voir Channel) : deux zones voisines qui s'envoient beaucoup à la fois
+# ne peuvent pas s'attendre l'une l'autre.
+#
+# Le client garde sa connexion TCP d'un bout à l'autre : seul le descripteur change de processus.
+# Un player qui quitte une zone y reste visible comme fantôme tant qu'il est proche de la frontière, de sorte
+# que les clients de l'ancienne zone ne le voient ni disparaître ni réapparaître.
+
+from socket import *
+
+import cPickle
+import errno
+import multiprocessing
+import os
+import select
+import signal
+import struct
+import sys
+import time
+from bisect import bisect_right
+from collections import deque
+from multiprocessing import reduction
+
+from server import GameServer, Client, Player, Poller, TICK_RATE, MAP_FILE, RESOURCE_ERRORS, ACCEPT_BACKOFF, WOULDBLOCK
+from protocol import JSON_CODEC, BINARY_CODECS
+from interest import CELL_WIDTH
+from delta import KEYFRAME_INTERVAL
+from tilemap import load_map
+
+# Distance à la frontière, en tuiles, jusqu'à laquelle un player est aussi visible de la zone voisine :
+# celle jusqu'à laquelle la grille d'intérêt (3x3 cellules) permet de voir
+GHOST_MARGIN = 2 * CELL_WIDTH
+
+# En-tête des messages d'une Connection de multiprocessing : taille du message sérialisé
+MESSAGE_SIZE = struct.Struct("!I")
+
+# Messages suivis d'un descripteur
+HANDLE_MESSAGES = ("connect", "handoff")
+
+
+# Connexion locale entre deux processus, lue et écrite sans bloquer, au même format qu'une Connection de
+# multiprocessing (la passerelle se contente de celle-ci pour écrire). Ce qui ne peut pas être écrit tout de suite
+# attend dans une file, vidée quand le poller signale la connexion prête. Les messages ne sont lus que jusqu'à leur
+# fin, pour que l'octet portant un descripteur (SCM_RIGHTS) ne soit lu que par recv_handle.
+class Channel :
+
+    def __init__(self, conn):
+        self.conn    = conn
+        self.fd      = conn.fileno()
+        self.sock    = fromfd(self.fd, AF_UNIX, SOCK_STREAM) # Même socket, pour les options MSG_DONTWAIT
+        self.out     = deque() # données à écrire, ou descripteur à transmettre puis fermer
+        self.inbuf   = ""
+        self.size    = None    # taille du message en cours de lecture, None tant que l'en-tête n'est pas lu
+        self.waiting = None    # message reçu dont le descripteur n'est pas encore arrivé
+
+    def fileno(self):
+        return self.fd
+
+    # Met en file un message, suivi d'un descripteur qui sera fermé une fois transmis
+    def send(self, message, handle=None):
+        data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+        self.out.append(MESSAGE_SIZE.pack(len(data)) + data)
+        if handle is not None:
+            self.out.append(handle)
+        self.flush()
+
+    # Ecrit autant que possible de la file, retourne vrai s'il en reste
+    def flush(self):
+        while self.out:
+            item = self.out[0]
+            if isinstance(item, int):
+                # Le descripteur n'accompagne qu'un octet, écrit dès que la socket a de la place
+                if not select.select([], [self.sock], [], 0)[1]:
+                    return True
+                reduction.send_handle(self.conn, item, None)
+                os.close(item)
+                self.out.popleft()
+                continue
+            try:
+                sent = self.sock.send(item, MSG_DONTWAIT)
+            except error as e:
+                if e.args[0] in WOULDBLOCK:
+                    return True
+                raise
+            if sent < len(item):
+                self.out[0] = item[sent:]
+                return True
+            self.out.popleft()
+        return False
+
+    # Retourne les messages complets reçus, en (message, descripteur ou None), et si la connexion est fermée
+    def receive(self):
+        messages = []
+        while True:
+            if self.waiting is not None:
+                if not select.select([self.sock], [], [], 0)[0]:
+                    return messages, False
+                messages.append((self.waiting, reduction.recv_handle(self.conn)))
+                self.waiting = None
+                continue
+            need = MESSAGE_SIZE.size if self.size is None else self.size
+            try:
+                data = self.sock.recv(need - len(self.inbuf), MSG_DONTWAIT)
+            except error as e:
+                if e.args[0] in WOULDBLOCK:
+                    return messages, False
+                return messages, True
+            if not data:
+                return messages, True
+            self.inbuf += data
+            if len(self.inbuf) < need:
+                continue
+            if self.size is None:
+                self.size, = MESSAGE_SIZE.unpack(self.inbuf)
+                self.inbuf = ""
+                continue
+            message = cPickle.loads(self.inbuf)
+            self.inbuf, self.size = "", None
+            if message[0] in HANDLE_MESSAGES:
+                self.waiting = message
+            else:
+                messages.append((message, None))
+
+
+# Player d'une zone voisine, placé dans la grille d'intérêt pour être vu des clients locaux
+class Ghost :
+    connected = False
+    delta     = None
+
+    def __init__(self, player):
+        self.player = player
+        self.fd     = ("ghost", player.id_client) # Clé dans joined et moved, distincte des descripteurs
+        self.known  = set()
+
+
+# Serveur d'une zone : un GameServer qui reçoit ses clients de la passerelle ou des autres zones
+class ZoneServer(GameServer) :
+
+    def __init__(self, port, zone, zones, gateway, peers, tick_rate=TICK_RATE, map_file=MAP_FILE):
+        # Les datagrammes arriveraient à la passerelle, qui ne sait pas les router : tout passe par TCP
+        GameServer.__init__(self, port, tick_rate, map_file=map_file, udp=False)
+        if self.map is None:
+            raise ValueError("A sharded server needs a map to split into zones")
+        self.zone      = zone
+        self.zones     = zones
+        self.gateway   = Channel(gateway) # Connexion venant de la passerelle
+        self.peers     = dict((zone, Channel(conn)) for zone, conn in peers.iteritems()) # zone -> Channel vers cette zone
+        self.id_client = zone    # Les identifiants sont entrelacés entre les zones pour rester uniques
+        self.owned     = dict()  # identifiant -> Client des players de la zone
+        self.ghosts    = dict()  # identifiant -> Ghost des players des zones voisines
+        self.published = dict()  # identifiant -> zones ayant un fantôme de ce player local
+        self.channels  = dict()  # fd -> (Channel, zone émettrice, None pour la passerelle)
+        self.flushing  = set()   # Channel dont la file d'écriture n'est pas vide
+        self.starts    = [z * self.map.width // zones for z in xrange(zones)]
+        self.neighbours = [z for z in (zone - 1, zone + 1) if 0 <= z < zones]
+
+    # Les zones n'écoutent pas de port : elles attendent les messages de la passerelle et des autres zones
+    def listen(self):
+        self.poller = Poller()
+        self.channels[self.gateway.fileno()] = (self.gateway, None)
+        for zone, conn in self.peers.iteritems():
+            self.channels[conn.fileno()] = (conn, zone)
+        for fd in self.channels:
+            self.poller.register(fd, Poller.READ)
+
+    def handle_event(self, fd, events):
+        if fd in self.channels:
+            channel, origin = self.channels[fd]
+            if events & Poller.WRITE:
+                self.flush_peer(channel)
+            if events & Poller.READ:
+                self.receive(channel, origin)
+        else:
+            GameServer.handle_event(self, fd, events)
+
+    # Envoie un message à une zone voisine, sans attendre qu'elle le lise
+    def send_peer(self, zone, message, handle=None):
+        channel = self.peers[zone]
+        channel.send(message, handle)
+        if channel.out and channel not in self.flushing and channel.fd in self.channels:
+            self.flushing.add(channel)
+            self.poller.modify(channel.fd, Poller.READ | Poller.WRITE)
+
+    # Poursuit l'écriture vers une zone voisine dont la connexion est de nouveau prête
+    def flush_peer(self, channel):
+        if not channel.flush() and channel in self.flushing:
+            self.flushing.discard(channel)
+            self.poller.modify(channel.fd, Poller.READ)
+
+    # Traite les messages disponibles sur une connexion locale
+    def receive(self, channel, origin):
+        messages, closed = channel.receive()
+        for message, handle in messages:
+            if message[0] == "connect":
+                self.adopt_connection(message[1], handle)
+            elif message[0] == "handoff":
+                self.adopt(message[1], handle, origin)
+            elif message[0] == "ghosts":
+                self.on_ghosts(message[1])
+        if closed:
+            self.poller.unregister(channel.fd)
+            del self.channels[channel.fd]
+            self.flushing.discard(channel)
+            if origin is None:
+                self.running = False
+
+    # Retourne la zone à laquelle appartient la colonne x
+    def zone_of(self, x):
+        return max(0, bisect_right(self.starts, x) - 1)
+
+    # Indique si la colonne x est assez proche d'une zone pour y être visible
+    def near(self, x, zone):
+        start = self.starts[zone]
+        end   = self.starts[zone + 1] if zone + 1 < self.zones else self.map.width
+        if x < start:
+            return start - x <= GHOST_MARGIN
+        return x - end < GHOST_MARGIN
+
+    # Crée le Client d'une socket reçue d'un autre processus
+    def attach(self, fd, address, player):
+        sock = fromfd(fd, AF_INET, SOCK_STREAM) # fromfd duplique le descripteur reçu
+        os.close(fd)
+        sock.setblocking(0)
+        client = Client(sock, address, player)
+        self.clients[client.fd] = client
+        self.owned[player.id_client] = client
+        self.poller.register(client.fd, Poller.READ)
+        return client
+
+    # Nouvelle connexion confiée par la passerelle : le protocole reste à négocier
+    def adopt_connection(self, address, fd):
+        client = self.attach(fd, address, Player(self.id_client))
+        self.id_client += self.zones
+        self.on_connect(client)
+
+    # Client transmis par une autre zone, avec tout l'état de sa connexion
+    def adopt(self, state, fd, origin):
+        id_client, x, y, direction, placed = state["player"]
+        player = Player(id_client)
+        player.update((x, y, direction))
+        player.placed = placed
+
+        # Le fantôme du player est remplacé par le player lui-même, sans que les clients le voient partir,
+        # sauf ceux qui voyaient la cellule du fantôme mais ne verront pas celle du player
+        ghost = self.ghosts.pop(id_client, None)
+        if ghost is not None:
+            cell = self.grid.positions.get(ghost)
+            self.forget(ghost, False)
+            if cell is not None:
+                area = set(self.grid.area(self.grid.cell_of(x, y)))
+                for other in self.grid.around(cell):
+                    if other.connected and id_client in other.known and self.grid.positions[other] not in area:
+                        other.known.discard(id_client)
+                        self.send_leave(other, id_client)
+
+        client = self.attach(fd, state["address"], player)
+        client.codec     = JSON_CODEC if state["codec"] == JSON_CODEC.name else BINARY_CODECS[state["version"]]
+        client.decoder   = state["decoder"]
+        client.delta     = state["delta"]
+        client.outbuf    = state["outbuf"]
+        client.known     = state["known"]
+        client.input_seq = state["input_seq"]
+        client.move_credit = state["move_credit"]
+        client.credit_tick = self.tick_count - state["credit_age"]
+        client.keyframe_due = state["keyframe_due"]
+        for id_backlog, record in state["backlog"].iteritems():
+            other = None
+            if record is not None:
+                other = Player(id_backlog)
+                other.update(record)
+            client.backlog[id_backlog] = other
+        if client.backlog:
+            self.backlogged[client.fd] = client
+        if client.delta is not None:
+            self.keyframes[id_client % KEYFRAME_INTERVAL].add(client)
+        if state["acknowledge"]:
+            self.inputs[client.fd] = client
+        if state["correct"]:
+            self.corrections[client.fd] = client
+        self.joined[client.fd] = client
+        # L'ancienne zone garde un fantôme du player, qu'on lui fera retirer quand il s'éloignera
+        self.published[id_client] = set([origin])
+        if client.outbuf:
+            self.handle_write(client)
+
+    # Transmet un client à la zone où son player vient d'entrer
+    def hand_off(self, client, zone):
+        player = client.player
+        fd     = client.fd
+        state  = {
+            "player": (player.id_client, player.x, player.y, player.direction, player.placed),
+            "address": client.address,
+            "codec": client.codec.name,
+            "version": getattr(client.codec, "version", None),
+            "decoder": client.decoder,
+            "delta": client.delta,
+            "outbuf": client.outbuf,
+            "known": client.known,
+            "input_seq": client.input_seq,
+            # Le crédit de déplacement suit le client, sans quoi il suffirait de passer d'une zone à l'autre pour
+            # le remettre à plein. Son âge est transmis en ticks, les compteurs des zones n'étant pas synchronisés.
+            "move_credit": client.move_credit,
+            "credit_age": self.tick_count - client.credit_tick,
+            # Les changements retenus sont transmis sous forme d'états, les players restent dans cette zone
+            "backlog": dict((id_backlog, None if other is None else (other.x, other.y, other.direction))
+                            for id_backlog, other in client.backlog.iteritems()),
+            "keyframe_due": client.keyframe_due,
+            "acknowledge": fd in self.inputs,
+            "correct": fd in self.corrections,
+        }
+        # La socket est dupliquée : la copie reste ouverte jusqu'à sa transmission
+        self.send_peer(zone, ("handoff", state), os.dup(fd))
+
+        # Le client quitte la zone sans que son départ soit annoncé : il y reste visible comme fantôme
+        client.connected = False
+        self.poller.unregister(fd)
+        del self.clients[fd]
+        del self.owned[player.id_client]
+        joined = self.joined.pop(fd, None) is not None
+        for pending in (self.moved, self.inputs, self.corrections, self.handshaking, self.blocked, self.backlogged):
+            pending.pop(fd, None)
+        if client.delta is not None:
+            self.keyframes[player.id_client % KEYFRAME_INTERVAL].discard(client)
+        client.sock.close()
+
+        ghost = self.ghosts[player.id_client] = Ghost(player)
+        cell  = None if joined else self.grid.remove(client)
+        if cell is None:
+            self.joined[ghost.fd] = ghost
+        else:
+            # Le fantôme reprend la cellule du client : le tick verra s'il en a changé et préviendra ceux qui ne le voient plus
+            self.grid.insert(ghost, cell[0] * self.grid.cell_width, cell[1] * self.grid.cell_height)
+            self.moved[ghost.fd] = ghost
+        # Les autres zones voisines n'ont plus à montrer ce player, la nouvelle zone s'en chargera
+        for other in self.published.pop(player.id_client, ()):
+            if other != zone:
+                self.send_peer(other, ("ghosts", [("unghost", player.id_client)]))
+
+    # Retire un fantôme ; son départ n'est annoncé aux clients qui le voyaient que si announce est vrai
+    def forget(self, ghost, announce=True):
+        joined = self.joined.pop(ghost.fd, None) is not None
+        self.moved.pop(ghost.fd, None)
+        cell = None if joined else self.grid.remove(ghost)
+        if announce and cell is not None:
+            self.departed.append((ghost.player.id_client, cell))
+
+    # Annonce immédiatement à un client le départ d'un player de sa zone d'intérêt
+    def send_leave(self, client, id_client):
+        if client.delta is not None:
+            self.send_delta(client, {id_client: None}, False)
+        else:
+            self.send(client, client.codec.snapshot([], [client.codec.leave(id_client)]))
+
+    # Met à jour les fantômes des players proches de la frontière d'une zone voisine
+    def on_ghosts(self, messages):
+        for message in messages:
+            id_client = message[1]
+            if id_client in self.owned:
+                continue
+            if message[0] == "unghost":
+                ghost = self.ghosts.pop(id_client, None)
+                if ghost is not None:
+                    self.forget(ghost)
+                continue
+            ghost = self.ghosts.get(id_client)
+            if ghost is None:
+                ghost = self.ghosts[id_client] = Ghost(Player(id_client))
+                self.joined[ghost.fd] = ghost
+            elif ghost.fd not in self.joined:
+                self.moved[ghost.fd] = ghost
+            ghost.player.update(message[2:])
+
+    # Un player placé hors de la zone est transmis à la zone correspondante
+    def handle_read(self, client):
+        GameServer.handle_read(self, client)
+        if client.connected and client.player.placed:
+            zone = self.zone_of(client.player.x)
+            if zone != self.zone:
+                self.hand_off(client, zone)
+
+    def disconnect(self, client):
+        GameServer.disconnect(self, client)
+        self.owned.pop(client.player.id_client, None)
+
+    def tick(self):
+        movers   = [client for client in self.moved.values() + self.joined.values() if client.connected]
+        departed = [id_client for id_client, cell in self.departed]
+        GameServer.tick(self)
+        self.publish(movers, departed)
+
+    # Envoie aux zones voisines les changements des players locaux proches de leur frontière
+    def publish(self, movers, departed):
+        messages = dict() # zone -> messages à lui envoyer
+        for client in movers:
+            player = client.player
+            if not (client.connected and player.placed):
+                continue
+            id_client = player.id_client
+            targets   = set(zone for zone in self.neighbours if self.near(player.x, zone))
+            for zone in targets:
+                messages.setdefault(zone, []).append(("ghost", id_client, player.x, player.y, player.direction))
+            for zone in self.published.get(id_client, set()).difference(targets):
+                messages.setdefault(zone, []).append(("unghost", id_client))
+            if targets:
+                self.published[id_client] = targets
+            else:
+                self.published.pop(id_client, None)
+        for id_client in departed:
+            for zone in self.published.pop(id_client, ()):
+                messages.setdefault(zone, []).append(("unghost", id_client))
+        for zone, updates in messages.iteritems():
+            self.send_peer(zone, ("ghosts", updates))
+
+
+def run_zone(port, zone, zones, gateway, peers, tick_rate, map_file, gateway_ends):
+    # Seule la passerelle doit garder ses extrémités des connexions, pour que sa fin soit vue par les zones
+    for conn in gateway_ends:
+        conn.close()
+    ZoneServer(port, zone, zones, gateway, peers, tick_rate, map_file).run()
+
+
+# Passerelle : accepte les connexions et les répartit à tour de rôle entre les zones, qui transmettent
+# ensuite chaque player à la zone correspondant à sa position dès qu'il l'a envoyée
+class Gateway :
+
+    def __init__(self, port, zones, tick_rate=TICK_RATE, map_file=MAP_FILE):
+        self.port      = port
+        self.tick_rate = tick_rate
+        self.map_file  = map_file
+        self.sock      = None
+        self.workers   = [] # (Connection, Process) de chaque zone
+        self.next      = 0
+
+        # L'index de la carte est construit une seule fois, avant que les zones ne l'ouvrent
+        index = load_map(map_file)
+        width = index.width
+        index.close()
+        # Une zone plus étroite que la marge des fantômes ne verrait pas au-delà de sa voisine
+        self.zones = max(1, min(zones, width // GHOST_MARGIN))
+        if self.zones != zones:
+            print("--A {} tiles wide map is split in {} zones--".format(width, self.zones))
+
+    def start(self):
+        peers = [dict() for zone in xrange(self.zones)]
+        for zone in xrange(self.zones):
+            for other in xrange(zone + 1, self.zones):
+                peers[zone][other], peers[other][zone] = multiprocessing.Pipe()
+        pipes = [multiprocessing.Pipe() for zone in xrange(self.zones)]
+        gateway_ends = [conn for conn, gateway in pipes]
+        for zone, (conn, gateway) in enumerate(pipes):
+            process = multiprocessing.Process(target=run_zone, args=(
+                self.port, zone, self.zones, gateway, peers[zone], self.tick_rate, self.map_file, gateway_ends))
+            process.daemon = True
+            process.start()
+            self.workers.append((conn, process))
+
+    def run(self):
+        # SIGTERM arrête la passerelle comme un Ctrl-C, et les zones avec elle
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.start()
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.sock.bind(("", self.port))
+        self.sock.listen(9999)
+        print("--Gateway running on port {} with {} zones--\n".format(self.port, self.zones))
+        try:
+            while True:
+                try:
+                    sock, address = self.sock.accept()
+                except error as e:
+                    # Un client parti pendant l'accept ne concerne que lui
+                    if e.args[0] in WOULDBLOCK or e.args[0] in (errno.ECONNABORTED, errno.EPROTO):
+                        continue
+                    if e.args[0] not in RESOURCE_ERRORS:
+                        raise
+                    print(u"Cannot accept connections : {}".format(e))
+                    time.sleep(ACCEPT_BACKOFF)
+                    continue
+                sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+                conn, process = self.workers[self.next]
+                self.next = (self.next + 1) % self.zones
+                conn.send(("connect", address))
+                reduction.send_handle(conn, sock.fileno(), process.pid)
+                sock.close()
+        finally:
+            for conn, process in self.workers:
+                process.terminate()
+
+
+if __name__ == '__main__':
+
+    port      = int(sys.argv[1]) if len(sys.argv) > 1 else 8004
+    zones     = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+    tick_rate = float(sys.argv[3]) if len(sys.argv) > 3 else TICK_RATE
+    map_file  = sys.argv[4] if len(sys.argv) > 4 else MAP_FILE
+    Gateway(port, zones, tick_rate, map_file).run()
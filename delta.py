@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# Compression des snapshots par deltas (protocole binaire version 2).
+#
+# Le serveur conserve pour chaque client le dernier état que celui-ci a acquitté (baseline) et ne lui envoie
+# que les champs ayant changé depuis. Le client acquitte chaque DELTA reçu, ce qui fait avancer sa baseline.
+# Une trame clé (keyframe) contenant tout l'état visible est envoyée périodiquement pour permettre de
+# repartir de zéro.
+#
+# Trame DELTA : numéro, numéro de la baseline, drapeaux, nombre de records, nombre de départs,
+#               puis les records (identifiant, masque, champs présents dans le masque) et les identifiants partis.
+# Trame ACK   : numéro du DELTA acquitté.
+
+import struct
+
+from protocol import frame, MSG_DELTA, PLAYER_ID, ProtocolError
+
+DELTA_HEADER = struct.Struct("!IIBHH") # numéro, baseline, drapeaux, records, départs
+ENTRY        = struct.Struct("!IB")    # identifiant, masque des champs présents
+COORDINATE   = struct.Struct("!h")
+DIRECTION    = struct.Struct("!B")
+
+# Champs d'un état (x, y, code de direction) et leur bit dans le masque
+FIELDS = ((1, COORDINATE), (2, COORDINATE), (4, DIRECTION))
+ALL_FIELDS = 7
+
+FLAG_KEYFRAME = 1 # L'état est complet et ne dépend d'aucune baseline
+FLAG_MORE     = 2 # La suite de ce DELTA est dans la trame suivante
+
+# Nombre de ticks entre deux keyframes
+KEYFRAME_INTERVAL = 100
+
+# Nombre maximal de DELTA non acquittés conservés pour un client. Au-delà, le client (qui n'acquitte plus, ou avec
+# trop de retard) repart d'une keyframe et l'historique est vidé.
+MAX_UNACKED = KEYFRAME_INTERVAL
+
+# Taille maximale des records d'une trame
+MAX_PAYLOAD = 0xFFFF - 1 - DELTA_HEADER.size
+
+
+def encode_entry(id_client, state, base):
+    mask   = ALL_FIELDS
+    fields = []
+    if base is not None:
+        mask = 0
+    for index, (bit, field) in enumerate(FIELDS):
+        if base is None or state[index] != base[index]:
+            mask |= bit
+            fields.append(field.pack(state[index]))
+    return ENTRY.pack(id_client, mask) + "".join(fields)
+
+
+# Côté serveur : état du delta d'un client
+class DeltaEncoder :
+
+    def __init__(self):
+        self.seq      = 0      # numéro du dernier DELTA envoyé
+        self.base_seq = 0      # numéro du dernier DELTA acquitté
+        self.baseline = dict() # identifiant -> état acquitté par le client
+        self.view     = dict() # identifiant -> état courant visible par le client
+        self.sent     = []     # (numéro, vue complète au moment de l'envoi) des DELTA non acquittés
+        self.unacked  = dict() # identifiant -> numéro du dernier DELTA envoyé après un changement du player
+        self.dirty    = False  # La vue a changé depuis le dernier DELTA envoyé
+
+    # Applique les changements du tick : identifiant -> (x, y, direction) ou None si le player n'est plus visible
+    def update(self, changes):
+        for id_client, state in changes.iteritems():
+            if self.view.get(id_client) == state:
+                continue
+            self.dirty = True
+            if state is None:
+                del self.view[id_client]
+            else:
+                self.view[id_client] = state
+
+    # Retourne les trames du DELTA à envoyer, ou "" si la vue n'a pas changé depuis le dernier envoi.
+    # Le DELTA peut être vide : le client revient alors simplement à sa baseline.
+    # Avec resend, un DELTA est envoyé tant que des changements ne sont pas acquittés, pour les canaux
+    # qui peuvent perdre des trames.
+    def encode(self, candidates, keyframe=False, resend=False):
+        if not (self.dirty or keyframe or (resend and self.unacked)):
+            return ""
+        self.dirty = False
+        self.seq  += 1
+        if len(self.sent) >= MAX_UNACKED:
+            self.sent = []
+            keyframe  = True
+        # Seuls les players modifiés depuis la baseline peuvent en différer
+        for id_client in candidates:
+            self.unacked[id_client] = self.seq
+
+        if keyframe:
+            delta = dict(self.view)
+            base_seq, baseline = 0, dict()
+        else:
+            delta = dict()
+            for id_client in self.unacked:
+                state = self.view.get(id_client)
+                if state != self.baseline.get(id_client):
+                    delta[id_client] = state
+            base_seq, baseline = self.base_seq, self.baseline
+        self.sent.append((self.seq, dict(self.view)))
+
+        entries = []
+        leaves  = []
+        for id_client, state in delta.iteritems():
+            if state is None:
+                leaves.append(PLAYER_ID.pack(id_client))
+            else:
+                entries.append(encode_entry(id_client, state, baseline.get(id_client)))
+        return self.frames(base_seq, FLAG_KEYFRAME if keyframe else 0, entries, leaves)
+
+    # Découpe le DELTA en trames ne dépassant pas la taille maximale
+    def frames(self, base_seq, flags, entries, leaves):
+        frames = []
+        while True:
+            size, count = 0, 0
+            while count < len(entries) and size + len(entries[count]) <= MAX_PAYLOAD:
+                size += len(entries[count])
+                count += 1
+            removed = min(len(leaves), (MAX_PAYLOAD - size) // PLAYER_ID.size)
+            more = count < len(entries) or removed < len(leaves)
+            header = DELTA_HEADER.pack(self.seq, base_seq, flags | (FLAG_MORE if more else 0), count, removed)
+            frames.append(frame(MSG_DELTA, header + "".join(entries[:count]) + "".join(leaves[:removed])))
+            entries = entries[count:]
+            leaves  = leaves[removed:]
+            if not more:
+                return "".join(frames)
+
+    # Le client a reçu le DELTA seq : la baseline devient l'état correspondant.
+    # Un DELTA qui n'est plus dans l'historique, vidé depuis son envoi, ne peut pas servir de baseline.
+    def ack(self, seq):
+        if seq <= self.base_seq or seq > self.seq:
+            return
+        if not self.sent or self.sent[0][0] > seq:
+            return
+        while self.sent and self.sent[0][0] <= seq:
+            sent_seq, view = self.sent.pop(0)
+            if sent_seq == seq:
+                self.baseline = view
+        self.base_seq = seq
+        self.unacked  = dict((id_client, sent_seq) for id_client, sent_seq in self.unacked.iteritems() if sent_seq > seq)
+
+
+# Côté client : reconstruit l'état complet à partir des DELTA reçus
+class DeltaDecoder :
+
+    def __init__(self):
+        self.states  = {0: dict()} # numéro -> état complet, conservés tant qu'ils peuvent servir de baseline
+        self.current = dict()      # identifiant -> (x, y, direction) actuellement connu
+        self.parts   = []          # morceaux d'un DELTA découpé en plusieurs trames
+        self.seq     = 0           # numéro du dernier DELTA appliqué
+
+    # Retourne (numéro, records modifiés, identifiants partis), ou None si le DELTA n'est pas complet
+    # ou plus ancien que le dernier appliqué (reçu en retard par datagramme)
+    def feed(self, payload):
+        seq, base_seq, flags, count, removed = DELTA_HEADER.unpack_from(payload)
+        if seq <= self.seq:
+            return None
+        offset  = DELTA_HEADER.size
+        entries = []
+        for i in xrange(count):
+            id_client, mask = ENTRY.unpack_from(payload, offset)
+            offset += ENTRY.size
+            values = []
+            for bit, field in FIELDS:
+                if mask & bit:
+                    values.append(field.unpack_from(payload, offset)[0])
+                    offset += field.size
+                else:
+                    values.append(None)
+            entries.append((id_client, values))
+        leaves = struct.unpack_from("!{}I".format(removed), payload, offset)
+
+        # Les morceaux d'un DELTA dépassé par un plus récent sont abandonnés
+        if self.parts and self.parts[0][0] != seq:
+            self.parts = []
+        self.parts.append((seq, entries, leaves))
+        if flags & FLAG_MORE:
+            return None
+        parts, self.parts = self.parts, []
+
+        if flags & FLAG_KEYFRAME:
+            base = dict()
+        elif base_seq in self.states:
+            base = self.states[base_seq]
+        else:
+            raise ProtocolError("Unknown baseline {}".format(base_seq))
+
+        state = dict(base)
+        for part_seq, entries, leaves in parts:
+            for id_client in leaves:
+                state.pop(id_client, None)
+            for id_client, values in entries:
+                previous = base.get(id_client)
+                if previous is not None:
+                    values = [previous[index] if value is None else value for index, value in enumerate(values)]
+                state[id_client] = tuple(values)
+
+        # Les états plus anciens que la baseline utilisée ne serviront plus
+        for old in [old for old in self.states if old < base_seq]:
+            del self.states[old]
+        self.states[seq] = state
+        self.seq = seq
+
+        records = [(id_client,) + values for id_client, values in state.iteritems() if self.current.get(id_client) != values]
+        leaves  = [id_client for id_client in self.current if id_client not in state]
+        self.current = state
+        return seq, records, leaves
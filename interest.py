@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Grille uniforme de gestion d'intérêt (area of interest).
+# La carte est découpée en cellules de la taille de la vue d'un client : un client ne s'intéresse
+# qu'aux players situés dans sa cellule et dans les 8 cellules voisines.
+
+# Taille par défaut d'une cellule, en tuiles, proche de la fenêtre Kivy par défaut (800x600 en tuiles de 32 pixels)
+CELL_WIDTH  = 25
+CELL_HEIGHT = 19
+
+
+class InterestGrid :
+
+    # Constructeur permettant l'initialisation des attributs
+    def __init__(self, cell_width=CELL_WIDTH, cell_height=CELL_HEIGHT):
+        self.cell_width  = cell_width
+        self.cell_height = cell_height
+        self.cells       = dict() # (cx, cy) -> set des objets présents dans la cellule
+        self.positions   = dict() # objet -> cellule courante
+
+    # Retourne la cellule contenant les coordonnées en tuiles (x, y)
+    def cell_of(self, x, y):
+        return (int(x) // self.cell_width, int(y) // self.cell_height)
+
+    # Retourne les 9 cellules formant la zone d'intérêt autour d'une cellule
+    def area(self, cell):
+        cx, cy = cell
+        return [(cx + dx, cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+    # Ajoute un objet à la grille et retourne sa cellule
+    def insert(self, item, x, y):
+        cell = self.cell_of(x, y)
+        self.cells.setdefault(cell, set()).add(item)
+        self.positions[item] = cell
+        return cell
+
+    # Déplace un objet, retourne son ancienne cellule
+    def move(self, item, x, y):
+        old  = self.positions[item]
+        cell = self.cell_of(x, y)
+        if cell != old:
+            self._discard(item, old)
+            self.cells.setdefault(cell, set()).add(item)
+            self.positions[item] = cell
+        return old
+
+    # Retire un objet de la grille, retourne sa dernière cellule
+    def remove(self, item):
+        cell = self.positions.pop(item, None)
+        if cell is not None:
+            self._discard(item, cell)
+        return cell
+
+    def _discard(self, item, cell):
+        members = self.cells[cell]
+        members.discard(item)
+        if not members:
+            del self.cells[cell]
+
+    # Itère sur tous les objets dont la cellule est dans la zone d'intérêt de cell
+    def around(self, cell):
+        for neighbour in self.area(cell):
+            members = self.cells.get(neighbour)
+            if members:
+                for item in members:
+                    yield item
+
+    def __contains__(self, item):
+        return item in self.positions
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Instrumentation du serveur : compteurs, jauges et histogrammes, exposés au format texte de Prometheus
+# sur un petit serveur HTTP local (thread séparé), et journalisation échantillonnée.
+#
+# Désactivée, l'instrumentation est remplacée par NULL_METRICS dont les instruments ne font rien : le coût
+# se limite à un appel de méthode vide par évènement réseau (et non par message) et par tick.
+
+import threading
+import time
+from bisect import bisect_left
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+# Bornes par défaut des histogrammes de durée, en secondes
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+# Bornes par défaut des histogrammes de taille, en octets
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# Intervalle minimal, en secondes, entre deux lignes de journal d'une même catégorie
+LOG_INTERVAL = 1.0
+
+
+class Counter :
+    def __init__(self, name, help):
+        self.name  = name
+        self.help  = help
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def render(self):
+        return ["# TYPE {} counter".format(self.name), "{} {}".format(self.name, self.value)]
+
+
+# Valeur lue au moment de l'export, la fonction est appelée depuis le thread HTTP
+class Gauge :
+    def __init__(self, name, help, function):
+        self.name     = name
+        self.help     = help
+        self.function = function
+
+    def render(self):
+        return ["# TYPE {} gauge".format(self.name), "{} {}".format(self.name, self.function())]
+
+
+# Répartition des observations dans des seaux cumulés à l'export, comme le veut le format de Prometheus
+class Histogram :
+    def __init__(self, name, help, buckets):
+        self.name    = name
+        self.help    = help
+        self.buckets = tuple(buckets)
+        self.counts  = [0] * (len(self.buckets) + 1) # Le dernier seau reçoit ce qui dépasse la plus grande borne
+        self.sum     = 0
+        self.count   = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def render(self):
+        lines = ["# TYPE {} histogram".format(self.name)]
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, total))
+        lines.append("{}_sum {}".format(self.name, self.sum))
+        lines.append("{}_count {}".format(self.name, self.count))
+        return lines
+
+
+# Instruments inactifs, partagés par tous les utilisateurs de NULL_METRICS
+class NullInstrument :
+    value = 0
+
+    def inc(self, value=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+NULL_INSTRUMENT = NullInstrument()
+
+
+# Registre des instruments d'un processus
+class Metrics :
+    enabled = True
+
+    def __init__(self, prefix="kog_"):
+        self.prefix      = prefix
+        self.instruments = []
+
+    def add(self, instrument):
+        self.instruments.append(instrument)
+        return instrument
+
+    def counter(self, name, help=""):
+        return self.add(Counter(self.prefix + name, help))
+
+    def gauge(self, name, function, help=""):
+        return self.add(Gauge(self.prefix + name, help, function))
+
+    def histogram(self, name, buckets=TIME_BUCKETS, help=""):
+        return self.add(Histogram(self.prefix + name, help, buckets))
+
+    # Export au format texte de Prometheus
+    def render(self):
+        lines = []
+        for instrument in self.instruments:
+            if instrument.help:
+                lines.append("# HELP {} {}".format(instrument.name, instrument.help))
+            lines.extend(instrument.render())
+        return "\n".join(lines) + "\n"
+
+
+# Registre de l'instrumentation désactivée
+class NullMetrics :
+    enabled = False
+
+    def counter(self, name, help=""):
+        return NULL_INSTRUMENT
+
+    def gauge(self, name, function, help=""):
+        return NULL_INSTRUMENT
+
+    def histogram(self, name, buckets=TIME_BUCKETS, help=""):
+        return NULL_INSTRUMENT
+
+    def render(self):
+        return ""
+
+NULL_METRICS = NullMetrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler) :
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Pas de ligne de journal par requête
+    def log_message(self, format, *args):
+        pass
+
+
+# Sert l'export des métriques sur http://127.0.0.1:port/metrics depuis un thread démon.
+# Les instruments ne sont modifiés que par la boucle du serveur, le thread HTTP se contente de les lire.
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    server = HTTPServer((host, port), MetricsHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# Journal limité à une ligne par catégorie et par intervalle : les lignes suivantes sont seulement comptées
+# et leur nombre est rappelé sur la prochaine ligne affichée
+class SampledLog :
+    def __init__(self, interval=LOG_INTERVAL):
+        self.interval   = interval
+        self.next_time  = dict() # catégorie -> date à partir de laquelle une ligne peut être affichée
+        self.suppressed = dict() # catégorie -> nombre de lignes non affichées depuis la dernière
+
+    def log(self, category, message):
+        now = time.time()
+        if now < self.next_time.get(category, 0):
+            self.suppressed[category] = self.suppressed.get(category, 0) + 1
+            return
+        self.next_time[category] = now + self.interval
+        suppressed = self.suppressed.pop(category, 0)
+        if suppressed:
+            message = u"{} ({} similar lines suppressed)".format(message, suppressed)
+        print(message)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+# Règles de déplacement d'un player, partagées par le client, qui prédit ses déplacements,
+# et par le serveur, qui les applique avec autorité.
+
+# Vitesse maximale d'un player, en tuiles par seconde, et nombre de déplacements pouvant être faits d'affilée
+MAX_MOVE_RATE = 10
+MOVE_BURST    = 3
+
+# Déplacements d'affilée que s'autorise un client qui prédit les siens : un de moins que le serveur, pour que
+# les messages rapprochés par le réseau restent acceptés
+PREDICTED_BURST = MOVE_BURST - 1
+
+# Décalage d'une tuile dans chaque direction
+OFFSETS = {
+    "up": (0, -1),
+    "down": (0, 1),
+    "left": (-1, 0),
+    "right": (1, 0),
+}
+
+
+# Applique une touche de direction à l'état (x, y, direction) d'un player et retourne son nouvel état.
+# Une touche dans une autre direction que celle du player le fait seulement tourner, sinon il avance
+# d'une tuile si walkable(x, y) l'accepte.
+def step(x, y, direction, key, walkable):
+    if key != direction:
+        return x, y, key
+    dx, dy = OFFSETS[key]
+    if walkable(x + dx, y + dy):
+        return x + dx, y + dy, direction
+    return x, y, direction
+
+
+# Consomme un déplacement du crédit d'un player, regagné à MAX_MOVE_RATE tuiles par seconde jusqu'à burst.
+# elapsed est le temps écoulé, en secondes, depuis le calcul de ce crédit. Retourne le nouveau crédit et
+# si le déplacement est permis. Seuls les changements de tuile sont comptés, pas les demi-tours sur place.
+def spend(credit, elapsed, burst=MOVE_BURST):
+    credit = min(burst, credit + elapsed * MAX_MOVE_RATE)
+    if credit < 1:
+        return credit, False
+    return credit - 1, True
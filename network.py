@@ -0,0 +1,279 @@
+"""Connection to the game server, without any Kivy dependency.
+
+The receiving thread blocks in select() instead of spinning on a non-blocking
+recv, decodes complete messages and puts the resulting player updates in a
+queue. The main thread drains that queue once per frame.
+
+The connection itself is made by that thread too, so the UI never waits for
+the server: what is sent before the connection is up is queued and written
+just after the HELLO.
+
+With protocol v5, the server keeps our player (id and position) in a session,
+resumed with its token when we connect again.
+
+With protocol v4, the deltas can also come by UDP, from the server's port:
+once the datagram channel works both ways, a lost packet no longer delays
+the following positions behind its retransmission.
+"""
+import errno
+import json
+import select
+import socket
+import struct
+import time
+from Queue import Queue, Empty
+from threading import Thread, Lock
+
+import protocol
+from delta import DeltaDecoder
+
+RECV_SIZE = 65536
+BIND_INTERVAL = 1.0  #Seconds between two BIND datagrams, until the server sends one back
+CONNECT_TIMEOUT = 5.0  #Seconds to wait for the server before playing offline
+#What a malformed message of the server raises while it is decoded
+DECODE_ERRORS = (protocol.ProtocolError, struct.error, ValueError, IndexError, TypeError)
+
+
+class ServerConnection(Thread):
+    """Thread to listen to the server for update of online players.
+
+    Updates are queued as ('update', id, x, y, direction, reception time) or
+    ('remove', id),
+    and the position the server kept after rejecting one of our moves as
+    ('correct', x, y, direction). With protocol v3, the state resulting from
+    the last input processed by the server is queued as
+    ('state', input seq, x, y, direction).
+    """
+    runThread    = True
+    sock         = None
+    online       = True   #False once the connection failed or was closed, read it live
+    connected    = False  #Is the connection up ? Until then, what we send is queued
+    binary       = True   #Use the binary protocol instead of the legacy JSON one
+    id_client    = None   #Our player id, sent by the server with the binary protocol
+    inputs       = False  #Does the server apply our inputs (protocol v3) ?
+    poll_timeout = 0.5    #How often a silent connection checks if it must stop
+    udp          = None   #Socket of the datagram channel, if we asked for one
+    token        = None   #Token of the datagram channel, sent by the server
+    channel      = False  #Do the deltas come by datagrams ?
+    next_bind    = 0
+    session      = None   #Token of our session, to get our player back on the next connection
+
+    def __init__(self, host, port, binary=True, udp=False, session=None):
+        Thread.__init__(self)
+        self.daemon  = True
+        self.host    = host
+        self.port    = port
+        self.binary  = binary
+        self.session = session
+        self.decoder = protocol.FrameDecoder() if binary else protocol.JsonDecoder()
+        self.deltas  = DeltaDecoder()
+        self.lock    = Lock()     #Moves are sent from the UI thread and acks from this one
+        self.updates = Queue()
+        self.outbox  = []         #Data sent before the connection is up
+        self.use_udp = udp
+        self.sock    = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    def connect(self):
+        """Connects to the server from this thread, then sends the HELLO and the queued data.
+        :return: Boolean telling whether the server could be reached."""
+        try:
+            self.sock.settimeout(CONNECT_TIMEOUT)
+            self.sock.connect((self.host, self.port))
+            self.sock.settimeout(None)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.binary and self.use_udp:
+                self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.udp.connect((self.host, self.port))
+            with self.lock:
+                hello = protocol.HELLO if self.binary else ""
+                self.sock.sendall(hello + "".join(self.outbox))
+                self.outbox    = []
+                self.connected = True
+        except socket.error, e:
+            if self.runThread:
+                self.log("Listener: Cannot reach the server ({}), playing offline".format(e))
+            self.online = False
+            self.outbox = []
+            return False
+        self.log("Listener: Connected to {}:{}".format(self.host, self.port))
+        return True
+
+    def log(self, message):
+        pass
+
+    def on_session(self, token):
+        """Called from this thread with the token of our session, to keep it for the next connection."""
+        pass
+
+    def send(self, data):
+        """Sends data to the server, or queues it until the connection is up.
+        Once the connection is lost, we play offline and the data is dropped."""
+        with self.lock:
+            if self.connected:
+                try:
+                    self.sock.sendall(data)
+                except socket.error, e:
+                    self.connected = False
+                    self.online    = False
+                    self.log("Listener: Connection lost while sending ({}), playing offline".format(e))
+            elif self.online:
+                self.outbox.append(data)
+
+    def send_move(self, x, y, direction):
+        self.send(protocol.encode_move(self.binary, x, y, direction))
+
+    def send_input(self, seq, key):
+        self.send(protocol.encode_input(seq, key))
+
+    def send_leave(self):
+        self.send(protocol.encode_leave(self.binary))
+
+    def bind(self):
+        """Sends our token by datagram, the server sends it back once it knows our address."""
+        self.next_bind = time.time() + BIND_INTERVAL
+        try:
+            self.udp.send(protocol.encode_bind(self.id_client, self.token))
+        except socket.error:
+            pass
+
+    def close(self):
+        self.runThread = False
+        self.sock.close()
+        if self.udp is not None:
+            self.udp.close()
+
+    def run(self):
+        if not self.connect():
+            return
+        sockets = [self.sock] if self.udp is None else [self.sock, self.udp]
+        while self.runThread:
+            try:
+                timeout = self.poll_timeout
+                if self.token is not None and not self.channel:
+                    if time.time() >= self.next_bind:
+                        self.bind()
+                    timeout = min(timeout, max(0, self.next_bind - time.time()))
+                # we wait for a message from server without using the CPU
+                readable, _, _ = select.select(sockets, [], [], timeout)
+                if not readable:
+                    continue
+                if self.udp in readable:
+                    self.read_datagram()
+                    if self.sock not in readable:
+                        continue
+                data = self.sock.recv(RECV_SIZE)
+            except (socket.error, select.error), e:
+                if not self.runThread:
+                    break
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    continue
+                # a "real" error occurred
+                self.log("Listener: Connection error {}".format(e))
+                break
+
+            if not data:
+                self.log("Listener: Connection closed by the server")
+                break
+            try:
+                self.receive(data)
+            except DECODE_ERRORS, e:
+                self.log("Listener: Invalid message from the server ({}), disconnecting".format(e))
+                break
+
+        # nothing more is sent on this connection, the game goes on offline
+        with self.lock:
+            self.connected = False
+            self.online    = False
+        self.sock.close()
+        self.log("Listener: Closing thread")
+
+    def receive(self, data):
+        """Decodes the received data, keeping incomplete messages for the next read."""
+        received = time.time()
+        if not self.binary:
+            for message in self.decoder.feed(data):
+                player = json.loads(message)
+                if len(player) > 0:
+                    #If the player just disconnected
+                    if (player[1], player[2]) == protocol.LEAVE_COORDINATES:
+                        self.updates.put(('remove', player[0]))
+                    else:
+                        self.updates.put(('update',) + tuple(player[:4]) + (received,))
+            return
+
+        for msg_type, payload in self.decoder.feed(data):
+            self.receive_frame(msg_type, payload, received)
+
+    def read_datagram(self):
+        try:
+            data = self.udp.recv(RECV_SIZE)
+        except socket.error:
+            return  #the server's port refused a previous datagram, TCP still works
+        try:
+            self.receive_datagram(data)
+        except DECODE_ERRORS:
+            pass    #a damaged datagram is lost like any other
+
+    def receive_datagram(self, data):
+        """Decodes a datagram of the server : one frame, possibly late or duplicated."""
+        try:
+            msg_type, payload = protocol.decode_datagram(data)
+        except protocol.ProtocolError:
+            return
+        if msg_type == protocol.MSG_BIND:
+            if not self.channel:
+                # the channel works both ways, the server can send us the deltas by datagrams
+                self.channel = True
+                self.send(protocol.encode_bind(self.id_client, self.token))
+                self.log("Listener: Receiving the deltas by datagrams")
+        elif msg_type == protocol.MSG_DELTA:
+            self.receive_frame(msg_type, payload, time.time())
+
+    def receive_frame(self, msg_type, payload, received):
+        """Handles one frame of the server, received by TCP or by datagram."""
+        if msg_type == protocol.MSG_WELCOME:
+            version, self.id_client = protocol.WELCOME.unpack(payload)
+            self.inputs = version >= 3
+            self.log("Listener: Joined as player {} (protocol v{})".format(self.id_client, version))
+            if version >= 5:
+                self.send(protocol.encode_resume(self.session))
+        elif msg_type == protocol.MSG_SESSION:
+            self.id_client, token = protocol.SESSION.unpack(payload)
+            self.log("Listener: {} session of player {}".format(
+                "Resumed the" if token == self.session else "Opened a", self.id_client))
+            self.session = token
+            self.on_session(token)
+        elif msg_type == protocol.MSG_SNAPSHOT:
+            records, leaves = protocol.decode_snapshot(payload)
+            for id_client in leaves:
+                self.updates.put(('remove', id_client))
+            for record in records:
+                self.updates.put(('update',) + record + (received,))
+        elif msg_type == protocol.MSG_DELTA:
+            delta = self.deltas.feed(payload)
+            if delta is None:
+                return
+            seq, records, leaves = delta
+            self.send(protocol.encode_ack(seq))
+            for id_client in leaves:
+                self.updates.put(('remove', id_client))
+            for id_client, x, y, code in records:
+                self.updates.put(('update', id_client, x, y, protocol.DIRECTIONS[code], received))
+        elif msg_type == protocol.MSG_CORRECTION:
+            x, y, code = protocol.MOVE.unpack(payload)
+            self.updates.put(('correct', x, y, protocol.DIRECTIONS[code]))
+        elif msg_type == protocol.MSG_STATE:
+            seq, x, y, code = protocol.STATE.unpack(payload)
+            self.updates.put(('state', seq, x, y, protocol.DIRECTIONS[code]))
+        elif msg_type == protocol.MSG_CHANNEL and self.udp is not None:
+            self.token, = protocol.CHANNEL.unpack(payload)
+            self.bind()
+
+    def drain(self):
+        """Returns every update received since the last call, without blocking."""
+        updates = []
+        while True:
+            try:
+                updates.append(self.updates.get_nowait())
+            except Empty:
+                return updates
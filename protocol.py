@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+# Protocoles réseau partagés par le client et le serveur.
+#
+# Protocole JSON historique : des tableaux JSON séparés par "|".
+#   client -> serveur : [x, y, direction]        ([99, 99, "down"] pour se déconnecter)
+#   serveur -> client : [id, x, y, direction]    ([id, 99, 99, "down"] quand le player disparaît)
+#
+# Protocole binaire : le client ouvre la connexion par HELLO (MAGIC + version), puis chaque trame est
+# préfixée par sa longueur sur 2 octets, suivie d'un octet de type :
+#   WELCOME  (serveur) : version retenue (la plus petite des deux), identifiant du player
+#   SNAPSHOT (serveur) : nombre de records, nombre de départs, records (id, x, y, direction), identifiants partis
+#   DELTA    (serveur) : à partir de la version 2, remplace SNAPSHOT (voir delta.py)
+#   CORRECTION (serveur) : position x, y, direction retenue par le serveur après un déplacement refusé
+#   STATE    (serveur) : à partir de la version 3, dernier INPUT traité et état x, y, direction qui en résulte
+#   MOVE     (client)  : x, y, direction
+#   LEAVE    (client)  : déconnexion
+#   ACK      (client)  : à partir de la version 2, acquittement d'un DELTA
+#   INPUT    (client)  : à partir de la version 3, touche de direction numérotée, appliquée par le serveur (voir movement.py)
+#   CHANNEL  (serveur) : à partir de la version 4, jeton permettant d'ouvrir le canal de datagrammes
+#   BIND     (client)  : identifiant et jeton, envoyés en datagramme UDP vers le port du serveur qui les renvoie
+#                        au client, puis sur la connexion TCP pour confirmer que le canal fonctionne dans les deux sens
+#   RESUME   (client)  : à partir de la version 5, envoyé en réponse à WELCOME : jeton d'une session précédente,
+#                        vide pour en ouvrir une nouvelle (voir sessions.py)
+#   SESSION  (serveur) : identifiant et jeton de la session ; l'identifiant remplace celui de WELCOME
+#
+# Une fois le canal confirmé, les DELTA tenant dans un datagramme (une trame par datagramme) sont envoyés en UDP :
+# ils ne sont plus retardés par les pertes qui bloquent le flux TCP. Un DELTA perdu n'est pas acquitté, le suivant
+# repart de la même baseline ; le client ignore les DELTA plus anciens que le dernier appliqué.
+
+import json
+import struct
+
+DELIMITER = "|"
+
+MAGIC   = "KOG"
+VERSION = 5
+HELLO   = MAGIC + chr(VERSION)
+
+# Directions codées sur un octet, dans l'ordre de leur index
+DIRECTIONS      = ("down", "up", "left", "right")
+DIRECTION_CODES = dict((direction, code) for code, direction in enumerate(DIRECTIONS))
+
+# Types de trames
+MSG_WELCOME  = 1
+MSG_SNAPSHOT = 2
+MSG_MOVE     = 3
+MSG_LEAVE    = 4
+MSG_DELTA    = 5
+MSG_ACK      = 6
+MSG_CORRECTION = 7
+MSG_INPUT    = 8
+MSG_STATE    = 9
+MSG_CHANNEL  = 10
+MSG_BIND     = 11
+MSG_RESUME   = 12
+MSG_SESSION  = 13
+
+FRAME_HEADER    = struct.Struct("!HB")   # longueur (type compris), type
+WELCOME         = struct.Struct("!BI")   # version, identifiant
+SNAPSHOT_HEADER = struct.Struct("!HH")   # nombre de records, nombre de départs
+RECORD          = struct.Struct("!IhhB") # identifiant, x, y, direction
+PLAYER_ID       = struct.Struct("!I")
+MOVE            = struct.Struct("!hhB")  # x, y, direction
+ACK             = struct.Struct("!I")    # numéro du DELTA acquitté
+INPUT           = struct.Struct("!IB")   # numéro de l'input, direction de la touche
+STATE           = struct.Struct("!IhhB") # numéro du dernier input traité, x, y, direction
+CHANNEL         = struct.Struct("!Q")    # jeton du canal de datagrammes
+BIND            = struct.Struct("!IQ")   # identifiant, jeton
+SESSION         = struct.Struct("!I16s") # identifiant, jeton de session
+
+# Taille maximale du contenu d'une trame, et nombre de records qu'elle peut contenir
+MAX_PAYLOAD = 0xFFFF - 1 - SNAPSHOT_HEADER.size
+MAX_RECORDS = MAX_PAYLOAD // RECORD.size
+
+# Taille maximale d'un message reçu d'un client par le serveur, bien au-delà du plus long message valide.
+# Un client qui envoie plus sans terminer son message est déconnecté.
+MAX_MESSAGE = 256
+
+# Taille maximale d'un datagramme, pour qu'il ne soit pas fragmenté par le réseau
+MAX_DATAGRAM = 1200
+
+# Coordonnées annonçant le départ d'un player dans le protocole JSON
+LEAVE_COORDINATES = (99, 99)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def frame(msg_type, payload=""):
+    return FRAME_HEADER.pack(len(payload) + 1, msg_type) + payload
+
+
+def direction_code(direction):
+    return DIRECTION_CODES.get(direction, 0)
+
+
+# Retourne la trame (type, contenu) contenue dans un datagramme
+def decode_datagram(data):
+    if len(data) <= FRAME_HEADER.size:
+        raise ProtocolError("Datagram too short")
+    length, msg_type = FRAME_HEADER.unpack_from(data)
+    if length + 2 != len(data):
+        raise ProtocolError("Datagram length mismatch")
+    return msg_type, data[FRAME_HEADER.size:]
+
+
+# Découpe un flux JSON en messages complets, en conservant les messages incomplets entre deux lectures.
+# Un message incomplet plus long que max_size lève ProtocolError.
+class JsonDecoder :
+    def __init__(self, max_size=None):
+        self.buffer   = ""
+        self.max_size = max_size
+
+    def feed(self, data):
+        # Le tampon ne contient jamais de délimiteur : seules les nouvelles données sont parcourues
+        if DELIMITER not in data:
+            self.buffer += data
+            messages = []
+        else:
+            messages = (self.buffer + data).split(DELIMITER)
+            self.buffer = messages.pop() # Le dernier morceau est un message incomplet
+        if self.max_size is not None and len(self.buffer) > self.max_size:
+            raise ProtocolError("Message longer than {} bytes".format(self.max_size))
+        return [message for message in messages if len(message) > 0]
+
+
+# Découpe un flux binaire en trames (type, contenu), en conservant les trames incomplètes.
+# Une trame annoncée plus longue que max_length lève ProtocolError.
+class FrameDecoder :
+    def __init__(self, max_length=None):
+        self.buffer     = ""
+        self.max_length = max_length
+
+    def feed(self, data):
+        buf = self.buffer + data if self.buffer else data
+        frames = []
+        offset = 0
+        size   = len(buf)
+        while size - offset >= FRAME_HEADER.size:
+            length, msg_type = FRAME_HEADER.unpack_from(buf, offset)
+            end = offset + 2 + length
+            if length == 0:
+                raise ProtocolError("Empty frame")
+            if self.max_length is not None and length > self.max_length:
+                raise ProtocolError("Frame longer than {} bytes".format(self.max_length))
+            if end > size:
+                break
+            frames.append((msg_type, buf[offset + FRAME_HEADER.size:end]))
+            offset = end
+        self.buffer = buf[offset:]
+        return frames
+
+
+# Codec du protocole JSON historique, côté serveur
+class JsonCodec :
+    name = "json"
+
+    def decoder(self):
+        return JsonDecoder(MAX_MESSAGE)
+
+    # Convertit les messages reçus en tuples ("move", x, y, direction) ou ("leave",).
+    # Un message illisible devient ("invalid", raison), journalisé par le serveur.
+    def messages(self, decoded):
+        result = []
+        for message in decoded:
+            try:
+                message = json.loads(message)
+            except ValueError:
+                result.append(("invalid", u"Invalid message : {!r}".format(message)))
+                continue
+            if not isinstance(message, list) or len(message) < 3:
+                result.append(("invalid", u"Malformed message : {!r}".format(message)))
+                continue
+            x, y, direction = message[:3]
+            if (x, y) == LEAVE_COORDINATES:
+                result.append(("leave",))
+            # Seuls des entiers et une direction connue peuvent atteindre la grille et la validation des déplacements
+            elif type(x) not in (int, long) or type(y) not in (int, long) or \
+                    not isinstance(direction, basestring) or direction not in DIRECTION_CODES:
+                result.append(("invalid", u"Malformed move : {!r}".format(message)))
+            else:
+                result.append(("move", x, y, str(direction)))
+        return result
+
+    def welcome(self, id_client):
+        return ""
+
+    def record(self, id_client, x, y, direction):
+        return json.dumps([id_client, x, y, direction]) + DELIMITER
+
+    def leave(self, id_client):
+        return json.dumps([id_client, LEAVE_COORDINATES[0], LEAVE_COORDINATES[1], "down"]) + DELIMITER
+
+    def snapshot(self, records, leaves):
+        return "".join(leaves) + "".join(records)
+
+    # Le protocole JSON ne permet pas au client de reconnaître sa propre position : les déplacements refusés sont ignorés
+    def correction(self, x, y, direction):
+        return ""
+
+
+# Codec du protocole binaire, côté serveur
+class BinaryCodec :
+    name = "binary"
+
+    def __init__(self, version=VERSION):
+        self.version = version
+        self.deltas  = version >= 2 # Les snapshots sont remplacés par des DELTA acquittés
+        self.inputs  = version >= 3 # Le client envoie ses touches plutôt que sa position
+        self.datagrams = version >= 4 # Les DELTA peuvent passer par un canal UDP
+        self.sessions  = version >= 5 # Le client reprend sa session avant de rejoindre le jeu
+
+    def decoder(self):
+        return FrameDecoder(MAX_MESSAGE)
+
+    def messages(self, frames):
+        result = []
+        for msg_type, payload in frames:
+            if msg_type == MSG_MOVE:
+                x, y, code = MOVE.unpack(payload)
+                result.append(("move", x, y, DIRECTIONS[code] if code < len(DIRECTIONS) else "down"))
+            elif msg_type == MSG_LEAVE:
+                result.append(("leave",))
+            elif msg_type == MSG_ACK and self.deltas:
+                result.append(("ack", ACK.unpack(payload)[0]))
+            elif msg_type == MSG_INPUT and self.inputs:
+                seq, code = INPUT.unpack(payload)
+                if code >= len(DIRECTIONS):
+                    raise ProtocolError("Unknown direction {}".format(code))
+                result.append(("input", seq, DIRECTIONS[code]))
+            elif msg_type == MSG_BIND and self.datagrams:
+                result.append(("bind",) + BIND.unpack(payload))
+            elif msg_type == MSG_RESUME and self.sessions:
+                if payload and len(payload) != SESSION.size - PLAYER_ID.size:
+                    raise ProtocolError("Invalid session token")
+                result.append(("resume", payload or None))
+            else:
+                raise ProtocolError("Unexpected frame type {}".format(msg_type))
+        return result
+
+    def welcome(self, id_client):
+        return frame(MSG_WELCOME, WELCOME.pack(self.version, id_client))
+
+    def record(self, id_client, x, y, direction):
+        return RECORD.pack(id_client, int(x), int(y), direction_code(direction))
+
+    def leave(self, id_client):
+        return PLAYER_ID.pack(id_client)
+
+    def correction(self, x, y, direction):
+        return frame(MSG_CORRECTION, MOVE.pack(int(x), int(y), direction_code(direction)))
+
+    def state(self, seq, x, y, direction):
+        return frame(MSG_STATE, STATE.pack(seq, int(x), int(y), direction_code(direction)))
+
+    def channel(self, token):
+        return frame(MSG_CHANNEL, CHANNEL.pack(token))
+
+    def session(self, id_client, token):
+        return frame(MSG_SESSION, SESSION.pack(id_client, token))
+
+    # Les snapshots trop gros pour une seule trame sont découpés en plusieurs trames
+    def snapshot(self, records, leaves):
+        frames = []
+        while True:
+            count   = min(len(records), MAX_RECORDS)
+            removed = min(len(leaves), (MAX_PAYLOAD - count * RECORD.size) // PLAYER_ID.size)
+            payload = SNAPSHOT_HEADER.pack(count, removed) + "".join(records[:count]) + "".join(leaves[:removed])
+            frames.append(frame(MSG_SNAPSHOT, payload))
+            records = records[count:]
+            leaves  = leaves[removed:]
+            if not (records or leaves):
+                return "".join(frames)
+
+
+JSON_CODEC    = JsonCodec()
+BINARY_CODECS = dict((version, BinaryCodec(version)) for version in xrange(1, VERSION + 1))
+BINARY_CODEC  = BINARY_CODECS[VERSION]
+
+
+# Côté client : encodage des messages envoyés au serveur
+def encode_move(binary, x, y, direction):
+    if binary:
+        return frame(MSG_MOVE, MOVE.pack(int(x), int(y), direction_code(direction)))
+    return json.dumps((x, y, direction)) + DELIMITER
+
+
+def encode_leave(binary):
+    if binary:
+        return frame(MSG_LEAVE)
+    return json.dumps((LEAVE_COORDINATES[0], LEAVE_COORDINATES[1], "down")) + DELIMITER
+
+
+def encode_ack(seq):
+    return frame(MSG_ACK, ACK.pack(seq))
+
+
+def encode_input(seq, key):
+    return frame(MSG_INPUT, INPUT.pack(seq, direction_code(key)))
+
+
+# Jeton de la session à reprendre, None pour en ouvrir une nouvelle
+def encode_resume(token):
+    return frame(MSG_RESUME, token or "")
+
+
+# Sert aussi au serveur pour renvoyer le datagramme BIND au client
+def encode_bind(id_client, token):
+    return frame(MSG_BIND, BIND.pack(id_client, token))
+
+
+# Côté client : décode le contenu d'un SNAPSHOT en (records, départs)
+def decode_snapshot(payload):
+    count, removed = SNAPSHOT_HEADER.unpack_from(payload)
+    offset  = SNAPSHOT_HEADER.size
+    records = []
+    for i in xrange(count):
+        id_client, x, y, code = RECORD.unpack_from(payload, offset)
+        records.append((id_client, x, y, DIRECTIONS[code] if code < len(DIRECTIONS) else "down"))
+        offset += RECORD.size
+    leaves = list(struct.unpack_from("!{}I".format(removed), payload, offset))
+    return records, leaves
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+# Enregistrement des sessions du serveur, relues par replay.py.
+#
+# Le serveur peut enregistrer tout ce qu'il reçoit : connexions, données lues sur chaque socket, fins de négociation
+# sur délai, déconnexions et ticks. L'enregistrement est un fichier binaire en ajout seul, écrit par un thread :
+# la boucle de jeu ne fait qu'accumuler les évènements en mémoire et confie ceux d'un tick en un seul bloc.
+# Les datagrammes ne sont pas enregistrés.
+
+import struct
+import threading
+import time
+from Queue import Queue
+
+# En-tête du fichier : signature, version du format et durée d'un tick de la session enregistrée
+FILE_MAGIC   = "KOGREC"
+FILE_VERSION = 1
+FILE_HEADER  = struct.Struct("!6sBd")
+
+# En-tête d'un évènement : type, descripteur de la connexion et taille des données qui suivent
+EVENT = struct.Struct("!BII")
+
+CONNECT    = 1 # Nouvelle connexion
+RECEIVE    = 2 # Données lues sur la connexion
+TIMEOUT    = 3 # Client resté muet, négocié en JSON
+DISCONNECT = 4 # Connexion fermée par le serveur ou par le client
+TICK       = 5 # Fin d'un tick, les données sont sa date d'enregistrement
+
+TICK_TIME = struct.Struct("!d")
+
+
+class RecordingError(Exception):
+    pass
+
+
+# Enregistreur branché sur un GameServer
+class Recorder :
+    enabled = True
+
+    def __init__(self, filename, tick_interval):
+        self.filename = filename
+        self.chunks   = []      # évènements du tick en cours, déjà encodés
+        self.blocks   = Queue() # blocs à écrire, None pour arrêter le thread
+        self.events   = 0
+        self.live     = set()   # descripteurs des connexions ouvertes, fermées dans l'enregistrement par close()
+
+        # Un enregistrement ne couvre qu'une exécution du serveur : un fichier existant est remplacé
+        self.file = open(filename, "wb")
+        self.file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, tick_interval))
+
+        self.thread = threading.Thread(target=self.write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, kind, fd, data=""):
+        self.chunks.append(EVENT.pack(kind, fd, len(data)))
+        if data:
+            self.chunks.append(data)
+        self.events += 1
+
+    def connect(self, fd):
+        self.live.add(fd)
+        self.add(CONNECT, fd)
+
+    def receive(self, fd, data):
+        self.add(RECEIVE, fd, data)
+
+    def timeout(self, fd):
+        self.add(TIMEOUT, fd)
+
+    def disconnect(self, fd):
+        self.live.discard(fd)
+        self.add(DISCONNECT, fd)
+
+    # Termine le tick et confie ses évènements au thread d'écriture, sans attendre
+    def tick(self):
+        self.add(TICK, 0, TICK_TIME.pack(time.time()))
+        self.blocks.put("".join(self.chunks))
+        self.chunks = []
+
+    # Ferme les connexions encore ouvertes, écrit les derniers évènements et arrête le thread d'écriture
+    def close(self):
+        for fd in sorted(self.live):
+            self.disconnect(fd)
+        if self.chunks:
+            self.blocks.put("".join(self.chunks))
+            self.chunks = []
+        self.blocks.put(None)
+        self.thread.join()
+
+    # Thread d'écriture : les blocs sont écrits dans l'ordre, le fichier est vidé après chaque salve
+    def write(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            self.file.write(block)
+            if self.blocks.empty():
+                self.file.flush()
+        self.file.close()
+
+
+# Enregistreur inactif, le coût se limite à un appel de méthode vide par évènement
+class NullRecorder :
+    enabled = False
+
+    def connect(self, fd):
+        pass
+
+    def receive(self, fd, data):
+        pass
+
+    def timeout(self, fd):
+        pass
+
+    def disconnect(self, fd):
+        pass
+
+    def tick(self):
+        pass
+
+    def close(self):
+        pass
+
+NULL_RECORDER = NullRecorder()
+
+
+# Lit un enregistrement, retourne la durée d'un tick et la liste des évènements (type, descripteur, données).
+# Un dernier évènement tronqué, si le serveur s'est arrêté brutalement, est ignoré.
+def load_recording(filename):
+    with open(filename, "rb") as f:
+        content = f.read()
+    if len(content) < FILE_HEADER.size:
+        raise RecordingError("{} is not a recording".format(filename))
+    magic, version, tick_interval = FILE_HEADER.unpack_from(content)
+    if magic != FILE_MAGIC or version != FILE_VERSION:
+        raise RecordingError("{} is not a recording of version {}".format(filename, FILE_VERSION))
+    events = []
+    offset = FILE_HEADER.size
+    while offset + EVENT.size <= len(content):
+        kind, fd, size = EVENT.unpack_from(content, offset)
+        offset += EVENT.size
+        if offset + size > len(content):
+            break
+        events.append((kind, fd, content[offset:offset + size]))
+        offset += size
+    return tick_interval, events
+
+
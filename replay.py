@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+# Relecture des sessions enregistrées par le serveur (voir recording.py).
+#
+# Les évènements sont réinjectés dans un GameServer dont les sockets sont factices, aussi vite que possible.
+# Les messages repassent par le décodage, la validation des déplacements et la diffusion, ce qui fait d'une
+# session réelle un banc d'essai du débit du serveur. La relecture est déterministe : les délais de négociation
+# et les déconnexions sont ceux de l'enregistrement, et les sockets factices acceptent toujours tout ce qu'on leur
+# envoie. Les identifiants des players peuvent différer de ceux de la session enregistrée, la relecture
+# n'utilisant pas la base des sessions.
+#
+# Usage : python replay.py <enregistrement> [carte] [répétitions]
+
+import json
+import sys
+import time
+
+from metrics import Metrics
+from protocol import JSON_CODEC
+from recording import CONNECT, RECEIVE, TIMEOUT, DISCONNECT, TICK, TICK_TIME, load_recording
+from server import GameServer, MAP_FILE
+
+
+# Socket factice : rend les données enregistrées à la lecture et accepte tout ce qu'on lui envoie
+class ReplaySocket :
+    def __init__(self, fd):
+        self.fd      = fd
+        self.pending = ""
+        self.sent    = 0
+
+    def fileno(self):
+        return self.fd
+
+    def recv(self, size):
+        data, self.pending = self.pending, ""
+        return data
+
+    def send(self, data):
+        self.sent += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+# Multiplexeur factice, les sockets de la relecture sont toujours prêtes
+class ReplayPoller :
+    def register(self, fd, events):
+        pass
+
+    def modify(self, fd, events):
+        pass
+
+    def unregister(self, fd):
+        pass
+
+
+# Journal muet, la relecture ne rapporte que son résultat
+class ReplayLog :
+    def log(self, category, message):
+        pass
+
+
+# Réinjecte un enregistrement dans un serveur, sans attendre entre les ticks
+class Playback :
+    def __init__(self, server, events):
+        self.server  = server
+        self.events  = events
+        self.clients = dict() # descripteur enregistré -> Client de la relecture
+        self.sockets = []     # toutes les sockets factices, pour compter les octets envoyés
+        server.poller = ReplayPoller()
+        server.log    = ReplayLog()
+
+    def run(self):
+        server = self.server
+        clients = self.clients
+        for kind, fd, data in self.events:
+            if kind == TICK:
+                server.tick()
+            elif kind == RECEIVE:
+                client = clients.get(fd)
+                if client is not None and client.connected:
+                    client.sock.pending = data
+                    server.handle_read(client)
+            elif kind == CONNECT:
+                sock = ReplaySocket(fd)
+                self.sockets.append(sock)
+                client = clients[fd] = server.add_client(sock, ("replay", fd))
+                # La négociation sur délai n'a lieu que si elle figure dans l'enregistrement
+                server.handshaking[fd] = (client, float("inf"))
+            elif kind == TIMEOUT:
+                client = clients.get(fd)
+                if client is not None and fd in server.handshaking:
+                    server.negotiate(client, JSON_CODEC)
+            elif kind == DISCONNECT:
+                client = clients.pop(fd, None)
+                if client is not None:
+                    server.disconnect(client)
+
+    def bytes_out(self):
+        return sum(sock.sent for sock in self.sockets)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage : python replay.py <recording> [map] [repeat]")
+        sys.exit(1)
+    filename = sys.argv[1]
+    map_file = sys.argv[2] if len(sys.argv) > 2 else MAP_FILE
+    repeat   = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    tick_interval, events = load_recording(filename)
+    ticks    = sum(1 for kind, fd, data in events if kind == TICK)
+    received = sum(len(data) for kind, fd, data in events if kind == RECEIVE)
+    times    = [TICK_TIME.unpack(data)[0] for kind, fd, data in events if kind == TICK]
+    recorded = times[-1] - times[0] if len(times) > 1 else ticks * tick_interval
+
+    runs = []
+    for i in xrange(repeat):
+        server   = GameServer(0, 1 / tick_interval, map_file=map_file, metrics=Metrics(), udp=False)
+        playback = Playback(server, events)
+        start = time.time()
+        playback.run()
+        elapsed = time.time() - start
+        runs.append({
+            "seconds": round(elapsed, 3),
+            "ticks_per_s": int(ticks / elapsed) if elapsed else None,
+            "messages": server.messages_in.value,
+            "messages_per_s": int(server.messages_in.value / elapsed) if elapsed else None,
+            "bytes_out": playback.bytes_out(),
+            "speedup": round(recorded / elapsed, 1) if elapsed else None,
+            "tick_mean_ms": round(1000 * server.tick_time.sum / server.tick_time.count, 3) if ticks else None,
+        })
+
+    print(json.dumps({
+        "recording": filename,
+        "events": len(events),
+        "ticks": ticks,
+        "connections": sum(1 for kind, fd, data in events if kind == CONNECT),
+        "bytes_in": received,
+        "recorded_seconds": round(recorded, 3),
+        "runs": runs,
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,108 +2,889 @@
 
 from socket import *
 
+import errno
 import json
-
+import os
+import select
+import struct
+import sys
 import time
-from threading import Thread
 
-thread = None
+from interest import InterestGrid, CELL_WIDTH, CELL_HEIGHT
+from protocol import MAGIC, VERSION, JSON_CODEC, BINARY_CODECS, DIRECTION_CODES, ProtocolError, direction_code
+from protocol import MSG_BIND, BIND, CHANNEL, MAX_DATAGRAM, decode_datagram, encode_bind
+from delta import DeltaEncoder, KEYFRAME_INTERVAL
+from tilemap import load_map
+from movement import MOVE_BURST, spend, step
+from metrics import NULL_METRICS, SIZE_BUCKETS, Metrics, SampledLog, serve_metrics
+from sessions import SessionStore
+from recording import NULL_RECORDER, Recorder
+
+# Taille maximale lue sur une socket à chaque évènement
+RECV_SIZE = 65536
+
+# Fréquence par défaut de la boucle de jeu, en ticks par seconde
+TICK_RATE = 20
+
+# Délai laissé à un client pour annoncer le protocole binaire avant de le considérer comme client JSON
+HANDSHAKE_TIMEOUT = 0.5
+
+# Carte sur laquelle les déplacements sont validés, la même que celle du client
+MAP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "map", "desert.tmx")
+
+# Base des sessions des players
+SESSIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions.db")
+
+# Couche et propriété des tuiles infranchissables
+COLLISION_LAYER    = "Ground"
+COLLISION_PROPERTY = "collision"
+
+# Taille au-delà de laquelle le tampon de sortie d'un client le fait déconnecter
+MAX_OUTBUF = 256 * 1024
+
+# Durée pendant laquelle un client peut ne pas vider son tampon de sortie avant d'être déconnecté
+SLOW_CLIENT_TIMEOUT = 5.0
+
+# Nombre de messages retenus en attendant la reprise de la session, au-delà duquel le client est déconnecté
+MAX_HELD = 64
+
+# Erreurs indiquant que la socket n'est simplement pas prête
+WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Erreurs d'accept dues au manque de descripteurs ou de mémoire : le serveur cesse un moment d'accepter
+# les connexions plutôt que de s'arrêter
+RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+# Durée pendant laquelle la socket d'écoute n'est plus lue après une telle erreur
+ACCEPT_BACKOFF = 0.5
+
+
+# Abstraction du mécanisme de multiplexage : epoll sous Linux, poll sinon, et select en dernier recours (Windows).
+class Poller :
+    READ  = 1
+    WRITE = 2
+
+    def __init__(self):
+        self.fds = dict()
+        if hasattr(select, "epoll"):
+            self.backend = select.epoll()
+            self.masks   = {self.READ: select.EPOLLIN, self.WRITE: select.EPOLLOUT}
+            self.errors  = select.EPOLLERR | select.EPOLLHUP
+        elif hasattr(select, "poll"):
+            self.backend = select.poll()
+            self.masks   = {self.READ: select.POLLIN, self.WRITE: select.POLLOUT}
+            self.errors  = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        else:
+            self.backend = None
+
+    def _mask(self, events):
+        mask = 0
+        for event in (self.READ, self.WRITE):
+            if events & event:
+                mask |= self.masks[event]
+        return mask
+
+    def register(self, fd, events):
+        self.fds[fd] = events
+        if self.backend is not None:
+            self.backend.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        if self.fds.get(fd) == events:
+            return
+        self.fds[fd] = events
+        if self.backend is not None:
+            self.backend.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        if fd in self.fds:
+            del self.fds[fd]
+            if self.backend is not None:
+                self.backend.unregister(fd)
 
-# Service de type Thread permettant une écoute des nouvelles connexions clientes
-class ListenerConnection(Thread):
+    # Retourne une liste de couples (fd, évènements) prêts, timeout en secondes (None = infini)
+    def poll(self, timeout=None):
+        if self.backend is None:
+            readers = [fd for fd, events in self.fds.items() if events & self.READ]
+            writers = [fd for fd, events in self.fds.items() if events & self.WRITE]
+            try:
+                readable, writable, _ = select.select(readers, writers, [], timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+            ready = dict((fd, self.READ) for fd in readable)
+            for fd in writable:
+                ready[fd] = ready.get(fd, 0) | self.WRITE
+            return ready.items()
+
+        if timeout is None:
+            timeout = -1
+        # poll attend des millisecondes, epoll des secondes
+        if not hasattr(select, "epoll"):
+            timeout = timeout if timeout < 0 else int(timeout * 1000)
+        try:
+            events = self.backend.poll(timeout)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        ready = []
+        for fd, mask in events:
+            flags = 0
+            # En cas d'erreur ou de fermeture, on force une lecture qui détectera la déconnexion
+            if mask & (self.masks[self.READ] | self.errors):
+                flags |= self.READ
+            if mask & self.masks[self.WRITE]:
+                flags |= self.WRITE
+            ready.append((fd, flags))
+        return ready
+
+
+# Etat d'une connexion cliente : sa socket, son player, son protocole et ses tampons d'entrée/sortie
+class Client :
+    def __init__(self, sock, address, player):
+        self.sock    = sock
+        self.address = address
+        self.player  = player
+        self.codec   = None # Protocole négocié, inconnu tant que le client n'a rien envoyé
+        self.decoder = None
+        self.delta   = None # Baseline acquittée du client pour la compression par deltas
+        self.inbuf   = ""   # Données reçues avant la négociation du protocole
+        self.outbuf  = ""
+        self.fd      = sock.fileno() # Conservé car la socket fermée n'a plus de descripteur
+        self.connected = True
+        self.known   = set() # identifiants des players que ce client connaît
+        self.input_seq = 0   # Numéro du dernier INPUT traité
+        self.blocked_since = None  # Date depuis laquelle le tampon de sortie n'a pas pu être vidé
+        self.backlog = dict()      # Changements retenus tant que le tampon de sortie n'est pas vide, par player
+        self.keyframe_due = False  # Une keyframe a été retenue avec les changements
+        self.token   = None        # Jeton du canal de datagrammes proposé au client
+        self.udp_address = None    # Adresse UDP du client, dès qu'il a envoyé son BIND
+        self.session = None        # Jeton de la session du player
+        self.resuming = False      # Le client doit reprendre sa session avant de rejoindre le jeu
+        self.held    = []          # Messages reçus avant la reprise de la session
+        self.move_credit = MOVE_BURST # Déplacements que le client peut encore faire accepter
+        self.credit_tick = 0          # Tick auquel ce crédit a été calculé
+
+
+# Serveur évènementiel mono-processus : une seule boucle multiplexe toutes les sockets clientes,
+# ce qui remplace les threads ListenerConnection/ListenerMessage tout en conservant le même protocole.
+# Les changements d'état sont accumulés puis diffusés en une seule trame par client à chaque tick.
+class GameServer :
 
     # Constructeur permettant l'initialisation des attributs
-    def __init__(self, port):
-        Thread.__init__(self)
-        self.port = port
-        self.clients = dict()
-        self.sock = None
+    def __init__(self, port, tick_rate=TICK_RATE, cell_width=CELL_WIDTH, cell_height=CELL_HEIGHT, map_file=MAP_FILE,
+                 metrics=NULL_METRICS, udp=True, sessions=None, recorder=NULL_RECORDER):
+        self.port      = port
+        self.clients   = dict() # fd -> Client
+        self.sock      = None
+        self.poller    = None
+        self.udp       = udp  # Propose un canal de datagrammes aux clients binaires version 4
+        self.udp_sock  = None
         self.id_client = 0
+        self.running   = False
+        self.tick_interval = 1.0 / tick_rate
+        self.tick_count    = 0
+        self.joined    = dict() # fd -> Client arrivés depuis le dernier tick
+        self.moved     = dict() # fd -> Client dont le player a changé depuis le dernier tick
+        self.departed  = []     # (identifiant, cellule) des players partis depuis le dernier tick
+        self.handshaking = dict() # fd -> (Client, échéance) dont le protocole n'est pas encore connu
+        self.keyframes = [set() for i in xrange(KEYFRAME_INTERVAL)] # Clients recevant une keyframe à chaque tick modulo l'intervalle
+        self.grid      = InterestGrid(cell_width, cell_height)
+        self.corrections = dict() # fd -> Client dont un déplacement a été refusé depuis le dernier tick
+        self.inputs      = dict() # fd -> Client dont des INPUT ont été traités depuis le dernier tick
+        self.blocked     = dict() # fd -> Client dont le tampon de sortie n'est pas vide
+        self.backlogged  = dict() # fd -> Client ayant des changements retenus
+        self.tokens      = dict() # jeton -> Client à qui un canal de datagrammes a été proposé
+        self.unreliable  = dict() # fd -> Client recevant ses DELTA par datagrammes
+        self.map        = None    # Index de la carte, None pour ne vérifier que la vitesse des déplacements
+        self.collisions = None    # Propriétés des tuiles de la couche de collision
+        self.log        = SampledLog()
+        self.sessions   = sessions # SessionStore, None pour ne pas conserver les players
+        self.by_session = dict()   # jeton de session -> Client connecté
+        self.recorder   = recorder # Enregistre ce que reçoit le serveur, pour le relire avec replay.py
+        self.accept_paused = None  # Date à laquelle la socket d'écoute sera de nouveau lue, None si elle l'est
+        if sessions is not None:
+            self.id_client = sessions.next_id
+        if map_file is not None:
+            self.load_collisions(map_file)
+        self.instrument(metrics)
+
+    # Crée les instruments du serveur, qui ne coûtent presque rien avec NULL_METRICS
+    def instrument(self, metrics):
+        self.metrics = metrics
+        self.connections   = metrics.counter("connections_total", "Connexions acceptées")
+        self.disconnections = metrics.counter("disconnections_total", "Connexions fermées")
+        self.messages_in   = metrics.counter("messages_in_total", "Messages décodés reçus des clients")
+        self.bytes_in      = metrics.counter("bytes_in_total", "Octets reçus des clients")
+        self.frames_out    = metrics.counter("frames_out_total", "Trames mises en file pour les clients")
+        self.bytes_out     = metrics.counter("bytes_out_total", "Octets écrits sur les sockets clientes")
+        self.send_blocked  = metrics.counter("send_blocked_total", "Envois partiels, le tampon de la socket est plein")
+        self.tick_time      = metrics.histogram("tick_seconds", help="Durée d'un tick")
+        self.fanout_time    = metrics.histogram("fanout_seconds", help="Calcul des destinataires des changements d'un tick")
+        self.serialize_time = metrics.histogram("serialize_seconds", help="Encodage des trames d'un tick")
+        self.send_time      = metrics.histogram("send_seconds", help="Ecriture des trames d'un tick sur les sockets")
+        self.send_buffer    = metrics.histogram("send_buffer_bytes", SIZE_BUCKETS,
+                                                "Données restant dans le tampon de sortie d'un client après un envoi partiel")
+        self.coalesced     = metrics.counter("coalesced_total", "Changements retenus pour un client dont le tampon n'est pas vide")
+        self.evictions     = metrics.counter("evictions_total", "Clients déconnectés car trop lents")
+        self.moves_dropped = metrics.counter("moves_dropped_total", "Déplacements refusés car trop rapprochés")
+        self.accept_errors = metrics.counter("accept_errors_total", "Connexions refusées faute de descripteurs ou de mémoire")
+        self.datagrams_in  = metrics.counter("datagrams_in_total", "Datagrammes reçus")
+        self.datagrams_out = metrics.counter("datagrams_out_total", "Datagrammes envoyés")
+        metrics.gauge("datagram_clients", lambda: len(self.unreliable), "Clients recevant leurs DELTA par datagrammes")
+        metrics.gauge("clients", lambda: len(self.clients), "Clients connectés")
+        metrics.gauge("send_buffer_total_bytes", lambda: sum(len(client.outbuf) for client in self.clients.values()),
+                      "Données en attente d'envoi, tous clients confondus")
+
+    # Charge la carte sans Kivy : seules ses dimensions et le bitmap des tuiles infranchissables sont utilisés
+    def load_collisions(self, map_file):
+        self.map = load_map(map_file)
+        layer = self.map.layer_index.get(COLLISION_LAYER)
+        if layer is not None:
+            self.collisions = self.map.layer_properties(layer)
+
+    # Ouvre la socket d'écoute non bloquante
+    def listen(self):
+        self.sock = socket(AF_INET, SOCK_STREAM)
+        self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.sock.bind(("", self.port))
+        self.sock.listen(9999) # Taille maximale de la file des connexions en attente
+        self.sock.setblocking(0)
+        self.poller = Poller()
+        self.poller.register(self.sock.fileno(), Poller.READ)
+        # Le canal de datagrammes utilise le même numéro de port que les connexions
+        if self.udp:
+            self.udp_sock = socket(AF_INET, SOCK_DGRAM)
+            self.udp_sock.bind(("", self.sock.getsockname()[1]))
+            self.udp_sock.setblocking(0)
+            self.poller.register(self.udp_sock.fileno(), Poller.READ)
 
-    # Fonction permettant l'execution du thread
+    # Boucle principale : attend les évènements réseau et les distribue
     def run(self):
-        print("--Listener thread running--\n")
-        sock = socket(AF_INET, SOCK_STREAM)
-        sock.bind(("", self.port))
+        print("--Server running on port {}--\n".format(self.port))
+        if self.sock is None:
+            self.listen()
+        self.running = True
+        next_tick = time.time() + self.tick_interval
+        try:
+            while self.running:
+                self.poll(max(0, next_tick - time.time()))
+                now = time.time()
+                if now >= next_tick:
+                    self.tick()
+                    next_tick += self.tick_interval
+                    # Si la boucle a pris trop de retard, on ne cherche pas à rattraper les ticks manqués
+                    if next_tick < now:
+                        next_tick = now + self.tick_interval
+        finally:
+            # Les derniers états des players sont écrits avant de quitter
+            if self.sessions is not None:
+                self.sessions.close()
+            self.recorder.close()
+
+    # Traite une itération de la boucle d'évènements
+    def poll(self, timeout):
+        for fd, events in self.poller.poll(timeout):
+            self.handle_event(fd, events)
+
+    # Distribue un évènement : nouvelle connexion ou socket cliente prête
+    def handle_event(self, fd, events):
+        if self.sock is not None and fd == self.sock.fileno():
+            self.accept()
+            return
+        if self.udp_sock is not None and fd == self.udp_sock.fileno():
+            self.handle_datagrams()
+            return
+        client = self.clients.get(fd)
+        if client is None:
+            return
+        if events & Poller.READ:
+            self.handle_read(client)
+        if events & Poller.WRITE and client.connected:
+            self.handle_write(client)
+
+    # Accepte toutes les connexions en attente
+    def accept(self):
         while True:
+            try:
+                sock, address = self.sock.accept()
+            except error as e:
+                if e.args[0] in WOULDBLOCK or e.args[0] == errno.ECONNABORTED:
+                    return
+                if e.args[0] in RESOURCE_ERRORS:
+                    self.pause_accept(e)
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            self.add_client(sock, address)
 
-            sock.listen(9999) #Fonction permettant de fixer le nombre maximal de clients connectés à 9999
-            client, address = sock.accept() # Fonction bloquante attendant une nouvelle connexion
-            self.clients[address] = [client, Player(self.id_client)] # Le nouveau client est ajouté au dictionnaire des clients, on crée un player pour chaque client
-            self.id_client += 1
-            print "{} connected".format( address )
+    # Cesse de lire la socket d'écoute pendant ACCEPT_BACKOFF : les connexions en attente restent dans la file
+    # du noyau, et le poller ne signalerait sinon la socket prête qu'à chaque itération
+    def pause_accept(self, e):
+        self.log.log("accept", u"Cannot accept connections : {}".format(e))
+        self.accept_errors.inc()
+        self.poller.unregister(self.sock.fileno())
+        self.accept_paused = time.time() + ACCEPT_BACKOFF
 
-            # Broadcast la nouvelle connexion d'un client à tous les clients déjà connectés
-            for index, address2 in enumerate(self.clients.keys()):
-                if address != address2:
-                    self.clients[address2][0].send(str(self.clients[address][1]) + "|")
-                    self.clients[address][0].send(str(self.clients[address2][1]) + "|")
+    # Crée le client d'une connexion acceptée, ou d'une socket factice lors d'une relecture
+    def add_client(self, sock, address):
+        client = Client(sock, address, Player(self.id_client)) # On crée un player pour chaque client
+        self.id_client += 1
+        self.connections.inc()
+        self.clients[client.fd] = client
+        self.poller.register(client.fd, Poller.READ)
+        self.on_connect(client)
+        return client
 
-            listenerMessage = ListenerMessage(address = address) # On associe un nouveau thread au client récemment connecté
-            listenerMessage.start()
+    # La nouvelle connexion sera diffusée au prochain tick, une fois son protocole connu
+    def on_connect(self, client):
+        self.recorder.connect(client.fd)
+        self.handshaking[client.fd] = (client, time.time() + HANDSHAKE_TIMEOUT)
 
+    # Fixe le protocole du client et l'ajoute au jeu
+    def negotiate(self, client, codec):
+        client.codec   = codec
+        client.decoder = codec.decoder()
+        self.handshaking.pop(client.fd, None)
+        welcome = codec.welcome(client.player.id_client)
+        if welcome:
+            self.send(client, welcome)
+        # Le client répond à WELCOME par le jeton de sa session, son player ne rejoint le jeu qu'ensuite
+        if self.sessions is not None and getattr(codec, "sessions", False):
+            client.resuming = True
+            return
+        self.join(client)
 
-# Service de type Thread permettant une écoute de son client associé et de broadcaster tout changement d'état.
-class ListenerMessage(Thread):
-    address = None
+    # Reprend la session d'un client, ou lui en ouvre une si son jeton est inconnu ou déjà utilisé, puis l'ajoute au jeu
+    def resume(self, client, token):
+        player = client.player
+        state  = self.sessions.get(token) if token is not None else None
+        # Une session tenue par une connexion vivante n'est pas reprise : le client reçoit un nouveau player,
+        # plutôt que de déconnecter l'autre client qui utilise le même jeton
+        if state is not None and token in self.by_session:
+            self.log.log("session", u"{} resumed a session held by {}".format(client.address, self.by_session[token].address))
+            state = None
+        if state is None:
+            token = self.sessions.create(player.id_client)
+        else:
+            id_client, x, y, direction = state
+            player.id_client = id_client
+            if x is not None:
+                player.update((x, y, direction))
+                # Le client apprend ainsi où se trouve son player
+                self.corrections[client.fd] = client
+        client.session  = token
+        client.resuming = False
+        self.by_session[token] = client
+        self.send(client, client.codec.session(player.id_client, token))
+        self.join(client)
+        held, client.held = client.held, []
+        for message in held:
+            self.on_message(client, message)
+            if not client.connected:
+                return
 
-     # Constructeur permettant l'initialisation des attributs
-    def __init__(self, address):
-        Thread.__init__(self)
-        self.address = address
+    # Ajoute au jeu un client dont le protocole est connu
+    def join(self, client):
+        codec = client.codec
+        self.joined[client.fd] = client
+        if getattr(codec, "deltas", False):
+            client.delta = DeltaEncoder()
+            self.keyframes[client.player.id_client % KEYFRAME_INTERVAL].add(client)
+        if self.udp_sock is not None and getattr(codec, "datagrams", False):
+            client.token = CHANNEL.unpack(os.urandom(CHANNEL.size))[0]
+            self.tokens[client.token] = client
+            self.send(client, codec.channel(client.token))
 
-   # Fonction permettant l'execution du thread
-    def run(self):
-        print "-- {} thread running --\n".format(self.address)
-        keepRunning = True
-        # Tant que le client est connecté, on rentre dans la boucle
-        while keepRunning:
-
-            # On essaye de communiquer avec celui ci
-            try : 
-                listenerConnection.clients[self.address][0].send("[]|") 
-            # Dans le cas où la communication ne s'effectue pas, on supprime le client. 
-            except : 
-                print "Le client {} est deconnecte ".format(self.address)
-                if self.address in listenerConnection.clients:
-                    del listenerConnection.clients[self.address] 
-                keepRunning = False
-            # Si la communication est bien établie, le processus continue son execution.
-            finally : 
-                # Si le client est bien dans le dictionnaires de clients
-                if self.address in listenerConnection.clients:
-                    message     = listenerConnection.clients[self.address][0].recv(2048) # On recoit des informations du client. 
-                    listMessage = json.loads(message) # On sérialise la donnée String avec la librairie JSON 
-                    listenerConnection.clients[self.address][1].update(listMessage) # On met à jour les attributs de l'objet player
-
-                    print(u"Message received from {} : {}".format(self.address, message))
-
-                    # Si on recoit une donnée de déconnexion, on déconnecte le client. 
-                    if listMessage[0] == 99 and listMessage[1] == 99:
-                        print(u"Deconnecting {}".format(self.address))
-                        for index, address in enumerate(listenerConnection.clients.keys()):
-                            if  listenerConnection.clients[address][0] != listenerConnection.clients[self.address][0]:
-                                listenerConnection.clients[address][0].send(json.dumps([listenerConnection.clients[self.address][1].id_client, 99, 99, "down"]) + "|")
-                        del listenerConnection.clients[self.address]
-                    # Sinon on envoit l'information à tous les clients connectés. 
-                    else : 
-                        for index, address in enumerate(listenerConnection.clients.keys()):
-                            if  listenerConnection.clients[address][0] == listenerConnection.clients[self.address][0]:
-                                pass
-                            else : 
-                                if len(message) > 0:
-                                    new_message = json.loads(message)
-                                    new_message.insert(0, listenerConnection.clients[self.address][1].id_client)
-                                    listenerConnection.clients[address][0].send(json.dumps(new_message) + "|")
-
-# Classe permettant de définir un objet player associé à un client. Il est composée de plusieurs variables. Notamment la position, la direction et l'identifiant. 
-class Player : 
+    # Lit les datagrammes reçus. Un BIND valide fixe l'adresse UDP du client et lui est renvoyé, pour que le client
+    # confirme sur sa connexion TCP que le canal fonctionne dans les deux sens.
+    def handle_datagrams(self):
+        while True:
+            try:
+                data, address = self.udp_sock.recvfrom(RECV_SIZE)
+            except error as e:
+                if e.args[0] in WOULDBLOCK:
+                    return
+                continue # Erreur ICMP remontée par un envoi précédent
+            self.datagrams_in.inc()
+            try:
+                msg_type, payload = decode_datagram(data)
+                if msg_type != MSG_BIND:
+                    continue
+                id_client, token = BIND.unpack(payload)
+            except (ProtocolError, struct.error):
+                continue
+            client = self.tokens.get(token)
+            if client is None or client.player.id_client != id_client:
+                continue
+            client.udp_address = address
+            self.send_datagram(address, encode_bind(id_client, token))
+
+    # Envoie un datagramme, abandonné si le tampon de la socket est plein : c'est alors une perte comme une autre
+    def send_datagram(self, address, data):
+        try:
+            self.udp_sock.sendto(data, address)
+        except error:
+            return
+        self.datagrams_out.inc()
+
+    # Détermine le protocole d'après les premiers octets reçus, retourne les données restantes
+    def handshake(self, client, data):
+        client.inbuf += data
+        hello = len(MAGIC) + 1
+        if client.inbuf.startswith(MAGIC) and len(client.inbuf) >= hello:
+            # On retient la plus récente version connue des deux côtés
+            version = max(1, min(ord(client.inbuf[len(MAGIC)]), VERSION))
+            data = client.inbuf[hello:]
+            self.negotiate(client, BINARY_CODECS[version])
+        elif MAGIC.startswith(client.inbuf) or client.inbuf.startswith(MAGIC):
+            return "" # Début possible du HELLO, on attend la suite
+        else:
+            data = client.inbuf
+            self.negotiate(client, JSON_CODEC)
+        client.inbuf = ""
+        return data
+
+    # Lit les données disponibles et découpe les messages complets
+    def handle_read(self, client):
+        try:
+            data = client.sock.recv(RECV_SIZE)
+        except error as e:
+            if e.args[0] in WOULDBLOCK:
+                return
+            self.disconnect(client)
+            return
+        if not data:
+            self.disconnect(client)
+            return
+        self.bytes_in.inc(len(data))
+        self.recorder.receive(client.fd, data)
+
+        if client.codec is None:
+            data = self.handshake(client, data)
+            if not data:
+                return
+        try:
+            messages = client.codec.messages(client.decoder.feed(data))
+        except (ProtocolError, struct.error) as e:
+            self.log.log("invalid", u"Invalid message from {} : {}".format(client.address, e))
+            self.disconnect(client)
+            return
+        self.messages_in.inc(len(messages))
+        for message in messages:
+            self.on_message(client, message)
+            if not client.connected:
+                return
+
+    # Traite un message décodé reçu d'un client : ("move", x, y, direction) ou ("leave",)
+    def on_message(self, client, message):
+        # Si on recoit une donnée de déconnexion, on déconnecte le client.
+        if message[0] == "leave":
+            self.disconnect(client)
+            return
+        if message[0] == "invalid":
+            self.log.log("invalid", u"{} from {}".format(message[1], client.address))
+            return
+        if message[0] == "resume":
+            if client.resuming:
+                self.resume(client, message[1])
+            return
+        # Le premier déplacement du client peut précéder la reprise de sa session
+        if client.resuming:
+            if len(client.held) >= MAX_HELD:
+                self.log.log("invalid", u"{} sent {} messages without resuming its session".format(client.address, MAX_HELD))
+                self.disconnect(client)
+                return
+            client.held.append(message)
+            return
+        if message[0] == "ack":
+            client.delta.ack(message[1])
+            return
+        if message[0] == "input":
+            self.on_input(client, message[1], message[2])
+            return
+        if message[0] == "bind":
+            # Le client a reçu le BIND renvoyé en datagramme : ses DELTA passeront désormais par le canal UDP
+            if client.udp_address is not None and message[2] == client.token:
+                self.unreliable[client.fd] = client
+            return
+
+        # Un déplacement refusé n'est pas diffusé, le client sera replacé au prochain tick.
+        # Le placement et les changements de direction sur place ne comptent pas dans la vitesse du player.
+        player = client.player
+        if not self.valid_move(player, message[1], message[2], message[3]) or \
+                (player.placed and (message[1], message[2]) != (player.x, player.y) and not self.allow_move(client)):
+            self.corrections[client.fd] = client
+            return
+
+        client.player.update(message[1:]) # On met à jour les attributs de l'objet player
+        # Sinon l'information sera envoyée à tous les autres clients au prochain tick.
+        self.moved[client.fd] = client
+
+    # Consomme un déplacement du crédit du client (voir movement.spend). Le temps est compté en ticks pour que
+    # la relecture d'un enregistrement reste identique. Retourne False si le client va trop vite.
+    def allow_move(self, client):
+        elapsed = (self.tick_count - client.credit_tick) * self.tick_interval
+        client.move_credit, allowed = spend(client.move_credit, elapsed)
+        client.credit_tick = self.tick_count
+        if not allowed:
+            self.moves_dropped.inc()
+        return allowed
+
+    # Vérifie qu'un déplacement reste dans la carte, hors des tuiles infranchissables, et d'au plus une tuile.
+    # Le premier déplacement reçu place le player sur la carte et n'est donc pas limité en distance.
+    def valid_move(self, player, x, y, direction):
+        if not isinstance(direction, basestring) or direction not in DIRECTION_CODES:
+            return False
+        if type(x) not in (int, long) or type(y) not in (int, long):
+            return False
+        if not self.walkable(x, y):
+            return False
+        if player.placed and abs(x - player.x) + abs(y - player.y) > 1:
+            return False
+        return True
+
+    # Indique si un player peut se trouver sur la tuile (x, y)
+    def walkable(self, x, y):
+        if self.map is not None:
+            if x < 0 or y < 0 or x >= self.map.width or y >= self.map.height:
+                return False
+            if self.collisions is not None and self.collisions.has(COLLISION_PROPERTY, x, y):
+                return False
+        return True
+
+    # Applique une touche de direction numérotée. Le client, qui a prédit son déplacement,
+    # recevra au prochain tick le numéro du dernier input traité et l'état qui en résulte.
+    # Un pas trop rapproché des précédents est acquitté sans être appliqué : le client sera corrigé.
+    def on_input(self, client, seq, key):
+        player = client.player
+        state  = step(player.x, player.y, player.direction, key, self.walkable)
+        if state[:2] != (player.x, player.y) and not self.allow_move(client):
+            state = (player.x, player.y, player.direction)
+        if state != (player.x, player.y, player.direction):
+            player.update(state)
+            self.moved[client.fd] = client
+        client.input_seq = seq
+        self.inputs[client.fd] = client
+
+    # Diffuse en une seule trame par client les changements survenus pendant le tick,
+    # limités à la zone d'intérêt de chaque client
+    def tick(self):
+        self.tick_count += 1
+        if self.metrics.enabled:
+            start = time.time()
+            self.broadcast()
+            self.tick_time.observe(time.time() - start)
+        else:
+            self.broadcast()
+        if self.sessions is not None:
+            self.sessions.flush()
+        self.recorder.tick()
+
+    # Corps du tick, mesuré par tick_seconds quand l'instrumentation est active
+    def broadcast(self):
+
+        # La socket d'écoute est de nouveau lue une fois le délai écoulé
+        if self.accept_paused is not None and time.time() >= self.accept_paused:
+            self.accept_paused = None
+            self.poller.register(self.sock.fileno(), Poller.READ)
+
+        # Les clients restés muets sont considérés comme des clients JSON historiques
+        if self.handshaking:
+            now = time.time()
+            for client, deadline in self.handshaking.values():
+                if deadline <= now:
+                    self.recorder.timeout(client.fd)
+                    self.negotiate(client, JSON_CODEC)
+
+        # Les clients qui ne vident plus leur tampon de sortie ralentiraient tout le serveur
+        if self.blocked:
+            now = time.time()
+            for client in self.blocked.values():
+                if now - client.blocked_since > SLOW_CLIENT_TIMEOUT:
+                    self.evict(client, "blocked for {:.1f}s".format(now - client.blocked_since))
+
+        # Les clients dont un déplacement a été refusé reçoivent la position retenue par le serveur.
+        # Un client dont le tampon n'est pas vide ne la recevra qu'une fois celui-ci vidé, à jour.
+        corrections = dict()
+        for client in self.corrections.values():
+            if client.outbuf:
+                corrections[client.fd] = client
+                continue
+            player = client.player
+            data = client.codec.correction(player.x, player.y, player.direction)
+            if data:
+                self.send(client, data)
+        self.corrections = corrections
+
+        # Les clients qui prédisent leurs déplacements reçoivent l'état correspondant à leur dernier input
+        inputs = dict()
+        for client in self.inputs.values():
+            if client.outbuf:
+                inputs[client.fd] = client
+                continue
+            player = client.player
+            self.send(client, client.codec.state(client.input_seq, player.x, player.y, player.direction))
+        self.inputs = inputs
+
+        keyframes = self.keyframes[self.tick_count % KEYFRAME_INTERVAL]
+        if not (self.joined or self.moved or self.departed or keyframes or self.backlogged or self.unreliable):
+            return
+        timed = self.metrics.enabled
+        if timed:
+            start = time.time()
+
+        pending = dict() # Client -> {identifiant: player, ou None pour un départ} à envoyer à la fin du tick
+        records = dict() # Chaque player n'est sérialisé qu'une seule fois par tick et par protocole
+
+        def push(client, id_client, player):
+            pending.setdefault(client, dict())[id_client] = player
+
+        # Les départs sont annoncés aux clients qui connaissaient le player. Ils sont traités en premier : un player
+        # qui revient pendant le même tick, en reprenant sa session, sera annoncé de nouveau par la suite.
+        for id_client, cell in self.departed:
+            for other in self.grid.around(cell):
+                if id_client in other.known:
+                    push(other, id_client, None)
+                    other.known.discard(id_client)
+
+        # Mise à jour de la grille : les clients ayant changé de cellule recalculent leur voisinage
+        changed = []
+        old_cells = dict()
+        for client in self.joined.values():
+            self.grid.insert(client, client.player.x, client.player.y)
+            changed.append(client)
+        for client in self.moved.values():
+            if client.fd in self.joined:
+                continue
+            old = self.grid.move(client, client.player.x, client.player.y)
+            if old != self.grid.positions[client]:
+                old_cells[client] = old
+                changed.append(client)
+
+        # Evènements d'entrée et de sortie de la zone d'intérêt des clients ayant changé de cellule
+        for client in changed:
+            # Les players sans connexion (fantômes d'une autre zone, voir cluster.py) n'ont pas de voisinage à recevoir
+            if not client.connected:
+                continue
+            visible = dict()
+            for other in self.grid.around(self.grid.positions[client]):
+                if other is not client:
+                    visible[other.player.id_client] = other
+            for id_client, other in visible.iteritems():
+                if id_client not in client.known:
+                    push(client, id_client, other.player)
+            for id_client in client.known.difference(visible):
+                push(client, id_client, None)
+            client.known = set(visible)
+
+        # Les changements d'un player sont envoyés aux clients de sa zone d'intérêt
+        for client in self.moved.values() + self.joined.values():
+            id_client = client.player.id_client
+            cell = self.grid.positions[client]
+            for other in self.grid.around(cell):
+                if other is not client:
+                    push(other, id_client, client.player)
+                    other.known.add(id_client)
+            # Les clients restés sur place qui ne voient plus le player reçoivent sa sortie
+            if client in old_cells:
+                area = set(self.grid.area(cell))
+                for old in self.grid.area(old_cells[client]):
+                    if old in area:
+                        continue
+                    for other in self.grid.cells.get(old, ()):
+                        if id_client in other.known:
+                            push(other, id_client, None)
+                            other.known.discard(id_client)
+
+        # Les clients à deltas reçoivent périodiquement une keyframe
+        for client in keyframes:
+            pending.setdefault(client, dict())
+
+        # Les clients dont le tampon s'est vidé reçoivent les changements retenus, complétés par ceux du tick
+        for client in self.backlogged.values():
+            if client.outbuf or not client.connected:
+                continue
+            backlog = client.backlog
+            backlog.update(pending.get(client, ()))
+            pending[client] = backlog
+            client.backlog = dict()
+            del self.backlogged[client.fd]
+
+        # Les clients en datagrammes reçoivent un DELTA tant qu'ils n'ont pas acquitté tous les changements
+        for client in self.unreliable.values():
+            if client.delta.unacked:
+                pending.setdefault(client, dict())
+        if timed:
+            fanout = time.time()
+            self.fanout_time.observe(fanout - start)
+
+        # Toutes les trames sont encodées avant d'être envoyées, pour mesurer séparément les deux étapes
+        frames = []
+        for client, messages in pending.iteritems():
+            if not client.connected:
+                continue
+            keyframe = client in keyframes
+            # Tant que le tampon n'est pas vide, seul le dernier état de chaque player est conservé
+            if client.outbuf and client.fd not in self.unreliable:
+                client.backlog.update(messages)
+                client.keyframe_due = client.keyframe_due or keyframe
+                self.backlogged[client.fd] = client
+                self.coalesced.inc(len(messages))
+                continue
+            if client.keyframe_due:
+                keyframe, client.keyframe_due = True, False
+            if client.delta is not None:
+                data = self.encode_delta(client, messages, keyframe)
+                if data:
+                    frames.append((client, data))
+                continue
+            codec = client.codec
+            updates, leaves = [], []
+            for id_client, player in messages.iteritems():
+                if player is None:
+                    leaves.append(codec.leave(id_client))
+                    continue
+                key = (codec.name, id_client)
+                if key not in records:
+                    records[key] = codec.record(id_client, player.x, player.y, player.direction)
+                updates.append(records[key])
+            frames.append((client, codec.snapshot(updates, leaves)))
+        if timed:
+            serialized = time.time()
+            self.serialize_time.observe(serialized - fanout)
+
+        for client, data in frames:
+            if not client.connected:
+                continue
+            # Une trame par datagramme : les DELTA trop gros, comme la plupart des keyframes, restent sur TCP
+            if client.fd in self.unreliable and len(data) <= MAX_DATAGRAM:
+                self.send_datagram(client.udp_address, data)
+            else:
+                self.send(client, data)
+        if timed:
+            self.send_time.observe(time.time() - serialized)
+
+        # Les nouvelles positions seront écrites en un seul lot à la fin du tick
+        if self.sessions is not None:
+            for client in self.moved.itervalues():
+                if client.session is not None:
+                    player = client.player
+                    self.sessions.save(client.session, player.id_client, player.x, player.y, player.direction)
+
+        self.joined   = dict()
+        self.moved    = dict()
+        self.departed = []
+
+    # Envoie au client ce qui a changé depuis sa baseline acquittée
+    def send_delta(self, client, messages, keyframe):
+        data = self.encode_delta(client, messages, keyframe)
+        if data:
+            self.send(client, data)
+
+    # Met à jour la vue du client et retourne le DELTA correspondant, vide si rien n'a changé
+    def encode_delta(self, client, messages, keyframe):
+        changes = dict()
+        for id_client, player in messages.iteritems():
+            if player is not None:
+                changes[id_client] = (int(player.x), int(player.y), direction_code(player.direction))
+            else:
+                changes[id_client] = None
+        client.delta.update(changes)
+        return client.delta.encode(changes, keyframe, client.fd in self.unreliable)
+
+    # Ajoute des données au tampon de sortie du client et tente de les envoyer
+    def send(self, client, data):
+        client.outbuf += data
+        self.frames_out.inc()
+        self.handle_write(client)
+        if len(client.outbuf) > MAX_OUTBUF:
+            self.evict(client, "{} bytes pending".format(len(client.outbuf)))
+
+    # Envoie autant que possible du tampon de sortie sans bloquer
+    def handle_write(self, client):
+        if client.outbuf:
+            try:
+                sent = client.sock.send(client.outbuf)
+            except error as e:
+                if e.args[0] not in WOULDBLOCK:
+                    self.disconnect(client)
+                    return
+                sent = 0
+            client.outbuf = client.outbuf[sent:]
+            self.bytes_out.inc(sent)
+            if client.outbuf:
+                self.send_blocked.inc()
+                self.send_buffer.observe(len(client.outbuf))
+        if not client.connected:
+            return
+        # Le poller n'est modifié que lorsque le tampon devient vide ou cesse de l'être
+        if client.outbuf:
+            if client.fd not in self.blocked:
+                client.blocked_since = time.time()
+                self.blocked[client.fd] = client
+                self.poller.modify(client.fd, Poller.READ | Poller.WRITE)
+        elif self.blocked.pop(client.fd, None) is not None:
+            client.blocked_since = None
+            self.poller.modify(client.fd, Poller.READ)
+
+    # Déconnecte un client trop lent pour suivre le rythme des envois
+    def evict(self, client, reason):
+        if not client.connected:
+            return
+        self.log.log("evict", u"Evicting slow client {} : {}".format(client.address, reason))
+        self.evictions.inc()
+        self.disconnect(client)
+
+    # Supprime le client, son départ sera annoncé aux autres joueurs au prochain tick
+    def disconnect(self, client):
+        if not client.connected:
+            return
+        self.log.log("disconnect", u"Deconnecting {}".format(client.address))
+        self.disconnections.inc()
+        self.recorder.disconnect(client.fd)
+        client.connected = False
+        self.poller.unregister(client.fd)
+        del self.clients[client.fd]
+        # Un déplacement du tick en cours ne serait sinon jamais écrit dans la session
+        if self.moved.pop(client.fd, None) is not None and self.sessions is not None and client.session is not None:
+            player = client.player
+            self.sessions.save(client.session, player.id_client, player.x, player.y, player.direction)
+        self.corrections.pop(client.fd, None)
+        self.inputs.pop(client.fd, None)
+        self.blocked.pop(client.fd, None)
+        self.backlogged.pop(client.fd, None)
+        self.tokens.pop(client.token, None)
+        self.unreliable.pop(client.fd, None)
+        if self.by_session.get(client.session) is client:
+            del self.by_session[client.session]
+        try:
+            client.sock.close()
+        except error:
+            pass
+        # Un client parti avant même d'avoir été placé dans la grille n'a pas besoin d'être signalé
+        self.joined.pop(client.fd, None)
+        self.handshaking.pop(client.fd, None)
+        if client.delta is not None:
+            self.keyframes[client.player.id_client % KEYFRAME_INTERVAL].discard(client)
+        cell = self.grid.remove(client)
+        if cell is not None:
+            self.departed.append((client.player.id_client, cell))
+
+
+# Classe permettant de définir un objet player associé à un client. Il est composée de plusieurs variables. Notamment la position, la direction et l'identifiant.
+class Player :
     def __init__(self,id_client):
         self.x = 0
         self.y = 0
         self.direction = "down"
         self.position = (self.x,self.y)
         self.id_client = id_client
+        self.placed = False # Vrai dès que le client a envoyé sa première position
 
     def __str__(self):
         return json.dumps([self.id_client, self.x, self.y, self.direction])
@@ -113,9 +894,24 @@ class Player :
         self.x         = listMessage[0]
         self.y         = listMessage[1]
         self.direction = listMessage[2]
-        
+        self.placed    = True
+
 
 if __name__ == '__main__':
 
-    listenerConnection = ListenerConnection(8004)
-    listenerConnection.start()
+    port      = int(sys.argv[1]) if len(sys.argv) > 1 else 8004
+    tick_rate = float(sys.argv[2]) if len(sys.argv) > 2 else TICK_RATE
+    map_file  = sys.argv[3] if len(sys.argv) > 3 else MAP_FILE
+    metrics_port = int(sys.argv[4]) if len(sys.argv) > 4 else 0 # 0 : instrumentation désactivée
+    metrics   = Metrics() if metrics_port else NULL_METRICS
+    sessions_file = sys.argv[5] if len(sys.argv) > 5 else SESSIONS_FILE # "none" : players non conservés
+    record_file = sys.argv[6] if len(sys.argv) > 6 else None # Enregistrement de la session, à relire avec replay.py
+    recorder  = Recorder(record_file, 1.0 / tick_rate) if record_file else NULL_RECORDER
+    sessions  = SessionStore(sessions_file) if sessions_file != "none" else None
+    server = GameServer(port, tick_rate, map_file=map_file, metrics=metrics, sessions=sessions, recorder=recorder)
+    if record_file:
+        print("--Recording to {}--".format(record_file))
+    if metrics_port:
+        serve_metrics(metrics, metrics_port)
+        print("--Metrics on http://127.0.0.1:{}/metrics--".format(metrics_port))
+    server.run()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+# Sessions persistantes des players : un jeton, remis au client à sa première connexion, lui permet de retrouver
+# son identifiant et sa position en se reconnectant, y compris après un redémarrage du serveur.
+#
+# Les sessions sont stockées dans une base SQLite, mais la boucle de jeu n'y accède jamais : toutes sont chargées
+# en mémoire au démarrage, et les changements d'un tick sont confiés en un seul lot à un thread d'écriture.
+# Si le disque est lent, les lots en attente sont fusionnés pour ne garder que le dernier état de chaque session.
+# Les sessions qui n'ont pas été écrites depuis SESSION_LIFETIME sont supprimées au démarrage.
+
+import binascii
+import os
+import sqlite3
+import threading
+import time
+from Queue import Queue, Empty
+
+# Taille des jetons de session, en octets
+TOKEN_SIZE = 16
+
+# Durée, en secondes, au-delà de laquelle une session qui n'a pas été écrite est oubliée
+SESSION_LIFETIME = 30 * 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    token     TEXT PRIMARY KEY,
+    id        INTEGER NOT NULL,
+    x         INTEGER,
+    y         INTEGER,
+    direction TEXT,
+    updated   REAL NOT NULL
+)
+"""
+
+
+def new_token():
+    return os.urandom(TOKEN_SIZE)
+
+
+class SessionStore :
+
+    # Supprime les sessions expirées, charge les autres et démarre le thread d'écriture
+    def __init__(self, filename, lifetime=SESSION_LIFETIME):
+        self.filename = filename
+        self.sessions = dict()   # jeton -> (identifiant, x, y, direction), x et y à None tant que le player n'est pas placé
+        self.dirty    = dict()   # jeton -> état modifié depuis le dernier lot
+        self.batches  = Queue()  # lots à écrire, None pour arrêter le thread
+        self.next_id  = 0        # premier identifiant libre
+
+        connection = sqlite3.connect(filename)
+        with connection:
+            connection.execute(SCHEMA)
+            # Les bases écrites avant l'expiration des sessions n'ont pas de date : elles partent d'aujourd'hui
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(sessions)")]
+            if "updated" not in columns:
+                connection.execute("ALTER TABLE sessions ADD COLUMN updated REAL NOT NULL DEFAULT 0")
+                connection.execute("UPDATE sessions SET updated = ?", (time.time(),))
+            connection.execute("DELETE FROM sessions WHERE updated < ?", (time.time() - lifetime,))
+        for token, id_client, x, y, direction in connection.execute("SELECT token, id, x, y, direction FROM sessions"):
+            self.sessions[binascii.unhexlify(token)] = (id_client, x, y, direction)
+            self.next_id = max(self.next_id, id_client + 1)
+        connection.close()
+
+        self.thread = threading.Thread(target=self.write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, token):
+        return self.sessions.get(token)
+
+    # Ouvre une session pour un nouveau player et retourne son jeton
+    def create(self, id_client):
+        token = new_token()
+        while token in self.sessions:
+            token = new_token()
+        self.save(token, id_client, None, None, None)
+        return token
+
+    # Retient le nouvel état d'une session, il sera écrit au prochain lot
+    def save(self, token, id_client, x, y, direction):
+        state = (id_client, x, y, direction)
+        self.sessions[token] = state
+        self.dirty[token] = state
+
+    # Confie au thread d'écriture les changements du tick, sans attendre
+    def flush(self):
+        if self.dirty:
+            self.batches.put(self.dirty)
+            self.dirty = dict()
+
+    # Ecrit les derniers changements et arrête le thread d'écriture
+    def close(self):
+        self.flush()
+        self.batches.put(None)
+        self.thread.join()
+
+    # Thread d'écriture : chaque lot est écrit en une seule transaction
+    def write(self):
+        connection = sqlite3.connect(self.filename)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        running = True
+        while running:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            # Les lots arrivés pendant l'écriture du précédent sont fusionnés
+            while True:
+                try:
+                    more = self.batches.get_nowait()
+                except Empty:
+                    break
+                if more is None:
+                    running = False
+                    break
+                batch.update(more)
+            updated = time.time()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO sessions (token, id, x, y, direction, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(binascii.hexlify(token),) + state + (updated,) for token, state in batch.iteritems()])
+        connection.close()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# Tests de la compression par deltas : le client doit toujours reconstruire la vue du serveur,
+# quels que soient le retard et l'absence de ses acquittements.
+#
+# Usage : python -m unittest discover
+
+import random
+import unittest
+
+from delta import DeltaEncoder, DeltaDecoder, MAX_UNACKED, FLAG_KEYFRAME, DELTA_HEADER
+from protocol import FrameDecoder, MSG_DELTA
+
+
+# Un serveur et un client reliés sans perte : chaque tick modifie la vue, le client décode le DELTA
+class Link :
+    def __init__(self):
+        self.encoder = DeltaEncoder()
+        self.decoder = DeltaDecoder()
+        self.frames  = FrameDecoder()
+        self.view    = dict()
+        self.flags   = []
+
+    # Applique les changements et retourne le numéro du DELTA reçu par le client, None si rien n'a été envoyé
+    def tick(self, changes, keyframe=False):
+        self.encoder.update(changes)
+        data = self.encoder.encode(changes.keys(), keyframe)
+        received = None
+        for msg_type, payload in self.frames.feed(data):
+            assert msg_type == MSG_DELTA
+            self.flags.append(DELTA_HEADER.unpack_from(payload)[2])
+            result = self.decoder.feed(payload)
+            if result is not None:
+                received = result[0]
+        return received
+
+
+def random_changes(players=20):
+    changes = dict()
+    for i in xrange(random.randrange(4)):
+        id_client = random.randrange(players)
+        if random.random() < 0.1:
+            changes[id_client] = None
+        else:
+            changes[id_client] = (random.randrange(100), random.randrange(100), random.randrange(4))
+    return changes
+
+
+class DeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+
+    def test_view_without_acks(self):
+        link = Link()
+        for tick in xrange(3 * MAX_UNACKED):
+            link.tick(random_changes())
+            self.assertEqual(link.decoder.current, link.encoder.view)
+            self.assertLessEqual(len(link.encoder.sent), MAX_UNACKED)
+
+    def test_history_reset_sends_a_keyframe(self):
+        link = Link()
+        for tick in xrange(MAX_UNACKED):
+            link.tick({tick: (tick, tick, 0)})
+        self.assertEqual(len(link.encoder.sent), MAX_UNACKED)
+        link.tick({0: (1, 2, 3)})
+        self.assertTrue(link.flags[-1] & FLAG_KEYFRAME)
+        self.assertEqual(len(link.encoder.sent), 1)
+        self.assertEqual(link.decoder.current, link.encoder.view)
+
+    def test_late_ack_of_a_dropped_delta(self):
+        link = Link()
+        first = link.tick({1: (1, 1, 0)})
+        for tick in xrange(MAX_UNACKED + 10):
+            link.tick({1: (tick % 50, 2, 1)})
+        # Le DELTA acquitté a été oublié avec l'historique : il ne devient pas la baseline
+        link.encoder.ack(first)
+        self.assertEqual(link.encoder.base_seq, 0)
+        link.tick({2: (5, 5, 2)})
+        self.assertEqual(link.decoder.current, link.encoder.view)
+
+    def test_random_ack_latency(self):
+        link  = Link()
+        acks  = []
+        for tick in xrange(2000):
+            seq = link.tick(random_changes(), keyframe=tick % 100 == 0)
+            if seq is not None and random.random() < 0.8:
+                acks.append((tick + random.randrange(200), seq))
+            acks.sort()
+            while acks and acks[0][0] <= tick:
+                link.encoder.ack(acks.pop(0)[1])
+            self.assertEqual(link.decoder.current, link.encoder.view)
+            self.assertLessEqual(len(link.encoder.sent), MAX_UNACKED)
+
+
+if __name__ == '__main__':
+    unittest.main()
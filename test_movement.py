@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+# Tests des règles de déplacement et de la vitesse maximale des players, côté client et côté serveur.
+#
+# Usage : python -m unittest discover
+
+import unittest
+
+from movement import MAX_MOVE_RATE, MOVE_BURST, PREDICTED_BURST, spend, step
+from protocol import BINARY_CODECS
+from replay import ReplaySocket, ReplayPoller, ReplayLog
+from server import GameServer
+
+
+def anywhere(x, y):
+    return True
+
+
+def nowhere(x, y):
+    return False
+
+
+# Serveur sans carte ni réseau, et un client binaire version 3 placé en (5, 5)
+def make_server():
+    server = GameServer(0, map_file=None)
+    server.poller = ReplayPoller()
+    server.log    = ReplayLog()
+    client = server.add_client(ReplaySocket(10), ("test", 10))
+    server.negotiate(client, BINARY_CODECS[3])
+    server.on_message(client, ("move", 5, 5, "right"))
+    return server, client
+
+
+class StepTest(unittest.TestCase):
+
+    def test_turn_in_place(self):
+        self.assertEqual(step(5, 5, "down", "left", anywhere), (5, 5, "left"))
+
+    def test_step_forward(self):
+        self.assertEqual(step(5, 5, "left", "left", anywhere), (4, 5, "left"))
+
+    def test_blocked(self):
+        self.assertEqual(step(5, 5, "up", "up", nowhere), (5, 5, "up"))
+
+
+class SpendTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        credit, allowed = MOVE_BURST, True
+        for i in xrange(MOVE_BURST):
+            credit, allowed = spend(credit, 0)
+            self.assertTrue(allowed)
+        credit, allowed = spend(credit, 0)
+        self.assertFalse(allowed)
+        credit, allowed = spend(credit, 1.0 / MAX_MOVE_RATE)
+        self.assertTrue(allowed)
+
+    def test_credit_is_capped(self):
+        credit, allowed = spend(0, 3600)
+        self.assertEqual(credit, MOVE_BURST - 1)
+        credit, allowed = spend(0, 3600, PREDICTED_BURST)
+        self.assertEqual(credit, PREDICTED_BURST - 1)
+
+
+class ServerSpeedTest(unittest.TestCase):
+
+    def test_burst_of_inputs(self):
+        server, client = make_server()
+        for seq in xrange(200):
+            server.on_input(client, seq, "right")
+        self.assertEqual(client.player.x, 5 + MOVE_BURST)
+        self.assertEqual(client.input_seq, 199)
+        # Deux ticks de 50 ms rendent un déplacement
+        server.tick()
+        server.tick()
+        for seq in xrange(200, 210):
+            server.on_input(client, seq, "right")
+        self.assertEqual(client.player.x, 6 + MOVE_BURST)
+
+    def test_burst_of_moves(self):
+        server, client = make_server()
+        for i in xrange(200):
+            server.on_message(client, ("move", client.player.x + 1, 5, "right"))
+        self.assertEqual(client.player.x, 5 + MOVE_BURST)
+        self.assertIn(client.fd, server.corrections)
+
+    def test_turns_are_free(self):
+        server, client = make_server()
+        for seq, key in enumerate(["up", "left", "down", "right"] * 10):
+            server.on_input(client, seq, key)
+        self.assertEqual((client.player.x, client.player.y, client.player.direction), (5, 5, "right"))
+        server.on_input(client, 100, "right")
+        self.assertEqual(client.player.x, 6)
+
+    def test_predicted_steps_are_accepted(self):
+        # Un client qui prédit ses pas à 30 touches par seconde n'est jamais corrigé par le serveur
+        server, client = make_server()
+        credit, now, last = PREDICTED_BURST, 0.0, 0.0
+        x = client.player.x
+        for key in xrange(300):
+            now += 1 / 30.0
+            while now >= (server.tick_count + 1) * server.tick_interval:
+                server.tick()
+            credit, allowed = spend(credit, now - last, PREDICTED_BURST)
+            last = now
+            if allowed:
+                x += 1
+                server.on_input(client, key, "right")
+                self.assertEqual(client.player.x, x)
+
+
+if __name__ == '__main__':
+    unittest.main()
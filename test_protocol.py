@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# Tests du décodage des messages reçus par le serveur.
+#
+# Usage : python -m unittest discover
+
+import unittest
+
+from protocol import JSON_CODEC, BINARY_CODEC, MAX_MESSAGE, FRAME_HEADER, MSG_MOVE, JsonDecoder, ProtocolError, \
+    encode_move
+
+
+def decode(data):
+    return JSON_CODEC.messages(JsonDecoder().feed(data))
+
+
+class JsonCodecTest(unittest.TestCase):
+
+    def test_move(self):
+        self.assertEqual(decode('[1, 2, "down"]|'), [("move", 1, 2, "down")])
+
+    def test_leave(self):
+        self.assertEqual(decode('[99, 99, "down"]|'), [("leave",)])
+
+    def test_split_messages(self):
+        decoder = JsonDecoder()
+        self.assertEqual(decoder.feed('[1, 2, "do'), [])
+        self.assertEqual(decoder.feed('wn"]|[3, 4, "up"]|[5'), ['[1, 2, "down"]', '[3, 4, "up"]'])
+
+    def test_invalid_messages(self):
+        for data in ['not json|', '{}|', '[1, 2]|', '"x"|', '[1, 2, []]|', '["1", 2, "down"]|',
+                     '[1.5, 2, "down"]|', '[1, 2, "north"]|', '[1, 2, 3]|', '[1, null, "up"]|']:
+            messages = decode(data)
+            self.assertEqual(len(messages), 1, data)
+            self.assertEqual(messages[0][0], "invalid", data)
+
+    def test_direction_is_a_str(self):
+        message = decode(u'[1, 2, "left"]|')[0]
+        self.assertIs(type(message[3]), str)
+
+
+# Un client ne peut pas faire retenir par le serveur plus d'un message incomplet de MAX_MESSAGE octets
+class MessageSizeTest(unittest.TestCase):
+
+    def test_json_without_delimiter(self):
+        decoder = JSON_CODEC.decoder()
+        decoder.feed("x" * MAX_MESSAGE)
+        self.assertRaises(ProtocolError, decoder.feed, "x")
+
+    def test_json_long_stream_of_messages(self):
+        decoder = JSON_CODEC.decoder()
+        for i in xrange(1000):
+            self.assertEqual(len(decoder.feed(encode_move(False, 1, 2, "up") * 10)), 10)
+
+    def test_binary_frame_too_long(self):
+        decoder = BINARY_CODEC.decoder()
+        self.assertRaises(ProtocolError, decoder.feed, FRAME_HEADER.pack(MAX_MESSAGE + 1, MSG_MOVE))
+
+    def test_binary_frames(self):
+        decoder = BINARY_CODEC.decoder()
+        data = encode_move(True, 1, 2, "up") * 100
+        self.assertEqual(len(decoder.feed(data[:-1])), 99)
+        self.assertEqual(len(decoder.feed(data[-1])), 1)
+
+    def test_client_side_decoder_is_unbounded(self):
+        decoder = JsonDecoder()
+        decoder.feed("x" * 10 * MAX_MESSAGE)
+        self.assertEqual(decoder.feed("|"), ["x" * 10 * MAX_MESSAGE])
+
+
+if __name__ == '__main__':
+    unittest.main()
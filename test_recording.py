@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Tests de l'enregistrement des sessions du serveur et de leur relecture.
+#
+# Usage : python -m unittest discover
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from metrics import Metrics
+from recording import CONNECT, RECEIVE, DISCONNECT, TICK, Recorder, RecordingError, load_recording
+from replay import Playback
+from server import GameServer
+
+
+class RecordingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename  = os.path.join(self.directory, "session.rec")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self):
+        recorder = Recorder(self.filename, 0.05)
+        recorder.connect(4)
+        recorder.receive(4, '[1, 2, "down"]|')
+        recorder.tick()
+        recorder.connect(5)
+        recorder.close()
+
+    def test_round_trip(self):
+        self.record()
+        tick_interval, events = load_recording(self.filename)
+        self.assertEqual(tick_interval, 0.05)
+        self.assertEqual([(kind, fd) for kind, fd, data in events],
+                         [(CONNECT, 4), (RECEIVE, 4), (TICK, 0), (CONNECT, 5), (DISCONNECT, 4), (DISCONNECT, 5)])
+        self.assertEqual(events[1][2], '[1, 2, "down"]|')
+
+    def test_each_run_starts_a_new_file(self):
+        self.record()
+        self.record()
+        tick_interval, events = load_recording(self.filename)
+        self.assertEqual(len(events), 6)
+
+    def test_truncated_event_is_ignored(self):
+        self.record()
+        with open(self.filename, "rb") as f:
+            content = f.read()
+        with open(self.filename, "wb") as f:
+            f.write(content[:-3])
+        tick_interval, events = load_recording(self.filename)
+        self.assertEqual(len(events), 5)
+
+    def test_not_a_recording(self):
+        with open(self.filename, "wb") as f:
+            f.write("KOGMAP" + "\0" * 20)
+        self.assertRaises(RecordingError, load_recording, self.filename)
+
+    def test_replay(self):
+        recorder = Recorder(self.filename, 0.05)
+        server   = GameServer(0, map_file=None, udp=False, recorder=recorder)
+        playback = Playback(server, [(CONNECT, 4, ""), (RECEIVE, 4, '[1, 2, "down"]|'), (TICK, 0, ""),
+                                     (CONNECT, 5, ""), (RECEIVE, 5, '[2, 2, "up"]|'), (TICK, 0, "")])
+        playback.run()
+        recorder.close()
+        # La relecture d'une session réenregistrée rejoue les mêmes messages, puis ferme les connexions restées ouvertes
+        tick_interval, events = load_recording(self.filename)
+        self.assertEqual([kind for kind, fd, data in events],
+                         [CONNECT, RECEIVE, TICK, CONNECT, RECEIVE, TICK, DISCONNECT, DISCONNECT])
+        server   = GameServer(0, map_file=None, udp=False, metrics=Metrics())
+        playback = Playback(server, events)
+        playback.run()
+        self.assertEqual(server.messages_in.value, 2)
+        self.assertEqual(server.clients, dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
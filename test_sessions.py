@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Tests des sessions persistantes des players : base SQLite et reprise par le serveur.
+#
+# Usage : python -m unittest discover
+
+import binascii
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from protocol import BINARY_CODECS
+from replay import ReplaySocket, ReplayPoller, ReplayLog
+from server import GameServer, MAX_HELD
+from sessions import SessionStore
+
+
+class SessionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename  = os.path.join(self.directory, "sessions.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reopen(self):
+        store = SessionStore(self.filename)
+        token = store.create(7)
+        store.flush()
+        store.save(token, 7, 3, 4, "left")
+        store.close()
+        store = SessionStore(self.filename)
+        self.assertEqual(store.get(token), (7, 3, 4, "left"))
+        self.assertEqual(store.next_id, 8)
+        store.close()
+
+    def test_expiry(self):
+        store = SessionStore(self.filename)
+        token = store.create(1)
+        store.close()
+        store = SessionStore(self.filename, lifetime=-1)
+        self.assertIsNone(store.get(token))
+        store.close()
+
+    def test_migration(self):
+        connection = sqlite3.connect(self.filename)
+        connection.execute("CREATE TABLE sessions (token TEXT PRIMARY KEY, id INTEGER NOT NULL, "
+                           "x INTEGER, y INTEGER, direction TEXT)")
+        connection.execute("INSERT INTO sessions VALUES (?, 2, 5, 6, 'up')", (binascii.hexlify("t" * 16),))
+        connection.commit()
+        connection.close()
+        store = SessionStore(self.filename)
+        self.assertEqual(store.get("t" * 16), (2, 5, 6, "up"))
+        store.close()
+
+
+# Un serveur sans carte ni réseau, dont les clients binaires version 5 reprennent leur session
+class ServerSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename  = os.path.join(self.directory, "sessions.db")
+        self.fd        = 10
+        self.start()
+
+    def tearDown(self):
+        self.server.sessions.close()
+        shutil.rmtree(self.directory)
+
+    def start(self):
+        self.server = GameServer(0, map_file=None, sessions=SessionStore(self.filename))
+        self.server.poller = ReplayPoller()
+        self.server.log    = ReplayLog()
+
+    def restart(self):
+        self.server.sessions.close()
+        self.start()
+
+    def connect(self, token=None):
+        self.fd += 1
+        client = self.server.add_client(ReplaySocket(self.fd), ("test", self.fd))
+        self.server.negotiate(client, BINARY_CODECS[5])
+        self.server.on_message(client, ("resume", token))
+        return client
+
+    def test_resume_after_restart(self):
+        client = self.connect()
+        self.server.on_message(client, ("move", 5, 6, "down"))
+        self.server.tick()
+        token, id_client = client.session, client.player.id_client
+        self.restart()
+        client = self.connect(token)
+        self.assertEqual(client.session, token)
+        self.assertEqual(client.player.id_client, id_client)
+        self.assertEqual((client.player.x, client.player.y, client.player.direction), (5, 6, "down"))
+
+    def test_move_in_the_tick_of_the_disconnection(self):
+        client = self.connect()
+        self.server.on_message(client, ("move", 5, 6, "down"))
+        self.server.tick()
+        self.server.on_message(client, ("move", 5, 7, "down"))
+        self.server.disconnect(client)
+        self.server.tick()
+        self.assertEqual(self.server.sessions.get(client.session)[1:], (5, 7, "down"))
+
+    def test_live_session_is_not_taken_over(self):
+        first  = self.connect()
+        second = self.connect(first.session)
+        self.assertTrue(first.connected)
+        self.assertNotEqual(second.session, first.session)
+        self.assertNotEqual(second.player.id_client, first.player.id_client)
+
+    def test_messages_held_before_resume(self):
+        self.fd += 1
+        client = self.server.add_client(ReplaySocket(self.fd), ("test", self.fd))
+        self.server.negotiate(client, BINARY_CODECS[5])
+        for i in xrange(MAX_HELD):
+            self.server.on_message(client, ("input", i, "down"))
+        self.assertTrue(client.connected)
+        self.server.on_message(client, ("input", MAX_HELD, "down"))
+        self.assertFalse(client.connected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+
+# Lecture des cartes TMX sans Kivy ni pytmx, et index de carte découpé en chunks sur disque.
+#
+# La carte TMX n'est analysée qu'une seule fois : ses gids sont écrits dans un fichier d'index (.kogmap)
+# rangé chunk par chunk, qui est ensuite ouvert par mmap. Lire un chunk ne touche ainsi que
+# quelques pages du fichier, quelle que soit la taille de la carte.
+#
+# Format de l'index :
+#   en-tête  : MAGIC, version, largeur, hauteur, largeur et hauteur d'une tuile, taille d'un chunk, nombre de couches
+#   métadonnées JSON préfixées par leur longueur : couches, tilesets, propriétés des tuiles
+#   gids     : pour chaque couche, pour chaque chunk (ligne par ligne), chunk_size x chunk_size entiers non signés
+#              de 4 octets petit-boutistes, les tuiles hors de la carte valant 0
+#
+# La découpe des tilesets en tuiles est elle aussi précalculée, dans un atlas au format Kivy (.atlas) :
+#   {image du tileset: {gid: [x, y, largeur, hauteur]}}, y étant compté depuis le bas de l'image comme dans OpenGL
+
+import base64
+import gzip
+import json
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from StringIO import StringIO
+from xml.etree import ElementTree
+
+INDEX_MAGIC   = "KOGM"
+INDEX_VERSION = 1
+INDEX_HEADER  = struct.Struct("<4sHIIHHHH") # magic, version, largeur, hauteur, tuile, tuile, chunk, couches
+METADATA_SIZE = struct.Struct("<I")
+
+# Taille par défaut d'un chunk, en tuiles
+CHUNK_SIZE = 16
+
+# Bits de retournement stockés par Tiled dans les gids
+GID_MASK = 0x1FFFFFFF
+
+
+class MapError(Exception):
+    pass
+
+
+# Carte TMX analysée : dimensions, tilesets, couches de tuiles et propriétés des tuiles
+class TmxMap :
+
+    def __init__(self, filename):
+        self.filename   = filename
+        self.directory  = os.path.dirname(os.path.abspath(filename))
+        self.tilesets   = [] # dictionnaires : firstgid, image, tilewidth, tileheight, spacing, margin, width, height
+        self.layers     = [] # (nom, visible, array des gids ligne par ligne)
+        self.properties = dict() # gid -> {nom: valeur}
+
+        root = ElementTree.parse(filename).getroot()
+        self.width      = int(root.get("width"))
+        self.height     = int(root.get("height"))
+        self.tilewidth  = int(root.get("tilewidth"))
+        self.tileheight = int(root.get("tileheight"))
+
+        for node in root:
+            if node.tag == "tileset":
+                self.load_tileset(node)
+            elif node.tag == "layer":
+                self.load_layer(node)
+
+    def load_tileset(self, node):
+        firstgid  = int(node.get("firstgid", 1))
+        directory = self.directory
+        # Tileset externe (.tsx), ses chemins sont relatifs à son propre fichier
+        if node.get("source"):
+            path = os.path.join(self.directory, node.get("source"))
+            node = ElementTree.parse(path).getroot()
+            directory = os.path.dirname(path)
+
+        image = node.find("image")
+        tileset = {
+            "firstgid": firstgid,
+            "name": node.get("name"),
+            "image": os.path.relpath(os.path.join(directory, image.get("source")), self.directory) if image is not None else None,
+            "tilewidth": int(node.get("tilewidth")),
+            "tileheight": int(node.get("tileheight")),
+            "spacing": int(node.get("spacing", 0)),
+            "margin": int(node.get("margin", 0)),
+            "width": int(image.get("width", 0)) if image is not None else 0,
+            "height": int(image.get("height", 0)) if image is not None else 0,
+        }
+        self.tilesets.append(tileset)
+
+        for tile in node.findall("tile"):
+            properties = tile.find("properties")
+            if properties is None:
+                continue
+            gid = firstgid + int(tile.get("id"))
+            self.properties[gid] = dict((prop.get("name"), prop.get("value", prop.text)) for prop in properties.findall("property"))
+
+    def load_layer(self, node):
+        data     = node.find("data")
+        encoding = data.get("encoding")
+        gids     = array("I")
+        if encoding == "base64":
+            raw = base64.b64decode(data.text.strip())
+            compression = data.get("compression")
+            if compression == "zlib":
+                raw = zlib.decompress(raw)
+            elif compression == "gzip":
+                raw = gzip.GzipFile(fileobj=StringIO(raw)).read()
+            elif compression:
+                raise MapError("Unsupported layer compression {}".format(compression))
+            gids.extend(struct.unpack("<{}I".format(len(raw) // 4), raw))
+        elif encoding == "csv":
+            gids.extend(int(gid) for gid in data.text.replace("\n", "").split(",") if gid.strip())
+        elif encoding is None:
+            gids.extend(int(tile.get("gid", 0)) for tile in data.findall("tile"))
+        else:
+            raise MapError("Unsupported layer encoding {}".format(encoding))
+
+        if len(gids) != self.width * self.height:
+            raise MapError("Layer {} has {} tiles instead of {}".format(node.get("name"), len(gids), self.width * self.height))
+        for index in xrange(len(gids)):
+            gids[index] &= GID_MASK
+        self.layers.append((node.get("name"), node.get("visible", "1") != "0", gids))
+
+
+# Index de carte découpé en chunks, lu par mmap
+class MapIndex :
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.width, self.height, self.tilewidth, self.tileheight, self.chunk_size, count = \
+            INDEX_HEADER.unpack_from(self.data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise MapError("{} is not a map index".format(filename))
+        size, = METADATA_SIZE.unpack_from(self.data, INDEX_HEADER.size)
+        offset = INDEX_HEADER.size + METADATA_SIZE.size
+        metadata = json.loads(self.data[offset:offset + size])
+
+        self.layers      = metadata["layers"]   # [(nom, visible)]
+        self.layer_index = dict((name, index) for index, (name, visible) in enumerate(self.layers))
+        self.tilesets    = metadata["tilesets"]
+        self.properties  = dict((int(gid), properties) for gid, properties in metadata["properties"].iteritems())
+        self.chunks_x    = (self.width + self.chunk_size - 1) // self.chunk_size
+        self.chunks_y    = (self.height + self.chunk_size - 1) // self.chunk_size
+        self.gids_offset = offset + size
+        self.chunk_bytes = self.chunk_size * self.chunk_size * 4
+        self.chunk_struct = struct.Struct("<{}I".format(self.chunk_size * self.chunk_size))
+        self.property_indexes = dict() # couche -> PropertyIndex, construit à la première demande
+
+    # Ecrit l'index d'une carte TMX déjà analysée
+    @staticmethod
+    def build(tmx, filename, chunk_size=CHUNK_SIZE):
+        metadata = json.dumps({
+            "layers": [(name, visible) for name, visible, gids in tmx.layers],
+            "tilesets": tmx.tilesets,
+            "properties": tmx.properties,
+        })
+        chunks_x = (tmx.width + chunk_size - 1) // chunk_size
+        chunks_y = (tmx.height + chunk_size - 1) // chunk_size
+
+        # Le client et le serveur peuvent construire l'index en même temps : chacun écrit son propre fichier
+        temporary = "{}.{}.tmp".format(filename, os.getpid())
+        with open(temporary, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, tmx.width, tmx.height,
+                                      tmx.tilewidth, tmx.tileheight, chunk_size, len(tmx.layers)))
+            f.write(METADATA_SIZE.pack(len(metadata)))
+            f.write(metadata)
+            for name, visible, gids in tmx.layers:
+                for cy in xrange(chunks_y):
+                    for cx in xrange(chunks_x):
+                        chunk = array("I", [0]) * (chunk_size * chunk_size)
+                        for row in xrange(min(chunk_size, tmx.height - cy * chunk_size)):
+                            start = (cy * chunk_size + row) * tmx.width + cx * chunk_size
+                            line  = gids[start:start + min(chunk_size, tmx.width - cx * chunk_size)]
+                            chunk[row * chunk_size:row * chunk_size + len(line)] = line
+                        f.write(struct.pack("<{}I".format(len(chunk)), *chunk))
+        os.rename(temporary, filename)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    # Retourne les gids d'un chunk, ligne par ligne (chunk_size x chunk_size valeurs)
+    def chunk(self, layer, cx, cy):
+        offset = self.gids_offset + ((layer * self.chunks_y + cy) * self.chunks_x + cx) * self.chunk_bytes
+        return self.chunk_struct.unpack_from(self.data, offset)
+
+    # Retourne le gid de la tuile (x, y) d'une couche, 0 hors de la carte
+    def gid(self, layer, x, y):
+        if x < 0 or y < 0 or x >= self.width or y >= self.height:
+            return 0
+        size = self.chunk_size
+        cx, tx = divmod(x, size)
+        cy, ty = divmod(y, size)
+        offset = self.gids_offset + ((layer * self.chunks_y + cy) * self.chunks_x + cx) * self.chunk_bytes
+        return struct.unpack_from("<I", self.data, offset + (ty * size + tx) * 4)[0]
+
+    # Retourne les (x, y, gid) non vides d'un chunk
+    def chunk_tiles(self, layer, cx, cy):
+        size  = self.chunk_size
+        gids  = self.chunk(layer, cx, cy)
+        tiles = []
+        for index, gid in enumerate(gids):
+            if gid:
+                ty, tx = divmod(index, size)
+                tiles.append((cx * size + tx, cy * size + ty, gid))
+        return tiles
+
+    # Retourne l'index des propriétés d'une couche, construit en un seul passage sur ses chunks
+    def layer_properties(self, layer):
+        if layer not in self.property_indexes:
+            tiles = (tile for cy in xrange(self.chunks_y) for cx in xrange(self.chunks_x)
+                          for tile in self.chunk_tiles(layer, cx, cy))
+            self.property_indexes[layer] = PropertyIndex(self.width, self.height, tiles, self.properties)
+        return self.property_indexes[layer]
+
+
+# Propriétés des tuiles d'une couche : pour chaque propriété, un bitmap d'un octet par tuile (ligne par ligne)
+# et la liste des coordonnées des tuiles qui la portent. Tester une tuile ne coûte qu'une indexation.
+class PropertyIndex :
+
+    def __init__(self, width, height, tiles, properties):
+        self.width   = width
+        self.height  = height
+        self.bitmaps = dict() # nom -> bytearray de width x height octets
+        self.tiles   = dict() # nom -> [(x, y)] triées ligne par ligne
+
+        # tiles : itérable de (x, y, gid), properties : gid -> {nom: valeur}
+        names = dict((gid, tuple(values)) for gid, values in properties.iteritems() if values)
+        if names:
+            for x, y, gid in tiles:
+                for name in names.get(gid, ()):
+                    if name not in self.bitmaps:
+                        self.bitmaps[name] = bytearray(width * height)
+                        self.tiles[name] = []
+                    self.bitmaps[name][y * width + x] = 1
+                    self.tiles[name].append((x, y))
+        for coordinates in self.tiles.itervalues():
+            coordinates.sort(key=lambda tile: (tile[1], tile[0]))
+
+    # Indique si la tuile (x, y) porte la propriété, False hors de la carte
+    def has(self, name, x, y):
+        bitmap = self.bitmaps.get(name)
+        if bitmap is None or x < 0 or y < 0 or x >= self.width or y >= self.height:
+            return False
+        return bitmap[y * self.width + x] == 1
+
+    # Retourne la première tuile (ligne par ligne) portant la propriété, None s'il n'y en a pas
+    def find(self, name):
+        tiles = self.tiles.get(name)
+        return tiles[0] if tiles else None
+
+    # Retourne toutes les tuiles portant la propriété
+    def find_all(self, name):
+        return list(self.tiles.get(name, ()))
+
+
+# Indique si un fichier dérivé est absent ou plus ancien que sa source
+def outdated(filename, source):
+    return not os.path.exists(filename) or os.path.getmtime(filename) < os.path.getmtime(source)
+
+
+# Retourne la largeur et la hauteur d'une image PNG, lues dans son en-tête
+def image_size(path):
+    with open(path, "rb") as f:
+        header = f.read(24)
+    if not header.startswith("\x89PNG"):
+        raise MapError("Cannot read the size of {}".format(path))
+    return struct.unpack(">II", header[16:24])
+
+
+# Ecrit l'atlas des tilesets : la région de texture de chaque gid, chemins relatifs au dossier de l'atlas
+def build_atlas(tilesets, directory, filename):
+    atlas = dict()
+    for ts in tilesets:
+        if ts["image"] is None:
+            continue
+        path = os.path.join(directory, ts["image"])
+        width, height = ts["width"], ts["height"]
+        if not (width and height):
+            width, height = image_size(path)
+        tw, th  = ts["tilewidth"], ts["tileheight"]
+        margin  = ts["margin"]
+        spacing = ts["spacing"]
+        cols    = (width - 2 * margin + spacing) // (tw + spacing)
+        rows    = (height - 2 * margin + spacing) // (th + spacing)
+
+        regions = dict()
+        for row in xrange(rows):
+            for col in xrange(cols):
+                x = margin + col * (tw + spacing)
+                y = height - (margin + row * (th + spacing)) - th
+                regions[str(ts["firstgid"] + row * cols + col)] = [x, y, tw, th]
+        atlas[os.path.relpath(path, os.path.dirname(os.path.abspath(filename)))] = regions
+
+    temporary = "{}.{}.tmp".format(filename, os.getpid())
+    with open(temporary, "w") as f:
+        json.dump(atlas, f)
+    os.rename(temporary, filename)
+
+
+# Ouvre l'index d'une carte TMX, en le (re)construisant s'il est absent ou plus ancien que la carte
+def load_map(tmx_file, chunk_size=CHUNK_SIZE):
+    index_file = os.path.splitext(tmx_file)[0] + ".kogmap"
+    if outdated(index_file, tmx_file):
+        MapIndex.build(TmxMap(tmx_file), index_file, chunk_size)
+    index = MapIndex(index_file)
+    if index.chunk_size != chunk_size:
+        index.close()
+        MapIndex.build(TmxMap(tmx_file), index_file, chunk_size)
+        index = MapIndex(index_file)
+    return index
+
+
+# Retourne l'atlas des tilesets d'une carte déjà indexée, en le (re)construisant s'il est absent ou périmé
+def load_atlas(tmx_file, index):
+    atlas_file = os.path.splitext(tmx_file)[0] + ".atlas"
+    if outdated(atlas_file, index.filename):
+        build_atlas(index.tilesets, os.path.dirname(os.path.abspath(tmx_file)), atlas_file)
+    with open(atlas_file) as f:
+        return json.load(f)